@@ -0,0 +1,131 @@
+"""Check that the incremental merge keeps links in sync within the 5-minute window against a local Postgres.
+
+    python -m benchmarks.links --table-rows 2000000 --file-rows 20000 --files 6
+
+The benchmark copy of links is seeded with synthetic follows, then incremental files are merged one after
+another exactly as insert_or_update_sql does. Each file mixes unfollows of stored links, follows again of
+stored (fid, target_fid, type) under a new id and hash, which conflict on both secondary unique
+constraints, and new follows. Prints seconds and rows/second per file and exits non-zero if any file takes
+longer than --window seconds.
+"""
+import argparse
+import sys
+import time
+from datetime import timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from benchmarks.loaders import create_engine_from_env, prepare_table, run_sql_script
+from benchmarks.synthetic import START_TIME, generate_table, random_bytes
+from models import Links
+from pg_copy import copy_batches, get_column_types
+from staging import create_staging_table, get_primary_key_columns, get_unique_constraints, merge_from_staging
+from transforms import transform_batch
+
+TABLE_NAME = 'links'
+FILE_SECONDS = 300
+
+
+def incremental_file(stored, index, rows, next_id, rng, unfollow_fraction, refollow_fraction):
+    """An incremental links file of `rows` rows changing the `stored` table, and the next unused id."""
+    updated_at = pa.scalar(START_TIME + timedelta(days=366, seconds=FILE_SECONDS * index), pa.timestamp('ms'))
+    unfollows = int(rows * unfollow_fraction)
+    refollows = int(rows * refollow_fraction)
+    follows = rows - unfollows - refollows
+    picked = stored.take(pa.array(rng.choice(stored.num_rows, unfollows + refollows, replace=False)))
+
+    unfollowed = picked.slice(0, unfollows)
+    unfollowed = unfollowed.set_column(unfollowed.schema.get_field_index('updated_at'), 'updated_at',
+                                       pa.array([updated_at.as_py()] * unfollows, pa.timestamp('ms')))
+    unfollowed = unfollowed.set_column(unfollowed.schema.get_field_index('deleted_at'), 'deleted_at',
+                                       unfollowed['updated_at'])
+
+    refollowed = picked.slice(unfollows)
+    refollowed = refollowed.set_column(refollowed.schema.get_field_index('id'), 'id',
+                                       pa.array(np.arange(next_id, next_id + refollows, dtype=np.int64)))
+    refollowed = refollowed.set_column(refollowed.schema.get_field_index('hash'), 'hash',
+                                       random_bytes(rng, refollows, 20))
+    for column in ('timestamp', 'created_at', 'updated_at'):
+        refollowed = refollowed.set_column(refollowed.schema.get_field_index(column), column,
+                                           pa.array([updated_at.as_py()] * refollows, pa.timestamp('ms')))
+    refollowed = refollowed.set_column(refollowed.schema.get_field_index('deleted_at'), 'deleted_at',
+                                       pa.nulls(refollows, pa.timestamp('ms')))
+    next_id += refollows
+
+    # Synthetic links follow target_fid = id, so fresh ids are fresh (fid, target_fid, type) triples
+    followed = generate_table(TABLE_NAME, follows, seed=index + 1)
+    new_ids = pa.array(np.arange(next_id, next_id + follows, dtype=np.int64))
+    followed = followed.set_column(followed.schema.get_field_index('id'), 'id', new_ids)
+    followed = followed.set_column(followed.schema.get_field_index('target_fid'), 'target_fid', new_ids)
+    next_id += follows
+    return pa.concat_tables([unfollowed, refollowed, followed.cast(stored.schema)]), next_id
+
+
+def apply_file(engine, table, column_types, key_columns, unique_constraints):
+    """Merge one file through a staging table like insert_or_update_sql and return (seconds, counts)."""
+    conn = engine.raw_connection()
+    try:
+        start_time = time.perf_counter()
+        with conn.cursor() as cursor:
+            batches = [transform_batch(batch, Links, column_types) for batch in table.to_batches()]
+            columns = batches[0].schema.names
+            stage_name = create_staging_table(cursor, TABLE_NAME, sequenced=True)
+            copy_batches(cursor, stage_name, columns, [column_types[name] for name in columns], batches)
+            counts = merge_from_staging(cursor, TABLE_NAME, stage_name, columns, key_columns, unique_constraints)
+        conn.commit()
+        return time.perf_counter() - start_time, counts
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--table-rows', type=int, default=1_000_000, help='links stored before the first file')
+    parser.add_argument('--file-rows', type=int, default=20_000, help='rows per 5-minute incremental file')
+    parser.add_argument('--files', type=int, default=6)
+    parser.add_argument('--unfollow-fraction', type=float, default=0.1)
+    parser.add_argument('--refollow-fraction', type=float, default=0.2)
+    parser.add_argument('--window', type=float, default=FILE_SECONDS, help='seconds each file has to be applied in')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    engine = create_engine_from_env()
+    run_sql_script(engine, './sql/setup.sql')
+    prepare_table(engine, TABLE_NAME)
+    stored = generate_table(TABLE_NAME, args.table_rows, seed=args.seed)
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            column_types = get_column_types(cursor, TABLE_NAME)
+            key_columns = get_primary_key_columns(cursor, TABLE_NAME)
+            unique_constraints = get_unique_constraints(cursor, TABLE_NAME)
+            batches = [transform_batch(batch, Links, column_types) for batch in stored.to_batches()]
+            columns = batches[0].schema.names
+            copy_batches(cursor, TABLE_NAME, columns, [column_types[name] for name in columns], batches)
+            cursor.execute(f"ANALYZE {TABLE_NAME}")
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"{TABLE_NAME}: seeded {args.table_rows} rows", flush=True)
+
+    rng = np.random.default_rng(args.seed)
+    next_id = int(pc.max(stored['id']).as_py()) + 1
+    slowest = 0.0
+    for index in range(args.files):
+        table, next_id = incremental_file(stored, index, args.file_rows, next_id, rng,
+                                          args.unfollow_fraction, args.refollow_fraction)
+        seconds, (inserted, updated, skipped) = apply_file(engine, table, column_types, key_columns,
+                                                           unique_constraints)
+        slowest = max(slowest, seconds)
+        print(f"file {index}: {table.num_rows} rows in {seconds:.2f} seconds "
+              f"({table.num_rows / seconds:.0f} rows/second): {inserted} inserted, {updated} updated, "
+              f"{skipped} skipped", flush=True)
+    print(f"slowest file took {slowest:.2f} seconds, {slowest / args.window:.1%} of the {args.window:.0f}-second window",
+          flush=True)
+    sys.exit(1 if slowest > args.window else 0)
+
+
+if __name__ == '__main__':
+    main()
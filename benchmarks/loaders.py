@@ -0,0 +1,208 @@
+"""Time the loader paths phase by phase against a local Postgres and write the results as JSON.
+
+    python -m benchmarks.loaders --rows 200000 --tables casts reactions --paths copy merge --output results.json
+
+Tables are created in a separate `benchmark` schema, copied from the ones sql/setup.sql creates, and
+truncated before every run, so the real tables are never touched. Point DB_* at the docker-compose
+Postgres rather than production.
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.synthetic import MODELS, write_file
+from index_builds import skip_deferred_indexes
+from parquet_source import open_parquet_file
+from pipeline import iter_pipeline
+from pg_copy import copy_batches, get_column_types
+from staging import create_staging_table, get_primary_key_columns, get_unique_constraints, insert_from_staging_sql, \
+    merge_from_staging
+from transforms import project_columns, transform_batch
+
+BENCHMARK_SCHEMA = 'benchmark'
+PATHS = ('copy', 'merge', 'insert')
+# Same batch size as insert_or_update_sql_seed.BATCH_SIZE
+INSERT_BATCH_SIZE = 200000
+
+
+def create_engine_from_env():
+    load_dotenv()
+    connection_string = (f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_HOST')}:"
+                         f"{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}")
+    return create_engine(connection_string, connect_args={'options': f'-csearch_path={BENCHMARK_SCHEMA}'})
+
+
+def run_sql_script(engine, filename):
+    with open(filename, 'r') as file:
+        statements = [s.strip() for s in file.read().split(';') if s.strip()]
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            # LOCAL, so the pooled connection goes back to the benchmark schema afterwards
+            cursor.execute("SET LOCAL search_path TO public")
+            for statement in skip_deferred_indexes(cursor, statements):
+                cursor.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def prepare_table(engine, table_name):
+    """(Re)create the benchmark copy of table_name with the real table's columns, constraints and indexes."""
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {BENCHMARK_SCHEMA}")
+            cursor.execute(f"DROP TABLE IF EXISTS {BENCHMARK_SCHEMA}.{table_name}")
+            cursor.execute(f"CREATE TABLE {BENCHMARK_SCHEMA}.{table_name} (LIKE public.{table_name} INCLUDING ALL)")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.phases = {}
+
+    def time(self, phase, function, *args):
+        start_time = time.perf_counter()
+        result = function(*args)
+        self.phases[phase] = self.phases.get(phase, 0.0) + time.perf_counter() - start_time
+        return result
+
+
+def decode(file_path, orm_class):
+    with open_parquet_file(file_path) as pf:
+        columns = project_columns(pf.schema_arrow.names, orm_class)
+        return columns, [batch for _, _, batch in iter_pipeline(pf, columns=columns)]
+
+
+def run_copy(engine, orm_class, file_path, timer, merge=False):
+    """The COPY path of insert_or_update_sql_seed.copy_file, or the incremental merge of insert_or_update_sql."""
+    table_name = orm_class.__tablename__
+    columns, batches = timer.time('decode', decode, file_path, orm_class)
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            column_types = get_column_types(cursor, table_name)
+            batches = timer.time('transform', lambda: [transform_batch(batch, orm_class, column_types)
+                                                       for batch in batches])
+            stage_name = create_staging_table(cursor, table_name, sequenced=merge)
+            timer.time('send', copy_batches, cursor, stage_name, columns,
+                       [column_types[name] for name in columns], batches)
+            key_columns = get_primary_key_columns(cursor, table_name) if merge else None
+            unique_constraints = get_unique_constraints(cursor, table_name) if merge else None
+
+            def commit():
+                if merge:
+                    inserted, updated, _ = merge_from_staging(cursor, table_name, stage_name, columns, key_columns,
+                                                           unique_constraints)
+                    rows = inserted + updated
+                else:
+                    cursor.execute(insert_from_staging_sql(table_name, stage_name, columns))
+                    rows = cursor.rowcount
+                conn.commit()
+                return rows
+
+            return timer.time('commit', commit)
+    finally:
+        conn.close()
+
+
+def run_insert(engine, orm_class, file_path, timer):
+    """The batched INSERT ... ON CONFLICT DO NOTHING path of insert_or_update_sql_seed.process_chunk."""
+    _, batches = timer.time('decode', decode, file_path, orm_class)
+    table_columns = orm_class.__table__.columns.keys()
+
+    def build_rows():
+        return [{key: value for key, value in row.items() if key in table_columns}
+                for batch in batches for row in batch.to_pylist()]
+
+    rows = timer.time('transform', build_rows)
+    session = sessionmaker(bind=engine)()
+    try:
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            statement = insert(orm_class.__table__).on_conflict_do_nothing()
+            timer.time('send', session.execute, statement, rows[start:start + INSERT_BATCH_SIZE])
+        timer.time('commit', session.commit)
+        # executemany does not report how many rows ON CONFLICT DO NOTHING kept; the table started empty
+        return session.execute(text(f"SELECT count(*) FROM {orm_class.__tablename__}")).scalar()
+    finally:
+        session.close()
+
+
+def benchmark(engine, table_name, path, file_path, repeat):
+    orm_class = MODELS[table_name]
+    runs = []
+    for _ in range(repeat):
+        prepare_table(engine, table_name)
+        timer = PhaseTimer()
+        if path == 'insert':
+            rows = run_insert(engine, orm_class, file_path, timer)
+        else:
+            rows = run_copy(engine, orm_class, file_path, timer, merge=path == 'merge')
+        total_seconds = sum(timer.phases.values())
+        runs.append({'rows': rows, 'phases': timer.phases, 'total_seconds': total_seconds,
+                     'rows_per_second': rows / total_seconds if total_seconds else 0.0})
+    best = min(runs, key=lambda run: run['total_seconds'])
+    return {'table': table_name, 'path': path, 'file_bytes': os.path.getsize(file_path), **best, 'runs': runs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000, help='rows per generated file')
+    parser.add_argument('--row-group-size', type=int, default=100_000)
+    parser.add_argument('--tables', nargs='+', default=sorted(MODELS), choices=sorted(MODELS))
+    parser.add_argument('--paths', nargs='+', default=list(PATHS), choices=PATHS)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per table and path; the fastest is reported')
+    parser.add_argument('--data-dir', help='existing files from benchmarks.synthetic; generated into a temp dir if omitted')
+    parser.add_argument('--output', help='JSON results file (default: stdout)')
+    args = parser.parse_args()
+
+    engine = create_engine_from_env()
+    run_sql_script(engine, './sql/setup.sql')
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='benchmark-')
+    results = []
+    for table_name in args.tables:
+        file_path = os.path.join(data_dir, next((f for f in os.listdir(data_dir) if f.split('-')[1] == table_name), ''))
+        if not os.path.isfile(file_path):
+            file_path = write_file(table_name, args.rows, data_dir, args.row_group_size)
+        for path in args.paths:
+            try:
+                results.append(benchmark(engine, table_name, path, file_path, args.repeat))
+                print(f"{table_name} {path}: {results[-1]['rows_per_second']:.0f} rows/second", flush=True)
+            except Exception as e:
+                # A path that cannot load a table is reported rather than aborting the whole suite
+                error = str(getattr(e, 'orig', e)).strip()
+                results.append({'table': table_name, 'path': path, 'error': error})
+                print(f"{table_name} {path}: failed: {error.splitlines()[0]}", flush=True)
+
+    with engine.connect() as conn:
+        server_version = conn.connection.dbapi_connection.server_version
+    report = {
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'postgres': server_version,
+        'cpu_count': os.cpu_count(),
+        'rows': args.rows,
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
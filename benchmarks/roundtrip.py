@@ -0,0 +1,151 @@
+"""Check that binary COPY from Arrow round-trips every column of every table against a local Postgres.
+
+    python -m benchmarks.roundtrip --rows 20000 --tables casts verifications
+
+Each table's synthetic export is transformed and copied into the `benchmark` schema exactly as the loaders
+do, read back ordered by primary key, and compared value by value with the Arrow data. Exits non-zero on
+the first table with a mismatch. Casts whose embeds and mentions are malformed in ways that fool a
+line-delimited JSON parser are then copied the same way, and must read back as [].
+"""
+import argparse
+import json
+import sys
+from datetime import timezone
+
+import pyarrow as pa
+
+from benchmarks.loaders import create_engine_from_env, prepare_table, run_sql_script
+from benchmarks.synthetic import MODELS, generate_table
+from pg_copy import copy_batches, get_column_types
+from staging import get_primary_key_columns
+from transforms import JSON_TYPES, transform_batch
+
+MAX_REPORTED_MISMATCHES = 5
+# (embeds, embeds read back, mentions, mentions read back) of casts that check malformed values
+MALFORMED_CASTS = [
+    ('1,"w":2', [], '1],"w":[2', []),
+    ('1} {"v":2', [], '1]} {"v":[2', []),
+    ('"a"}\n{"v":1', [], '[1,\n2]', [1, 2]),
+    ('{"a":NaN}', [], '{3, -4}', [3, -4]),
+    ('"x\\u0000"', [], '[99999999999999999999]', []),
+    ('[{"url": "https://x"}]', [{'url': 'https://x'}], 'abc', []),
+]
+
+
+def normalize(value, type_name):
+    """Python value of a column as psycopg2 returns it, for values read from Arrow or from Postgres."""
+    if value is None:
+        return None
+    if type_name in JSON_TYPES:
+        return json.loads(value) if isinstance(value, str) else value
+    if type_name == 'bytea':
+        return bytes(value)
+    if type_name in ('timestamp', 'timestamptz') and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    if type_name == 'timestamptz':
+        return value.replace(tzinfo=None)
+    return value
+
+
+def roundtrip(engine, table_name, rows, seed):
+    """Copy `rows` synthetic rows into the benchmark copy of table_name and return the mismatches found."""
+    orm_class = MODELS[table_name]
+    prepare_table(engine, table_name)
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            column_types = get_column_types(cursor, table_name)
+            primary_key = get_primary_key_columns(cursor, table_name)
+            table = generate_table(table_name, rows, seed=seed)
+            table = table.sort_by([(column, 'ascending') for column in primary_key])
+            batches = [transform_batch(batch, orm_class, column_types) for batch in table.to_batches()]
+            columns = batches[0].schema.names
+            types = [column_types[name] for name in columns]
+            copy_batches(cursor, table_name, columns, types, batches)
+            conn.commit()
+
+            column_list = ', '.join(f'"{column}"' for column in columns)
+            order_by = ', '.join(f'"{column}"' for column in primary_key)
+            cursor.execute(f"SELECT {column_list} FROM {table_name} ORDER BY {order_by}")
+            actual_rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    expected_rows = [row for batch in batches for row in zip(*(column.to_pylist() for column in batch.columns))]
+    if len(actual_rows) != len(expected_rows):
+        return [f"{table_name}: expected {len(expected_rows)} rows, read back {len(actual_rows)}"]
+    mismatches = []
+    for index, (expected, actual) in enumerate(zip(expected_rows, actual_rows)):
+        for name, type_name, expected_value, actual_value in zip(columns, types, expected, actual):
+            if normalize(expected_value, type_name) != normalize(actual_value, type_name):
+                mismatches.append(f"{table_name} row {index} {name} ({type_name}): "
+                                  f"expected {expected_value!r}, read back {actual_value!r}")
+                if len(mismatches) >= MAX_REPORTED_MISMATCHES:
+                    return mismatches
+    return mismatches
+
+
+def malformed(engine):
+    """Copy MALFORMED_CASTS into the benchmark copy of casts and return the mismatches found."""
+    prepare_table(engine, 'casts')
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            column_types = get_column_types(cursor, 'casts')
+            table = generate_table('casts', len(MALFORMED_CASTS))
+            embeds, _, mentions, _ = zip(*MALFORMED_CASTS)
+            for name, values in (('embeds', embeds), ('mentions', mentions)):
+                table = table.set_column(table.schema.get_field_index(name), name, pa.array(values))
+            batches = [transform_batch(batch, MODELS['casts'], column_types) for batch in table.to_batches()]
+            columns = batches[0].schema.names
+            copy_batches(cursor, 'casts', columns, [column_types[name] for name in columns], batches)
+            conn.commit()
+            cursor.execute("SELECT embeds, mentions FROM casts ORDER BY id")
+            actual_rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    if len(actual_rows) != len(MALFORMED_CASTS):
+        return [f"casts: expected {len(MALFORMED_CASTS)} rows, read back {len(actual_rows)}"]
+    mismatches = []
+    for (embeds_value, embeds_expected, mentions_value, mentions_expected), actual in zip(MALFORMED_CASTS,
+                                                                                          actual_rows):
+        for name, value, expected, actual_value in (('embeds', embeds_value, embeds_expected, actual[0]),
+                                                    ('mentions', mentions_value, mentions_expected, actual[1])):
+            if actual_value != expected:
+                mismatches.append(f"casts {name} {value!r}: expected {expected!r}, read back {actual_value!r}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20_000)
+    parser.add_argument('--tables', nargs='+', default=sorted(MODELS), choices=sorted(MODELS))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    engine = create_engine_from_env()
+    run_sql_script(engine, './sql/setup.sql')
+    failed = False
+    for table_name in args.tables:
+        mismatches = roundtrip(engine, table_name, args.rows, args.seed)
+        if mismatches:
+            failed = True
+            print(f"{table_name}: FAILED", flush=True)
+            for mismatch in mismatches:
+                print(f"  {mismatch}", flush=True)
+        else:
+            print(f"{table_name}: {args.rows} rows round-tripped", flush=True)
+    mismatches = malformed(engine)
+    if mismatches:
+        failed = True
+        print("malformed values: FAILED", flush=True)
+        for mismatch in mismatches:
+            print(f"  {mismatch}", flush=True)
+    else:
+        print(f"malformed values: {len(MALFORMED_CASTS)} casts read back as expected", flush=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
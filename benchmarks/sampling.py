@@ -0,0 +1,56 @@
+"""Check that reconcile samples about as many keys as it needs to split a range, whatever the keys look like.
+
+    python -m benchmarks.sampling --rows 2000000 --tables casts links
+
+Each table's synthetic export is scanned as one unbounded range, then again as the ranges it splits into,
+exactly as reconcile's first two passes do. Prints the keys sampled per range against the
+RECONCILE_FANOUT * SAMPLES_PER_RANGE aimed for and exits non-zero if either pass is off by more than
+--tolerance. No database is needed.
+"""
+import argparse
+import sys
+import tempfile
+
+import numpy as np
+
+from benchmarks.synthetic import MODELS, write_file
+from reconcile import RECONCILE_FANOUT, SAMPLES_PER_RANGE, KeyRange, above, scan_snapshot
+
+NO_CUTOFF = np.iinfo(np.int64).max
+
+
+def sampled_per_range(path, key_columns, ranges):
+    """Mean keys sampled per range in one scan of ranges that hold more rows than the target."""
+    smallest, largest = scan_snapshot(path, key_columns, ranges, NO_CUTOFF)
+    if ranges[0].low is None:
+        ranges[0].low, ranges[0].high = smallest, above(largest)
+    counted = [key_range for key_range in ranges if key_range.rows > RECONCILE_FANOUT * SAMPLES_PER_RANGE]
+    return sum(len(key_range.samples) for key_range in counted) / max(len(counted), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--tables', nargs='+', default=['casts', 'links'], choices=sorted(MODELS))
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    target = RECONCILE_FANOUT * SAMPLES_PER_RANGE
+    failed = False
+    with tempfile.TemporaryDirectory() as output_dir:
+        for table_name in args.tables:
+            path = write_file(table_name, args.rows, output_dir, seed=args.seed)
+            whole = KeyRange(None, None, args.rows)
+            first = sampled_per_range(path, ['id'], [whole])
+            second = sampled_per_range(path, ['id'], whole.split())
+            for label, sampled in (('first pass', first), ('second pass', second)):
+                off = abs(sampled - target) / target
+                failed = failed or off > args.tolerance
+                print(f"{table_name} {label}: {sampled:.0f} keys sampled per range, aiming for {target} "
+                      f"({off:.1%} off)", flush=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Synthetic parquet exports shaped like the Neynar files for every table in models.py.
+
+    python -m benchmarks.synthetic --rows 200000 --tables casts reactions --output-dir ./benchmarks/data
+"""
+import argparse
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy import JSON, TIMESTAMP, BigInteger, SmallInteger
+from sqlalchemy.dialects.postgresql import BYTEA
+
+from models import Casts, Fids, Fnames, Links, ProfileWithAddresses, Reactions, Signers, Storage, UserData, \
+    Verifications, WarpcastPowerUsers
+
+MODELS = {model.__tablename__: model for model in (
+    Fids, Storage, Links, Casts, UserData, Reactions, Fnames, Signers, Verifications, WarpcastPowerUsers,
+    ProfileWithAddresses
+)}
+
+START_TIME = datetime(2023, 1, 1)
+MAX_FID = 1_000_000
+# Exponent of the Zipf distribution for fids: a few accounts produce most of the messages
+FID_SKEW = 1.3
+USER_DATA_TYPES = 6
+BYTEA_SIZES = {'signer': 32}
+DEFAULT_BYTEA_SIZE = 20
+# Share of NULLs in nullable columns that are usually empty in the exports
+NULL_FRACTIONS = {'deleted_at': 0.05, 'parent_hash': 0.6, 'parent_fid': 0.6, 'parent_url': 0.9,
+                  'root_parent_hash': 0.6, 'root_parent_url': 0.9, 'target_url': 0.9, 'target_hash': 0.1}
+WORDS = np.array(['gm', 'farcaster', 'frame', 'onchain', 'degen', 'build', 'ship', 'warpcast', 'hub', 'cast',
+                  'channel', 'based', 'mint', 'zora', 'hello', 'world', 'today', 'we', 'are', 'so', 'back'])
+
+
+def skewed_fids(rng, n):
+    return np.minimum(rng.zipf(FID_SKEW, n), MAX_FID).astype(np.int64)
+
+
+def random_bytes(rng, n, size):
+    data = pa.py_buffer(rng.bytes(n * size))
+    return pa.FixedSizeBinaryArray.from_buffers(pa.binary(size), n, [None, data]).cast(pa.binary())
+
+
+def random_text(rng, n, max_words=30):
+    lengths = rng.integers(1, max_words, n)
+    words = WORDS[rng.integers(0, len(WORDS), int(lengths.sum()))]
+    ends = np.cumsum(lengths)
+    return [' '.join(words[end - length:end]) for end, length in zip(ends, lengths)]
+
+
+def int_list_strings(rng, n, high, max_items=4, empty_fraction=0.7):
+    counts = np.where(rng.random(n) < empty_fraction, 0, rng.integers(1, max_items + 1, n))
+    values = rng.integers(0, high, int(counts.sum()))
+    ends = np.cumsum(counts)
+    return ['[' + ','.join(map(str, values[end - count:end])) + ']' for end, count in zip(ends, counts)]
+
+
+def embeds(rng, n):
+    kinds = rng.integers(0, 4, n)
+    return ['[]' if kind == 0 else
+            json.dumps([{'url': f'https://example.com/{i}/image.png'}]) if kind == 1 else
+            json.dumps([{'castId': {'fid': int(i % MAX_FID), 'hash': f'0x{i:040x}'}}]) if kind == 2 else
+            json.dumps([{'url': f'https://example.com/{i}'}, {'url': f'https://frames.example.com/{i}'}])
+            for i, kind in enumerate(kinds)]
+
+
+def column_array(table_name, column, n, rng, timestamps, ids):
+    name = column.name
+    if name in ('mentions', 'mentions_positions'):
+        return pa.array(int_list_strings(rng, n, MAX_FID if name == 'mentions' else 320))
+    if name == 'embeds':
+        return pa.array(embeds(rng, n))
+    if name == 'claim':
+        return pa.array([json.dumps({'address': f'0x{i:040x}', 'blockHash': f'0x{i:064x}', 'protocol': 'ethereum'})
+                         for i in ids])
+    if name == 'verified_addresses':
+        return pa.array([json.dumps({'eth_addresses': [f'0x{i:040x}'], 'sol_addresses': []}) for i in ids])
+    if name.endswith('_url'):
+        return pa.array([f'https://example.com/{i % 5000}' for i in rng.integers(0, 1 << 30, n)])
+    if name == 'fname':
+        return pa.array([f'user{i}' for i in ids])
+    if name == 'type' and table_name == 'links':
+        return pa.array(['follow'] * n)
+    # Keep the secondary unique constraints of sql/setup.sql satisfied: links (fid, target_fid, type)
+    # and user_data (fid, type)
+    if table_name == 'links' and name == 'target_fid':
+        return pa.array(ids)
+    if table_name == 'user_data' and name in ('fid', 'type'):
+        values = (ids - 1) // USER_DATA_TYPES + 1 if name == 'fid' else (ids - 1) % USER_DATA_TYPES + 1
+        return pa.array(values.astype(np.int64 if name == 'fid' else np.int16))
+    if name == 'reaction_type':
+        return pa.array(rng.integers(1, 3, n).astype(np.int16))
+    if column.primary_key and isinstance(column.type, BigInteger):
+        return pa.array(ids)
+    if name in ('fid', 'target_fid', 'parent_fid', 'app_fid'):
+        return pa.array(skewed_fids(rng, n))
+    if isinstance(column.type, TIMESTAMP):
+        if name in ('timestamp', 'created_at', 'updated_at'):
+            return pa.array(timestamps)
+        return pa.array(timestamps + np.timedelta64(3600, 's') * rng.integers(1, 24 * 365, n))
+    if isinstance(column.type, BYTEA):
+        return random_bytes(rng, n, BYTEA_SIZES.get(name, DEFAULT_BYTEA_SIZE))
+    if isinstance(column.type, JSON):
+        return pa.array(['{}'] * n)
+    if isinstance(column.type, SmallInteger):
+        return pa.array(rng.integers(1, 7, n).astype(np.int16))
+    if isinstance(column.type, BigInteger):
+        return pa.array(rng.integers(1, 1000, n).astype(np.int64))
+    return pa.array(random_text(rng, n))
+
+
+def generate_table(table_name, rows, seed=0, days=365):
+    """Arrow table of `rows` synthetic rows for table_name, in timestamp order like an export."""
+    rng = np.random.default_rng(seed)
+    ids = np.arange(1, rows + 1, dtype=np.int64)
+    offsets = np.sort(rng.integers(0, days * 86400 * 1000, rows)).astype('timedelta64[ms]')
+    timestamps = np.datetime64(START_TIME, 'ms') + offsets
+    arrays, names = [], []
+    for column in MODELS[table_name].__table__.columns:
+        array = column_array(table_name, column, rows, rng, timestamps, ids)
+        fraction = NULL_FRACTIONS.get(column.name) if column.nullable else None
+        if fraction:
+            array = pc.if_else(pa.array(rng.random(rows) < fraction), pa.nulls(rows, array.type), array)
+        arrays.append(array)
+        names.append(column.name)
+    return pa.table(arrays, names=names)
+
+
+def write_file(table_name, rows, output_dir, row_group_size=100_000, seed=0):
+    """Write a full export file named like the Neynar ones and return its path."""
+    os.makedirs(output_dir, exist_ok=True)
+    end_timestamp = int((START_TIME + timedelta(days=365)).timestamp())
+    path = os.path.join(output_dir, f"farcaster-{table_name}-0-{end_timestamp}.parquet")
+    pq.write_table(generate_table(table_name, rows, seed=seed), path, row_group_size=row_group_size)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000, help='rows per file')
+    parser.add_argument('--row-group-size', type=int, default=100_000)
+    parser.add_argument('--tables', nargs='+', default=sorted(MODELS), choices=sorted(MODELS))
+    parser.add_argument('--output-dir', default='./benchmarks/data/full')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for table_name in args.tables:
+        path = write_file(table_name, args.rows, args.output_dir, args.row_group_size, args.seed)
+        print(f"{path}: {args.rows} rows, {os.path.getsize(path)} bytes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import logging
+import os
+import time
+
+import metrics
+
+# Set to 1 to keep cast_counters up to date in the transactions that merge casts and reactions
+CAST_COUNTERS = os.getenv('CAST_COUNTERS', '0') == '1'
+
+COUNTER_COLUMNS = ('likes', 'recasts', 'replies', 'thread_size')
+# Per counted table: the columns its counters read, and (cast hash column, {counter: condition}) pairs, each
+# live row adding one to every counter whose condition it meets under the cast hash it holds in that column
+COUNTED_TABLES = {
+    'reactions': (('deleted_at', 'reaction_type', 'target_hash'),
+                  (('target_hash', {'likes': 'reaction_type = 1', 'recasts': 'reaction_type = 2'}),)),
+    'casts': (('deleted_at', 'hash', 'parent_hash', 'root_parent_hash'),
+              (('parent_hash', {'replies': 'TRUE'}),
+               # A root cast may carry its own hash as root_parent_hash, and is not part of its own thread size
+               ('root_parent_hash', {'thread_size': 'hash IS DISTINCT FROM root_parent_hash'}))),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def counted_columns(table_name):
+    """Columns of table_name the counters depend on, or () if merges into it leave cast_counters alone."""
+    if not CAST_COUNTERS or table_name not in COUNTED_TABLES:
+        return ()
+    return COUNTED_TABLES[table_name][0]
+
+
+def _counted_rows_sql(table_name, source, sign):
+    """(hash, counters...) of each live row of source, an aliased relation with table_name's counted columns."""
+    _, counters = COUNTED_TABLES[table_name]
+    values = []
+    for hash_column, conditions in counters:
+        values.append(f'(r."{hash_column}", ' + ', '.join(
+            f"CASE WHEN {conditions[counter]} THEN {sign} ELSE 0 END" if counter in conditions else '0'
+            for counter in COUNTER_COLUMNS) + ')')
+    return (f"SELECT v.* FROM {source} CROSS JOIN LATERAL (VALUES {', '.join(values)}) "
+            f"v (hash, {', '.join(COUNTER_COLUMNS)}) WHERE r.deleted_at IS NULL AND v.hash IS NOT NULL")
+
+
+def _summed_sql(counted_rows):
+    sums = ', '.join(f'sum({counter})' for counter in COUNTER_COLUMNS)
+    zeros = ', '.join('0' for _ in COUNTER_COLUMNS)
+    # Hashes are locked in order, so merges of casts and reactions counting the same casts cannot deadlock
+    return (f"SELECT hash, {sums} FROM ({' UNION ALL '.join(counted_rows)}) counted GROUP BY hash "
+            f"HAVING ({sums}) <> ({zeros}) ORDER BY hash")
+
+
+def counter_deltas_sql(table_name, signed_rows):
+    """INSERT that adds to cast_counters what the row versions of signed_rows change, for a CTE.
+
+    signed_rows is a query returning a sign column, 1 for a row version written and -1 for one overwritten or
+    deleted, and the counted columns of table_name. A row marked deleted_at counts for nothing, so marking a
+    row deleted takes back what it counted for.
+    """
+    return (f"INSERT INTO cast_counters AS c (hash, {', '.join(COUNTER_COLUMNS)}) "
+            f"{_summed_sql([_counted_rows_sql(table_name, f'({signed_rows}) r', 'r.sign')])} "
+            f"ON CONFLICT (hash) DO UPDATE SET " +
+            ', '.join(f"{counter} = c.{counter} + EXCLUDED.{counter}" for counter in COUNTER_COLUMNS))
+
+
+def recount_sql(counters_table='cast_counters', sources=None):
+    """INSERT that counts every live row of the counted tables into an empty counters_table.
+
+    sources maps a counted table to the relation it is read from instead, e.g. one in another schema.
+    """
+    sources = sources or {}
+    return (f"INSERT INTO {counters_table} (hash, {', '.join(COUNTER_COLUMNS)}) " +
+            _summed_sql([_counted_rows_sql(table_name, f"{sources.get(table_name, table_name)} r", '1')
+                         for table_name in COUNTED_TABLES]))
+
+
+def rebuild_cast_counters(engine):
+    """Recompute cast_counters from scratch, e.g. after a seed loaded casts or reactions without counting them.
+
+    Merges into casts and reactions wait until the rebuild commits, and reads of cast_counters while it runs.
+    """
+    start_time = time.time()
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {', '.join(COUNTED_TABLES)} IN SHARE MODE")
+            cursor.execute("TRUNCATE cast_counters")
+            cursor.execute(recount_sql())
+            counted = cursor.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    logger.info(f"Rebuilt cast_counters for {counted} casts in {time.time() - start_time:.2f} seconds")
+
+
+def main():
+    # Imported here, since the loader imports this module through staging
+    from insert_or_update_sql import ENGINE, PARTITIONED_SCHEMA, run_sql_script
+    if PARTITIONED_SCHEMA:
+        run_sql_script('./sql/partitioned_setup.sql')
+    run_sql_script('./sql/setup.sql')
+    rebuild_cast_counters(ENGINE)
+
+
+if __name__ == "__main__":
+    metrics.start('cast_counters')
+    main()
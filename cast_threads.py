@@ -0,0 +1,114 @@
+import logging
+import os
+import time
+
+import metrics
+
+# Set to 1 to keep cast_threads up to date in the transactions that merge casts
+CAST_THREADS = os.getenv('CAST_THREADS', '0') == '1'
+
+# Farcaster timestamps count seconds from 2021-01-01, which keeps them within four bytes
+FARCASTER_EPOCH = 1609459200
+# Path segments kept per cast, so a path stays well within the size of a btree index entry. Replies deeper than
+# this share the path of their ancestor at this depth and sort among themselves in no particular order
+THREAD_PATH_MAX_DEPTH = 256
+
+logger = logging.getLogger(__name__)
+
+
+def _segment(alias):
+    """Eight bytes that sort a cast among its siblings: its timestamp, then the start of its hash."""
+    return (f"int4send((extract(epoch FROM {alias}.timestamp) - {FARCASTER_EPOCH})::integer) || "
+            f"substring({alias}.hash FROM 1 FOR 4)")
+
+
+def _child_path(parent, child):
+    return (f"CASE WHEN {parent}.depth < {THREAD_PATH_MAX_DEPTH} THEN {parent}.path || {_segment(child)} "
+            f"ELSE {parent}.path END")
+
+
+def thread_updates_sql(table_name, stage_name):
+    """Statements that bring cast_threads up to date with the casts of a staging table, after their merge.
+
+    Each merged cast gets its row, or a new deleted_at, and a root cast is placed at once. A reply is placed
+    under its parent once the parent is placed, along with every reply waiting on it, however deep: replies
+    that arrive before their parent wait unplaced until it does. Returns no statements for tables other than
+    casts, or when CAST_THREADS is off.
+    """
+    if not CAST_THREADS or table_name != 'casts':
+        return []
+    return [
+        f"INSERT INTO cast_threads AS t (hash, parent_hash, timestamp, deleted_at, root_hash, depth, path) "
+        f"SELECT DISTINCT ON (c.hash) c.hash, c.parent_hash, c.timestamp, c.deleted_at, "
+        f"CASE WHEN c.parent_hash IS NULL THEN c.hash END, CASE WHEN c.parent_hash IS NULL THEN 0 END, "
+        f"CASE WHEN c.parent_hash IS NULL THEN {_segment('c')} END "
+        f"FROM {stage_name} s JOIN casts c ON c.hash = s.hash AND c.timestamp = s.timestamp ORDER BY c.hash "
+        f"ON CONFLICT (hash) DO UPDATE SET deleted_at = EXCLUDED.deleted_at "
+        f"WHERE t.deleted_at IS DISTINCT FROM EXCLUDED.deleted_at",
+        # Starts from the staged casts whose parent is placed, and the casts waiting on a staged cast that is
+        # placed, such as a root that arrived after its replies. Then walks down through the casts waiting on them
+        f"WITH RECURSIVE staged AS (SELECT DISTINCT hash FROM {stage_name}), placed AS ("
+        f"SELECT * FROM ("
+        f"SELECT t.hash, p.root_hash, p.depth + 1 AS depth, {_child_path('p', 't')} AS path "
+        f"FROM staged s JOIN cast_threads t ON t.hash = s.hash JOIN cast_threads p ON p.hash = t.parent_hash "
+        f"WHERE t.root_hash IS NULL AND p.root_hash IS NOT NULL "
+        f"UNION "
+        f"SELECT t.hash, p.root_hash, p.depth + 1, {_child_path('p', 't')} "
+        f"FROM staged s JOIN cast_threads p ON p.hash = s.hash JOIN cast_threads t ON t.parent_hash = p.hash "
+        f"WHERE t.root_hash IS NULL AND p.root_hash IS NOT NULL) ready "
+        f"UNION ALL "
+        f"SELECT t.hash, p.root_hash, p.depth + 1, {_child_path('p', 't')} "
+        f"FROM placed p JOIN cast_threads t ON t.parent_hash = p.hash WHERE t.root_hash IS NULL) "
+        f"UPDATE cast_threads t SET root_hash = placed.root_hash, depth = placed.depth, path = placed.path "
+        f"FROM placed WHERE t.hash = placed.hash",
+    ]
+
+
+def rebuild_cast_threads(engine):
+    """Recompute cast_threads from scratch, e.g. after a seed loaded casts without placing them.
+
+    Merges into casts wait until the rebuild commits, and reads of cast_threads while it runs.
+    """
+    start_time = time.time()
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("LOCK TABLE casts IN SHARE MODE")
+            cursor.execute("TRUNCATE cast_threads")
+            # Walks down from every root cast along idx_casts_parent_hash
+            cursor.execute(
+                f"INSERT INTO cast_threads (hash, parent_hash, timestamp, deleted_at, root_hash, depth, path) "
+                f"WITH RECURSIVE placed AS ("
+                f"SELECT c.hash, c.parent_hash, c.timestamp, c.deleted_at, c.hash AS root_hash, 0 AS depth, "
+                f"{_segment('c')} AS path FROM casts c WHERE c.parent_hash IS NULL "
+                f"UNION ALL "
+                f"SELECT c.hash, c.parent_hash, c.timestamp, c.deleted_at, p.root_hash, p.depth + 1, "
+                f"{_child_path('p', 'c')} FROM placed p JOIN casts c ON c.parent_hash = p.hash) "
+                f"SELECT * FROM placed ON CONFLICT (hash) DO NOTHING"
+            )
+            placed = cursor.rowcount
+            # Replies whose parent is not loaded wait for it unplaced
+            cursor.execute(
+                "INSERT INTO cast_threads (hash, parent_hash, timestamp, deleted_at) "
+                "SELECT hash, parent_hash, timestamp, deleted_at FROM casts ON CONFLICT (hash) DO NOTHING"
+            )
+            waiting = cursor.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    logger.info(f"Rebuilt cast_threads in {time.time() - start_time:.2f} seconds: {placed} casts placed, "
+                f"{waiting} waiting for their parent")
+
+
+def main():
+    # Imported here, since the loader imports this module through staging
+    from insert_or_update_sql import ENGINE, PARTITIONED_SCHEMA, run_sql_script
+    if PARTITIONED_SCHEMA:
+        run_sql_script('./sql/partitioned_setup.sql')
+    run_sql_script('./sql/setup.sql')
+    rebuild_cast_threads(ENGINE)
+
+
+if __name__ == "__main__":
+    metrics.start('cast_threads')
+    main()
@@ -0,0 +1,95 @@
+import os
+import time
+
+import metrics
+
+# Rows loaded between checkpoints; each checkpoint commits the rows before it
+CHECKPOINT_ROWS = int(os.getenv('CHECKPOINT_ROWS', 1000000))
+
+
+def get_checkpoint(cursor, file_name):
+    """(row_group, batch) to resume file_name from, or None if the file has no committed progress."""
+    cursor.execute("SELECT row_group, batch FROM file_checkpoints WHERE file_name = %s", (file_name,))
+    row = cursor.fetchone()
+    return tuple(row) if row else None
+
+
+def save_checkpoint(cursor, file_name, table_name, position):
+    cursor.execute(
+        "INSERT INTO file_checkpoints (file_name, table_name, row_group, batch) VALUES (%s, %s, %s, %s) "
+        "ON CONFLICT (file_name) DO UPDATE SET row_group = EXCLUDED.row_group, batch = EXCLUDED.batch, "
+        "updated_at = CURRENT_TIMESTAMP",
+        (file_name, table_name, *position)
+    )
+
+
+def clear_checkpoint(cursor, file_name):
+    cursor.execute("DELETE FROM file_checkpoints WHERE file_name = %s", (file_name,))
+
+
+def has_checkpoint(engine, file_name):
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            return get_checkpoint(cursor, file_name) is not None
+    finally:
+        conn.close()
+
+
+class Chunk:
+    """Up to about `rows` positioned batches, consumed lazily so a chunk is never held in memory at once.
+
+    After iteration, `end` is the position to resume from, or None once the file is exhausted.
+    """
+
+    def __init__(self, positioned_batches, rows):
+        self._batches = positioned_batches
+        self._rows = rows
+        self.end = None
+        self.exhausted = False
+
+    def __iter__(self):
+        rows = 0
+        while rows < self._rows:
+            item = next(self._batches, None)
+            if item is None:
+                self.exhausted = True
+                self.end = None
+                return
+            row_group, batch_index, batch = item
+            self.end = (row_group, batch_index + 1)
+            rows += batch.num_rows
+            yield batch
+
+
+def load_in_chunks(conn, file_name, table_name, positioned_batches, load_chunk, finish=None, checkpoint_rows=None):
+    """Load a file in chunks of about CHECKPOINT_ROWS rows, committing each chunk with its checkpoint.
+
+    load_chunk(cursor, batches) loads one chunk and returns the number of rows it applied. The last chunk's
+    transaction clears the checkpoint and runs finish(cursor); if finish returns False the transaction is
+    rolled back and None is returned. Otherwise returns the total rows applied.
+    """
+    batches = iter(positioned_batches)
+    total_rows = 0
+    while True:
+        chunk = Chunk(batches, checkpoint_rows or CHECKPOINT_ROWS)
+        start_time = time.time()
+        try:
+            with conn.cursor() as cursor:
+                chunk_rows = load_chunk(cursor, chunk)
+                if not chunk.exhausted:
+                    save_checkpoint(cursor, file_name, table_name, chunk.end)
+                else:
+                    clear_checkpoint(cursor, file_name)
+                    if finish is not None and finish(cursor) is False:
+                        conn.rollback()
+                        return None
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        total_rows += chunk_rows
+        metrics.inc('rows_applied_total', chunk_rows, table=table_name)
+        metrics.observe('batch_duration_seconds', time.time() - start_time, table=table_name)
+        if chunk.exhausted:
+            return total_rows
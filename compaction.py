@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from parquet_source import open_parquet_file
+from transforms import project_columns
+
+# Most consecutive incremental files of one table merged and applied together while catching up
+COMPACT_MAX_FILES = int(os.getenv('COMPACT_MAX_FILES', 48))
+# Rows a merged run may hold before dedupe; the run is built in memory, so later files wait for the next one
+COMPACT_MAX_ROWS = int(os.getenv('COMPACT_MAX_ROWS', 1000000))
+
+ORDER_COLUMN = 'updated_at'
+_SEQUENCE_COLUMN = '__compaction_seq'
+
+
+def dedupe_latest(table, primary_key):
+    """Keep one row per primary key: the one with the latest updated_at, the later one in the run on ties.
+
+    Rows without updated_at sort last and so lose to rows with one. The rows kept stay in run order.
+    """
+    if table.num_rows < 2:
+        return table
+    keyed = table.select(primary_key).append_column(_SEQUENCE_COLUMN, pa.array(np.arange(table.num_rows)))
+    sort_keys = [(column, 'ascending') for column in primary_key]
+    if ORDER_COLUMN in table.column_names:
+        keyed = keyed.append_column(ORDER_COLUMN, table[ORDER_COLUMN])
+        sort_keys.append((ORDER_COLUMN, 'descending'))
+    sort_keys.append((_SEQUENCE_COLUMN, 'descending'))
+    indices = pc.sort_indices(keyed, sort_keys=sort_keys)
+    grouped = keyed.take(indices)
+
+    # The first row of each key in sort order is the one to keep
+    first = np.zeros(table.num_rows, dtype=bool)
+    first[0] = True
+    for column in primary_key:
+        values = grouped[column].combine_chunks()
+        first[1:] |= pc.not_equal(values[1:], values[:-1]).to_numpy(zero_copy_only=False)
+    keep = np.sort(indices.to_numpy()[first])
+    return table.take(pa.array(keep))
+
+
+def read_run(file_paths, orm_class, primary_key, on_open=None):
+    """Read a run of one table's files oldest first, while it stays within COMPACT_MAX_ROWS rows, and dedupe it.
+
+    on_open(pf) is called for every file read, e.g. to create the partitions it needs. Returns the compacted
+    table, the number of files read and the rows they held.
+    """
+    tables = []
+    rows_read = 0
+    for file_path in file_paths:
+        with open_parquet_file(file_path) as pf:
+            if tables and rows_read + pf.metadata.num_rows > COMPACT_MAX_ROWS:
+                break
+            if on_open is not None:
+                on_open(pf)
+            tables.append(pf.read(columns=project_columns(pf.schema_arrow.names, orm_class)))
+            rows_read += pf.metadata.num_rows
+    # Columns whose type differs between files, e.g. all null in one of them, are widened
+    compacted = dedupe_latest(pa.concat_tables(tables, promote_options='permissive'), primary_key)
+    return compacted, len(tables), rows_read
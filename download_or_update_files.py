@@ -1,10 +1,16 @@
+import json
 import logging
 import os
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError, ProfileNotFound
 from dotenv import load_dotenv
 
+import metrics
+import work_queue
+from s3_download import DOWNLOAD_WORKERS, MULTIPART_CONCURRENCY, download_object, download_objects
+
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,14 +20,150 @@ local_full_path = os.path.abspath('./downloads/full')
 s3_incremental_path = 's3://tf-premium-parquet/public-postgres/farcaster/v2/incremental/'
 local_incremental_path = os.path.abspath('./downloads/incremental')
 file_types = ['casts', 'fids', 'fnames', 'links', 'reactions', 'signers', 'storage', 'user_data', 'verifications', 'warpcast_power_users', 'profile_with_addresses']
+manifest_path = os.path.abspath(os.getenv('S3_MANIFEST_PATH', './downloads/s3_manifest.json'))
+
+aws_profile = os.getenv('AWS_PROFILE', 'neynar_parquet_exports')
+# Point at a local S3 stand-in (moto server, minio) instead of AWS when set
+s3_endpoint_url = os.getenv('S3_ENDPOINT_URL') or None
 
 try:
-    session = boto3.Session(profile_name='neynar_parquet_exports')
-    s3 = session.client('s3')
+    session = boto3.Session(profile_name=aws_profile)
+    s3 = session.client('s3', endpoint_url=s3_endpoint_url,
+                        config=Config(max_pool_connections=DOWNLOAD_WORKERS * MULTIPART_CONCURRENCY))
 except ProfileNotFound as e:
-    logging.error("AWS profile 'neynar_parquet_exports' not found. Please ensure it is configured correctly.")
+    logging.error(f"AWS profile '{aws_profile}' not found. Please ensure it is configured correctly.")
     raise e
 
+# S3 paths whose manifest entry has been refreshed by this process
+refreshed_paths = set()
+
+
+def split_s3_path(s3_path):
+    bucket_name = s3_path.split('/')[2]
+    prefix = '/'.join(s3_path.split('/')[3:])
+    return bucket_name, prefix
+
+
+def key_file_type(key):
+    """Table name encoded in an export key, e.g. 'casts' for .../farcaster-casts-1712000000-1712000300.parquet"""
+    parts = os.path.basename(key).split('-')
+    return parts[1] if len(parts) > 2 else None
+
+
+def key_timestamp(key):
+    return int(key.rsplit('.', 1)[0].rsplit('-', 1)[-1])
+
+
+def load_manifest(path=None):
+    path = path or manifest_path
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def save_manifest(manifest, path=None):
+    path = path or manifest_path
+    ensure_directory_exists(os.path.dirname(path))
+    # Written aside and renamed over the old one, so a crash mid-write leaves the previous manifest intact
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def list_keys(bucket_name, prefix, start_after=None):
+    paginator = s3.get_paginator('list_objects_v2')
+    request_params = {'Bucket': bucket_name, 'Prefix': prefix}
+    if start_after:
+        request_params['StartAfter'] = start_after
+    for page in paginator.paginate(**request_params):
+        contents = page.get('Contents', [])
+        metrics.inc('s3_list_requests_total')
+        metrics.inc('s3_listed_objects_total', len(contents))
+        for file in contents:
+            yield file
+
+
+def add_missing_file_types(path_entry):
+    """Give file types not published yet an empty entry, with a key prefix derived from a known type."""
+    if not path_entry:
+        return
+    known_entry = next(iter(path_entry.values()))
+    key_base = known_entry['key_prefix'].rsplit('-', 2)[0]
+    for file_type in file_types:
+        path_entry.setdefault(file_type, {'key_prefix': f"{key_base}-{file_type}-", 'last_key': '', 'objects': {}})
+
+
+def refresh_manifest(s3_path, manifest):
+    """Add objects published under s3_path since the last run to the manifest.
+
+    Keys sort by table name before timestamp, so the last key seen is kept per file type and each
+    type is listed from there with StartAfter. A full listing is only done when a type is missing.
+    """
+    bucket_name, prefix = split_s3_path(s3_path)
+    path_entry = manifest.setdefault(s3_path, {})
+
+    if not path_entry:
+        listings = [list_keys(bucket_name, prefix)]
+    else:
+        add_missing_file_types(path_entry)
+        listings = [list_keys(bucket_name, entry['key_prefix'], entry['last_key']) for entry in path_entry.values()]
+
+    new_files = 0
+    for listing in listings:
+        for file in listing:
+            key = file['Key']
+            file_type = key_file_type(key)
+            if not file_type or not key.endswith('.parquet'):
+                continue
+            type_entry = path_entry.setdefault(file_type, {
+                'key_prefix': key.rsplit('-', 2)[0] + '-',
+                'last_key': '',
+                'objects': {},
+            })
+            if key in type_entry['objects']:
+                continue
+            type_entry['objects'][key] = {'size': file['Size'], 'etag': file['ETag'].strip('"'),
+                                          'timestamp': key_timestamp(key)}
+            type_entry['last_key'] = max(type_entry['last_key'], key)
+            new_files += 1
+
+    add_missing_file_types(path_entry)
+    logging.info(f"Manifest refreshed for {s3_path}: {new_files} new files")
+    return path_entry
+
+
+def load_refreshed_manifest(s3_paths, relist=False):
+    """Load the manifest once for a whole run, with s3_paths brought up to date.
+
+    Each path is listed at most once per process unless relist is set. The per-type helpers read and change
+    the returned manifest in memory, and the caller writes it back once with save_manifest.
+    """
+    manifest = load_manifest()
+    for s3_path in s3_paths:
+        if relist or s3_path not in refreshed_paths:
+            refresh_manifest(s3_path, manifest)
+            refreshed_paths.add(s3_path)
+    return manifest
+
+
+def get_manifest_objects(manifest, s3_path, file_type):
+    """Return [(key, object info)] for file_type under s3_path, oldest first."""
+    type_entry = manifest.get(s3_path, {}).get(file_type, {'objects': {}})
+    return sorted(type_entry['objects'].items(), key=lambda item: item[1]['timestamp'])
+
+
+def prune_manifest(manifest, s3_path, file_type, oldest_timestamp):
+    """Forget objects of file_type older than oldest_timestamp; they will never be downloaded again."""
+    type_entry = manifest.get(s3_path, {}).get(file_type)
+    if not type_entry:
+        return
+    type_entry['objects'] = {key: info for key, info in type_entry['objects'].items()
+                             if info['timestamp'] >= oldest_timestamp}
+
 
 def file_already_downloaded(local_path, file_type):
     for file in os.listdir(local_path):
@@ -30,24 +172,22 @@ def file_already_downloaded(local_path, file_type):
     return False
 
 
-def download_most_recent_file(s3_path, local_path, file_type):
+def download_most_recent_file(s3_path, local_path, file_type, manifest):
     if file_already_downloaded(local_path, file_type):
         return
 
     try:
-        bucket_name = s3_path.split('/')[2]
-        prefix = '/'.join(s3_path.split('/')[3:])
-        response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-        files = [file for file in response['Contents'] if file_type in file['Key'] and file['Key'].endswith('.parquet')]
-        files.sort(key=lambda x: int(x['Key'].rsplit('.', 1)[0].rsplit('-', 1)[-1]), reverse=True)
+        bucket_name, _ = split_s3_path(s3_path)
+        files = get_manifest_objects(manifest, s3_path, file_type)
 
         if files:
-            most_recent_file = files[0]['Key']
-            file_size = files[0]['Size']
+            most_recent_file, file_info = files[-1]
+            file_size = file_info['size']
             logging.info(f"Most recent file: {most_recent_file}, Size: {file_size} bytes")
             local_file_path = os.path.join(local_path, os.path.basename(most_recent_file))
-            if not os.path.exists(local_file_path):
-                s3.download_file(bucket_name, most_recent_file, local_file_path)
+            downloaded = download_object(s3, bucket_name, most_recent_file, local_file_path, file_size,
+                                         file_info['etag'])
+            metrics.inc('s3_download_bytes_total', downloaded, table=file_type)
         else:
             logging.info(f"No files found for {file_type} in {s3_path}")
     except NoCredentialsError as e:
@@ -55,6 +195,24 @@ def download_most_recent_file(s3_path, local_path, file_type):
             f"Failed to download the most recent file for {file_type} from {s3_path} to {local_path}: {str(e)}")
 
 
+def get_stream_files():
+    """S3 URIs of the newest full file per type and the incremental files since it, for loading without a download."""
+    bucket_name, _ = split_s3_path(s3_daily_path)
+    manifest = load_refreshed_manifest([s3_daily_path, s3_incremental_path])
+    full_files, incremental_files = [], []
+    for file_type in file_types:
+        files = get_manifest_objects(manifest, s3_daily_path, file_type)
+        if not files:
+            continue
+        full_key, full_info = files[-1]
+        full_files.append(f"s3://{bucket_name}/{full_key}")
+        incremental_files.extend(f"s3://{bucket_name}/{key}"
+                                 for key, info in get_manifest_objects(manifest, s3_incremental_path, file_type)
+                                 if info['timestamp'] >= full_info['timestamp'])
+    save_manifest(manifest)
+    return full_files, incremental_files
+
+
 def ensure_directory_exists(path):
     if not os.path.exists(path):
         os.makedirs(path)
@@ -87,90 +245,92 @@ def delete_outdated_incremental_files(local_incremental_path, file_type, latest_
                 logging.error(f"Filename format is unexpected: {file}")
 
 
-def download_incremental_files(bucket_name, local_incremental_path, file_type, latest_timestamp):
-    prefix = '/'.join(s3_incremental_path.split('/')[3:])
-    continuation_token = None
-    while True:
-        request_params = {'Bucket': bucket_name, 'Prefix': prefix}
-        if continuation_token:
-            request_params['ContinuationToken'] = continuation_token
-        response = s3.list_objects_v2(**request_params)
-        if 'Contents' in response:
-            for file in response['Contents']:
-                file_key = file['Key']
-                if file_type in file_key and file_key.endswith('.parquet'):
-                    file_timestamp = int(file_key.rsplit('.', 1)[0].rsplit('-', 1)[-1])
-                    if file_timestamp >= latest_timestamp:
-                        local_file_path = os.path.join(local_incremental_path, os.path.basename(file_key))
-                        if not os.path.exists(local_file_path):
-                            s3.download_file(bucket_name, file_key, local_file_path)
-        continuation_token = response.get('NextContinuationToken', None)
-        if not continuation_token:
-            break
-
-
-def get_available_file_types(s3_path):
-    bucket_name = s3_path.split('/')[2]
-    prefix = '/'.join(s3_path.split('/')[3:])
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
+def download_incremental_files(bucket_name, local_incremental_path, file_type, latest_timestamp, manifest):
+    prune_manifest(manifest, s3_incremental_path, file_type, latest_timestamp)
+    jobs = []
+    for file_key, file_info in get_manifest_objects(manifest, s3_incremental_path, file_type):
+        if file_info['timestamp'] >= latest_timestamp:
+            local_file_path = os.path.join(local_incremental_path, os.path.basename(file_key))
+            if not os.path.exists(local_file_path):
+                jobs.append((file_key, local_file_path, file_info['size'], file_info['etag']))
+    # Each file is queued for the loaders the moment it is published, while the rest are still downloading
+    downloaded_bytes = download_objects(s3, bucket_name, jobs,
+                                        on_downloaded=lambda local_path: work_queue.enqueue([local_path]))
+    metrics.inc('s3_download_bytes_total', downloaded_bytes, table=file_type)
+    newest_timestamp = get_latest_full_timestamp(local_incremental_path, file_type)
+    if newest_timestamp:
+        metrics.set_gauge('newest_downloaded_timestamp_seconds', newest_timestamp, table=file_type)
+    return len(jobs)
+
+
+def sync_incremental_files(relist=False, manifest=None):
+    """Drop incremental files older than the local full files and download the ones published since.
+
+    relist forces a new S3 listing in a long-running process, which otherwise lists each path once. Without
+    manifest, the manifest is loaded and saved here; with one, saving it is left to the caller. Returns the
+    number of files downloaded.
+    """
+    loaded = manifest is None
+    if loaded:
+        manifest = load_refreshed_manifest([s3_incremental_path], relist=relist)
+    ensure_directory_exists(local_incremental_path)
+    downloaded = 0
+    for file_type in file_types:
+        latest_timestamp = get_latest_full_timestamp(local_full_path, file_type)
+        if latest_timestamp:
+            delete_outdated_incremental_files(local_incremental_path, file_type, latest_timestamp)
+            work_queue.forget_before(file_type, latest_timestamp)
+            downloaded += download_incremental_files(s3_incremental_path.split('/')[2], local_incremental_path,
+                                                     file_type, latest_timestamp, manifest)
+    if loaded:
+        save_manifest(manifest)
+    return downloaded
+
 
-    file_types = {}
+def get_available_file_types(s3_path, manifest):
+    available_types = {}
     latest_timestamp = 0
 
-    if 'Contents' in response:
-        files = response['Contents']
-        files.sort(key=lambda x: x['LastModified'], reverse=True)
-        recent_files = files[:14]  # Get the most recent 20 files
-
-        for file in recent_files:
-            file_name = file['Key'].split('/')[-1]
-            logging.info(f"File found: {file_name}")
-            if file_name.endswith('.parquet'):
-                file_parts = file_name.split('-')
-                if len(file_parts) > 1:
-                    file_type = file_parts[0]
-                    try:
-                        timestamp = int(file_parts[-1].split('.')[0])
-                    except ValueError:
-                        logging.error(f"Error parsing timestamp from file name: {file_name}")
-                        continue
-
-                    if timestamp > latest_timestamp:
-                        latest_timestamp = timestamp
-                        file_types = {file_type: timestamp}
-                    elif timestamp == latest_timestamp:
-                        file_types[file_type] = timestamp
+    for file_type in file_types:
+        files = get_manifest_objects(manifest, s3_path, file_type)
+        if not files:
+            continue
+        file_key, file_info = files[-1]
+        logging.info(f"File found: {os.path.basename(file_key)}")
+        timestamp = file_info['timestamp']
+        if timestamp > latest_timestamp:
+            latest_timestamp = timestamp
+            available_types = {file_type: timestamp}
+        elif timestamp == latest_timestamp:
+            available_types[file_type] = timestamp
 
     # Log the available file types and their timestamps
     logging.info(f"Available file types in {s3_path} (timestamp {latest_timestamp}):")
-    for file_type, timestamp in file_types.items():
+    for file_type, timestamp in available_types.items():
         logging.info(f"  - {file_type}: {timestamp}")
 
-    return file_types, latest_timestamp
+    return available_types, latest_timestamp
 
 
 def main():
 
     ensure_directory_exists(local_full_path)
+    manifest = load_refreshed_manifest([s3_daily_path, s3_incremental_path])
 
     # Log available file types for full dataset
-    full_types, full_timestamp = get_available_file_types(s3_daily_path)
+    full_types, full_timestamp = get_available_file_types(s3_daily_path, manifest)
     logging.info(f"Available file types in full dataset (timestamp {full_timestamp}):")
     for file_type in sorted(full_types.keys()):
         logging.info(f"  - {file_type}")
 
 
     for file_type in file_types:
-        download_most_recent_file(s3_daily_path, local_full_path, file_type)
-    ensure_directory_exists(local_incremental_path)
-    for file_type in file_types:
-        latest_timestamp = get_latest_full_timestamp(local_full_path, file_type)
-        if latest_timestamp:
-            delete_outdated_incremental_files(local_incremental_path, file_type, latest_timestamp)
-            download_incremental_files(s3_incremental_path.split('/')[2], local_incremental_path, file_type,
-                                       latest_timestamp)
+        download_most_recent_file(s3_daily_path, local_full_path, file_type, manifest)
+    sync_incremental_files(manifest=manifest)
+    save_manifest(manifest)
 
 
 if __name__ == "__main__":
+    metrics.start('download_or_update_files')
     main()
     logging.info("finished ;)")
\ No newline at end of file
@@ -17,6 +17,13 @@ module.exports = {
     script: './scripts/insert_update_sql.sh',
     exec_mode: 'fork',
     autorestart: false
+  },{
+    name: 'sync_daemon',
+    script: './sync_daemon.py',
+    interpreter: 'python3',
+    exec_mode: 'fork',
+    autorestart: true,
+    kill_timeout: 120000
   },{
     name: 'update_full_files',
     script: './scripts/update_full_files.sh',
@@ -3,6 +3,7 @@ import pyarrow.parquet as pq
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.dialects.postgresql import insert
+from pipeline import iter_pipeline
 from models import Base, Fids, Storage, Links, Casts, UserData, Reactions, Fnames, Signers, Verifications, FileTracking
 import logging
 from dotenv import load_dotenv
@@ -69,7 +70,7 @@ def process_file(file_path):
         return
 
     with pq.ParquetFile(file_path) as pf:
-        iterator = pf.iter_batches(batch_size=4000000)  # Adjust batch size based on your memory constraints
+        iterator = (batch for _, _, batch in iter_pipeline(pf))  # Bounded by LOAD_MEMORY_BUDGET
         session = Session()
         try:
             for batch in iterator:
@@ -3,6 +3,7 @@ import pyarrow.parquet as pq
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.dialects.postgresql import insert
+from pipeline import iter_pipeline
 from models import Base, Reactions, Fids, Storage, Casts, UserData, Fnames, Signers, Verifications, FileTracking, Links
 import logging
 from dotenv import load_dotenv
@@ -66,7 +67,7 @@ def process_file(file_path):
             primary_key = [key.name for key in orm_class.__table__.primary_key.columns][0]
 
             with pq.ParquetFile(file_path) as pf:
-                iterator = pf.iter_batches(batch_size=4000000)  # Adjust batch size based on your memory constraints
+                iterator = (batch for _, _, batch in iter_pipeline(pf))  # Bounded by LOAD_MEMORY_BUDGET
                 session = Session()
                 total_rows = 0
                 for batch in iterator:
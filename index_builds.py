@@ -0,0 +1,167 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Tables rebuilt at once, and the per-session settings used for each index build
+INDEX_BUILD_WORKERS = int(os.getenv('INDEX_BUILD_WORKERS', 4))
+INDEX_MAINTENANCE_WORK_MEM = os.getenv('INDEX_MAINTENANCE_WORK_MEM', '1GB')
+INDEX_PARALLEL_WORKERS = int(os.getenv('INDEX_PARALLEL_WORKERS', 4))
+INDEX_PROGRESS_INTERVAL = 30
+# Table a CREATE INDEX statement of sql/setup.sql builds its index on
+INDEX_TABLE_PATTERN = re.compile(r'^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?\S+\s+ON\s+(?:ONLY\s+)?"?(\w+)"?',
+                                 re.IGNORECASE | re.MULTILINE)
+
+logger = logging.getLogger(__name__)
+
+
+def defer_indexes(engine, table_names):
+    """Record and drop the secondary indexes of table_names so a bulk load does not have to maintain them.
+
+    Indexes backing primary key and unique constraints are kept, since the load relies on them for
+    ON CONFLICT. Definitions go to deferred_indexes in the same transaction as the drops, so a crash
+    never loses an index definition.
+    """
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            deferred = 0
+            for table_name in table_names:
+                cursor.execute(
+                    "SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i "
+                    "JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE i.indrelid = %s::regclass "
+                    "AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.indexrelid)",
+                    (table_name,)
+                )
+                for index_name, index_definition in cursor.fetchall():
+                    cursor.execute(
+                        "INSERT INTO deferred_indexes (index_name, table_name, index_definition) "
+                        "VALUES (%s, %s, %s) ON CONFLICT (index_name) DO NOTHING",
+                        (index_name, table_name, index_definition)
+                    )
+                    cursor.execute(f'DROP INDEX IF EXISTS "{index_name}"')
+                    deferred += 1
+        conn.commit()
+        logger.info(f"Deferred {deferred} indexes on {', '.join(table_names) or 'no tables'}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def skip_deferred_indexes(cursor, statements):
+    """statements without the CREATE INDEX statements on tables whose indexes are waiting in deferred_indexes.
+
+    setup.sql creates its indexes IF NOT EXISTS, so running it while a seed loads, e.g. from the
+    insert_update_sql cron, would build the dropped indexes again halfway through the load. deferred_indexes
+    stays locked until the caller's transaction ends, so no indexes can be deferred between this check and
+    the statements that follow it.
+    """
+    cursor.execute("SELECT to_regclass('deferred_indexes') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return statements
+    cursor.execute("LOCK TABLE deferred_indexes IN SHARE MODE")
+    cursor.execute("SELECT DISTINCT table_name FROM deferred_indexes")
+    deferred_tables = {row[0] for row in cursor.fetchall()}
+    if not deferred_tables:
+        return statements
+    kept = []
+    for statement in statements:
+        match = INDEX_TABLE_PATTERN.search(statement)
+        if match and match.group(1) in deferred_tables:
+            continue
+        kept.append(statement)
+    logger.info(f"Left {len(statements) - len(kept)} index statements on {', '.join(sorted(deferred_tables))} "
+                f"to the deferred index rebuild")
+    return kept
+
+
+def _report_progress(engine, stop):
+    """Log pg_stat_progress_create_index for running builds until stop is set."""
+    while not stop.wait(INDEX_PROGRESS_INTERVAL):
+        try:
+            conn = engine.raw_connection()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT relid::regclass, index_relid::regclass, phase, blocks_done, blocks_total, "
+                        "tuples_done, tuples_total FROM pg_stat_progress_create_index"
+                    )
+                    for table, index, phase, blocks_done, blocks_total, tuples_done, tuples_total in cursor.fetchall():
+                        logger.info(f"Index build on {table} ({index}): {phase}, blocks {blocks_done}/{blocks_total}, "
+                                    f"tuples {tuples_done}/{tuples_total}")
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning(f"Could not read index build progress: {e}")
+
+
+def _rebuild_table_indexes(engine, table_name, indexes):
+    conn = engine.raw_connection()
+    built = []
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SET maintenance_work_mem = '{INDEX_MAINTENANCE_WORK_MEM}'")
+            cursor.execute(f"SET max_parallel_maintenance_workers = {INDEX_PARALLEL_WORKERS}")
+            conn.commit()
+            for i, (index_name, index_definition) in enumerate(indexes, 1):
+                start_time = time.time()
+                # IF NOT EXISTS makes a rebuild after a crash (or after setup.sql recreated the index) a no-op.
+                # Definitions of partitioned indexes read ON ONLY, which would leave the partitions unindexed.
+                cursor.execute(index_definition.replace('CREATE INDEX ', 'CREATE INDEX IF NOT EXISTS ', 1)
+                               .replace('CREATE UNIQUE INDEX ', 'CREATE UNIQUE INDEX IF NOT EXISTS ', 1)
+                               .replace(' ON ONLY ', ' ON ', 1))
+                cursor.execute("DELETE FROM deferred_indexes WHERE index_name = %s", (index_name,))
+                conn.commit()
+                build_time = time.time() - start_time
+                built.append((index_name, build_time))
+                logger.info(f"Built index {index_name} on {table_name} ({i}/{len(indexes)}) in {build_time:.2f} seconds")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return built
+
+
+def rebuild_deferred_indexes(engine):
+    """Recreate every index recorded in deferred_indexes, one worker per table, and forget each once built."""
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT table_name, index_name, index_definition FROM deferred_indexes ORDER BY deferred_at")
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return
+
+    indexes_by_table = defaultdict(list)
+    for table_name, index_name, index_definition in rows:
+        indexes_by_table[table_name].append((index_name, index_definition))
+
+    logger.info(f"Rebuilding {len(rows)} deferred indexes on {len(indexes_by_table)} tables")
+    start_time = time.time()
+    stop = threading.Event()
+    monitor = threading.Thread(target=_report_progress, args=(engine, stop), daemon=True)
+    monitor.start()
+    try:
+        with ThreadPoolExecutor(max_workers=INDEX_BUILD_WORKERS) as executor:
+            futures = {executor.submit(_rebuild_table_indexes, engine, table_name, indexes): table_name
+                       for table_name, indexes in indexes_by_table.items()}
+            for future in as_completed(futures):
+                try:
+                    built = future.result()
+                    logger.info(f"Rebuilt {len(built)} indexes on {futures[future]} in "
+                                f"{sum(build_time for _, build_time in built):.2f} seconds")
+                except Exception as e:
+                    logger.error(f"Failed to rebuild indexes on {futures[future]}: {e}")
+    finally:
+        stop.set()
+        monitor.join()
+    logger.info(f"Deferred index rebuild finished in {time.time() - start_time:.2f} seconds")
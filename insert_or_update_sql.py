@@ -1,20 +1,34 @@
 import logging
 import os
 import sys
-import threading
+import time
 from collections import defaultdict
+from contextlib import ExitStack
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
-import json
 
-import pyarrow.parquet as pq
 from dotenv import load_dotenv
 from filelock import FileLock, Timeout
-from sqlalchemy import create_engine, text, ARRAY
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 
-from models import Fids, Storage, Links, Casts, UserData, Reactions, Fnames, Signers, Verifications, FileTracking, \
+from models import Fids, Storage, Links, Casts, UserData, Reactions, Fnames, Signers, Verifications, \
     WarpcastPowerUsers, ProfileWithAddresses
+import metrics
+import work_queue
+from cast_counters import CAST_COUNTERS, COUNTED_TABLES, rebuild_cast_counters
+from cast_threads import CAST_THREADS, rebuild_cast_threads
+from checkpoints import clear_checkpoint, get_checkpoint, has_checkpoint, load_in_chunks
+from compaction import COMPACT_MAX_FILES, read_run
+from index_builds import skip_deferred_indexes
+from partitions import PARTITIONED_SCHEMA, ensure_file_partitions
+from parquet_source import STREAM_FROM_S3, open_parquet_file
+from pipeline import READ_BATCH_ROWS, iter_pipeline, peak_rss_bytes
+from pg_copy import get_column_types, copy_batches
+from schema_swap import share_swap_lock
+from staging import create_staging_table, get_primary_key_columns, get_unique_constraints, insert_from_staging_sql, \
+    merge_from_staging
+from transforms import project_columns, transform_batch
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 load_dotenv()
@@ -32,7 +46,26 @@ CONNECTION_STRING = f"postgresql://{env_vars['DB_USER']}:{env_vars['DB_PASS']}@{
 ENGINE = create_engine(CONNECTION_STRING)
 Session = sessionmaker(bind=ENGINE)
 
-skip_tables = {'links'}
+skip_tables = set()
+
+ORM_CLASSES = {
+    'fids': Fids,
+    'storage': Storage,
+    'links': Links,
+    'casts': Casts,
+    'user_data': UserData,
+    'reactions': Reactions,
+    'fnames': Fnames,
+    'signers': Signers,
+    'verifications': Verifications,
+    'warpcast_power_users': WarpcastPowerUsers,
+    'profile_with_addresses': ProfileWithAddresses
+}
+
+# Tables applied in parallel by the incremental applier, one worker process per table at a time
+APPLY_WORKERS = int(os.getenv('APPLY_WORKERS', min(os.cpu_count() or 1, 4)))
+# Seconds between checks of the work queue while files are in flight or the daemon is idle
+QUEUE_POLL_INTERVAL = 1
 
 
 # skip_tables = {}
@@ -45,7 +78,7 @@ def run_sql_script(filename):
     conn = ENGINE.raw_connection()
     cursor = conn.cursor()
     try:
-        for statement in statements:
+        for statement in skip_deferred_indexes(cursor, statements):
             if statement:
                 cursor.execute(statement)
         conn.commit()
@@ -58,19 +91,38 @@ def run_sql_script(filename):
         conn.close()
 
 
-def file_already_processed(file_name):
-    session = Session()
-    exists = session.query(FileTracking).filter(FileTracking.file_name == file_name).one_or_none() is not None
-    session.close()
-    return exists
+def load_processed_files(table_name, file_names):
+    """The subset of file_names already in file_tracking, read with one query per table.
+
+    Only tracking rows from the oldest pending file onwards are read, so the cost follows the number of
+    pending files rather than the whole history.
+    """
+    if not file_names:
+        return set()
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT file_name FROM file_tracking WHERE table_name = %s AND file_timestamp >= %s",
+                (table_name, min(extract_timestamp(file_name) for file_name in file_names))
+            )
+            return {row[0] for row in cursor.fetchall()} & set(file_names)
+    finally:
+        conn.close()
+
 
+def record_file_as_processed(cursor, file_name):
+    """Claim file_name in file_tracking inside the caller's transaction.
 
-def record_file_as_processed(file_name):
-    session = Session()
-    tracking_entry = FileTracking(file_name=file_name)
-    session.add(tracking_entry)
-    session.commit()
-    session.close()
+    Returns False if another run has already recorded it; the caller then rolls back instead of applying
+    the file twice.
+    """
+    cursor.execute(
+        "INSERT INTO file_tracking (file_name, table_name, file_timestamp) VALUES (%s, %s, %s) "
+        "ON CONFLICT DO NOTHING",
+        (file_name, file_name.split('-')[1], extract_timestamp(file_name))
+    )
+    return cursor.rowcount == 1
 
 
 def extract_timestamp(filename):
@@ -99,144 +151,364 @@ def table_is_empty(table_name):
         return not result.scalar()
 
 
-def process_category_files(files, path, incremental):
-    """Process files for a specific category in chronological order."""
-    for file in files:
-        file_path = os.path.join(path, file)
-        try:
-            process_file(file_path, incremental)
-        except Exception as e:
-            logging.error(f"Error processing file {file}: {e}")
+def init_worker():
+    """Give each applier process its own single-connection engine; it loads one file at a time."""
+    global ENGINE, Session
+    # Connections inherited from the parent belong to the parent, so drop them without closing them
+    ENGINE.dispose(close=False)
+    ENGINE = create_engine(CONNECTION_STRING, pool_size=1, max_overflow=0, pool_pre_ping=True)
+    Session = sessionmaker(bind=ENGINE)
+    # Samples inherited from the parent are the parent's to publish
+    metrics.reset()
+
+
+def use_schema(schema):
+    """Load into schema instead of public from now on, e.g. the snapshot refresh_snapshot.py is building."""
+    global ENGINE, Session
+    ENGINE.dispose()
+    ENGINE = create_engine(CONNECTION_STRING, connect_args={'options': f'-csearch_path={schema}'})
+    Session = sessionmaker(bind=ENGINE)
+
+
+def apply_files(file_paths):
+    """Apply a run of one table's incremental files in a worker process.
+
+    Returns (rows, the files applied), with rows None if another run holds a lock on it. A run of several files is
+    compacted into one apply, which may leave its newest files for the next run.
+    """
+    start_time = time.time()
+    if len(file_paths) == 1:
+        rows, applied = process_file(file_paths[0], incremental=True), file_paths
+    else:
+        rows, applied = process_compacted_files(file_paths)
+    if rows is not None:
+        metrics.set_gauge('rows_per_second', rows / max(time.time() - start_time, 1e-6),
+                          table=os.path.basename(file_paths[0]).split('-')[1])
+    return rows, applied
+
+
+def claim_runs(exclude_tables=()):
+    """Claim the next run of files of every table not in exclude_tables, and return [(run, table_name)].
+
+    Files that need no applying, because their table is skipped or has no model, they are already in
+    file_tracking or they were deleted after a newer full file superseded them, are completed straight away.
+    """
+    runs = []
+    # Claim again after a run is completed without applying it, since the next files of its table are now due
+    claim_again = True
+    while claim_again:
+        claim_again = False
+        for run in work_queue.claim_next(exclude_tables=set(exclude_tables) | {table for _, table in runs},
+                                         max_files=COMPACT_MAX_FILES):
+            table_name = os.path.basename(run[0]).split('-')[1]
+            not_applicable = table_name in skip_tables or table_name not in ORM_CLASSES
+            processed = set() if not_applicable else \
+                load_processed_files(table_name, [os.path.basename(file_path) for file_path in run])
+            finished = [file_path for file_path in run
+                        if not_applicable or os.path.basename(file_path) in processed
+                        or (not file_path.startswith('s3://') and not os.path.exists(file_path))]
+            for file_path in finished:
+                work_queue.complete(file_path)
+            run = [file_path for file_path in run if file_path not in finished]
+            if not run:
+                claim_again = True
+                continue
+            runs.append((run, table_name))
+    for table_name, files in work_queue.depth().items():
+        metrics.set_gauge('files_pending', files, table=table_name)
+    return runs
+
+
+def settle_run(run, table_name, rows=None, applied=(), error=None):
+    """Record in work_queue how applying a run went and return the rows it applied.
+
+    rows is None if another run held a lock on the run, and error the exception it raised if it failed.
+    """
+    if error is not None or rows is None:
+        if error is not None:
+            logging.error(f"Error processing file {os.path.basename(run[0])}"
+                          f"{f' and {len(run) - 1} files after it' if len(run) > 1 else ''}: {error}. "
+                          f"The rest of {table_name} waits for it to be retried")
+        # Retried on its own, so a bad file cannot hold back the files before it in a run. A run locked by
+        # another one, which may still fail, is checked again after a backoff too
+        work_queue.fail(run[0], error if error is not None else 'locked by another run')
+        work_queue.release(run[1:])
+        return 0
+    for file_path in applied:
+        work_queue.complete(file_path)
+    work_queue.release(run[len(applied):])
+    try:
+        record_freshness(work_queue.newest_timestamps())
+    except Exception as e:
+        logging.warning(f"Could not record freshness metrics: {e}")
+    return rows
+
+
+def apply_queued_files(executor, stop=None, wait_for_files=None):
+    """Apply the files in work_queue with executor's workers and return the rows applied per table.
+
+    Each table has at most one run of up to COMPACT_MAX_FILES consecutive files in flight and its files go
+    oldest first; a failed file is retried on its own after a backoff and holds back the rest of its table.
+    Without stop, returns once nothing is left to claim. With stop, keeps claiming newly queued files,
+    waiting on wait_for_files(timeout) when idle, until stop is set, and then lets the files in flight finish.
+    """
+    rows_by_table = defaultdict(int)
+    in_flight = {}
+    while True:
+        if stop is None or not stop.is_set():
+            for run, table_name in claim_runs(exclude_tables={table for _, table in in_flight.values()}):
+                in_flight[executor.submit(metrics.run_in_worker, apply_files, run)] = (run, table_name)
+        if not in_flight:
+            if stop is None or stop.is_set():
+                break
+            if wait_for_files is not None:
+                wait_for_files(QUEUE_POLL_INTERVAL)
+            else:
+                stop.wait(QUEUE_POLL_INTERVAL)
+            continue
+        for future in wait(in_flight, timeout=QUEUE_POLL_INTERVAL, return_when=FIRST_COMPLETED).done:
+            run, table_name = in_flight.pop(future)
+            try:
+                (rows, applied), samples = future.result()
+            except Exception as e:
+                settle_run(run, table_name, error=e)
+                continue
+            metrics.merge(samples)
+            rows_by_table[table_name] += settle_run(run, table_name, rows, applied)
+    return rows_by_table
+
+
+def record_freshness(newest_downloaded):
+    """Publish, per table, how far the newest applied file trails the newest downloaded one."""
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT table_name, max(file_timestamp) FROM file_tracking "
+                           "WHERE table_name IS NOT NULL GROUP BY table_name")
+            newest_applied = dict(cursor.fetchall())
+    finally:
+        conn.close()
+    for table_name, downloaded_timestamp in newest_downloaded.items():
+        metrics.set_gauge('newest_downloaded_timestamp_seconds', downloaded_timestamp, table=table_name)
+        applied_timestamp = newest_applied.get(table_name)
+        if applied_timestamp is not None:
+            metrics.set_gauge('newest_applied_timestamp_seconds', applied_timestamp, table=table_name)
+            metrics.set_gauge('freshness_lag_seconds', max(downloaded_timestamp - applied_timestamp, 0),
+                              table=table_name)
+
+
+def list_local_files(path):
+    """Published parquet files in path; partial downloads (.part) and their resume state are skipped."""
+    return [os.path.join(path, file) for file in os.listdir(path) if file.endswith('.parquet')]
 
 
 def process_file(file_path, incremental=False):
+    """Load a full file, or merge an incremental one, and return the rows applied.
+
+    Returns 0 for a file that needs no applying, and None if another run holds its lock.
+    """
     file_name = os.path.basename(file_path)
     table_name = file_name.split('-')[1].split('.')[0]
 
-    orm_class_dict = {
-        'fids': Fids,
-        'storage': Storage,
-        'links': Links,
-        'casts': Casts,
-        'user_data': UserData,
-        'reactions': Reactions,
-        'fnames': Fnames,
-        'signers': Signers,
-        'verifications': Verifications,
-        'warpcast_power_users': WarpcastPowerUsers,
-        'profile_with_addresses': ProfileWithAddresses
-    }
-
     if table_name in skip_tables:
         logging.info(f"Skipping file {file_name} associated with table {table_name}")
-        return
+        return 0
 
     lock_path = f'/tmp/{file_name}.lock'
     lock = FileLock(lock_path)
 
     try:
-        with lock.acquire(timeout=0), Session() as session:
-            if incremental and file_already_processed(file_name):
-                logging.info(f"Skipping already processed file {file_name}")
-                return
-
-            orm_class = orm_class_dict.get(table_name)
-            if not orm_class or (not incremental and not table_is_empty(table_name)):
+        with lock.acquire(timeout=0):
+            orm_class = ORM_CLASSES.get(table_name)
+            # A partially loaded full file resumes from its checkpoint even though the table is no longer empty
+            if not orm_class or (not incremental and not table_is_empty(table_name)
+                                 and not has_checkpoint(ENGINE, file_name)):
                 logging.info(f"No action taken for table '{table_name}' from file '{file_name}'")
-                return
+                return 0
 
             logging.info(f"Processing file {file_name} for table {table_name}")
 
-            with pq.ParquetFile(file_path) as pf:
-                iterator = pf.iter_batches(batch_size=2000000)
-                total_rows = 0
-                for batch in iterator:
-                    data = batch.to_pydict()
-                    table_columns = {column.name for column in orm_class.__table__.columns}
-                    filtered_data = []
-                    for i in range(len(batch)):
-                        row_data = {key: value[i] for key, value in data.items() if key in table_columns}
-
-                        # Convert mentions_positions to array of SmallInteger
-                        if 'mentions_positions' in row_data:
-                            if isinstance(row_data['mentions_positions'], str):
-                                row_data['mentions_positions'] = [int(x) for x in
-                                                                  row_data['mentions_positions'].strip('[]').split(',')
-                                                                  if x]
-                            elif isinstance(row_data['mentions_positions'], list):
-                                row_data['mentions_positions'] = [int(x) for x in row_data['mentions_positions']]
-
-                        # Convert embeds and mentions to proper JSON arrays
-                        for field in ['embeds', 'mentions']:
-                            if field in row_data and isinstance(row_data[field], str):
-                                try:
-                                    row_data[field] = json.loads(row_data[field])
-                                except json.JSONDecodeError:
-                                    row_data[field] = []
-
-                        filtered_data.append(row_data)
-
-                        if incremental:
-                            primary_key = [key.name for key in orm_class.__table__.primary_key.columns][0]
-                            insert_statement = insert(orm_class.__table__).on_conflict_do_update(
-                                index_elements=[primary_key],
-                                set_={key: value for key, value in row_data.items() if key != primary_key}
-                            )
-                        else:
-                            insert_statement = insert(orm_class.__table__).on_conflict_do_nothing()
-
-                        session.execute(insert_statement, [row_data])
-                        total_rows += 1
-
-                    logging.info(f"Processed {total_rows} rows so far for file {file_name}")
-
-                session.commit()
-                logging.info(f"File {file_name} processed: {total_rows} rows inserted/updated")
-
-                if incremental:
-                    record_file_as_processed(file_name)
+            conn = ENGINE.raw_connection()
+            try:
+                with conn.cursor() as cursor:
+                    column_types = get_column_types(cursor, table_name)
+                    # Partitioned tables key on (id, timestamp), so take the key from the database
+                    primary_key = get_primary_key_columns(cursor, table_name)
+                    unique_constraints = get_unique_constraints(cursor, table_name)
+                    checkpoint = get_checkpoint(cursor, file_name)
+
+                with open_parquet_file(file_path) as pf:
+                    with conn.cursor() as cursor:
+                        ensure_file_partitions(cursor, table_name, pf)
+                    conn.commit()
+                    if checkpoint:
+                        logging.info(f"Resuming file {file_name} at row group {checkpoint[0]}, batch {checkpoint[1]}")
+                    columns = project_columns(pf.schema_arrow.names, orm_class)
+                    column_type_names = [column_types[name] for name in columns]
+                    skipped_rows = 0
+
+                    def load_chunk(cursor, chunk):
+                        nonlocal skipped_rows
+                        share_swap_lock(cursor)
+                        stage_name = create_staging_table(cursor, table_name, sequenced=incremental)
+                        staged_rows = copy_batches(cursor, stage_name, columns, column_type_names, chunk)
+                        if not incremental:
+                            cursor.execute(insert_from_staging_sql(table_name, stage_name, columns))
+                            logging.info(f"Staged {staged_rows} rows for file {file_name}, applied {cursor.rowcount}")
+                            return cursor.rowcount
+                        inserted, updated, skipped = merge_from_staging(cursor, table_name, stage_name, columns,
+                                                                        primary_key, unique_constraints)
+                        skipped_rows += skipped
+                        metrics.inc('rows_skipped_total', skipped, table=table_name)
+                        logging.info(f"Staged {staged_rows} rows for file {file_name}: {inserted} inserted, "
+                                     f"{updated} updated, {skipped} unchanged skipped")
+                        return inserted + updated
+
+                    # Recorded with the last chunk, so a file is only tracked once all of it is in
+                    finish = (lambda cursor: record_file_as_processed(cursor, file_name)) if incremental else None
+                    batches = iter_pipeline(pf, columns=columns, start=checkpoint,
+                                            transform=lambda batch: transform_batch(batch, orm_class, column_types))
+                    total_rows = load_in_chunks(conn, file_name, table_name, batches, load_chunk, finish)
+                if total_rows is None:
+                    logging.info(f"Skipping already processed file {file_name}")
+                    return 0
+            finally:
+                conn.close()
+
+            logging.info(f"File {file_name} processed: {total_rows} rows inserted/updated"
+                         f"{f', {skipped_rows} unchanged rows skipped' if incremental else ''}")
+            return total_rows
     except Timeout:
         logging.info(f"Skipping locked file {file_name}")
+        return None
+
+
+def process_compacted_files(file_paths):
+    """Apply consecutive incremental files of one table as a single deduplicated merge.
+
+    Files are read oldest first while the run stays within COMPACT_MAX_ROWS rows. Each primary key keeps its
+    row with the latest updated_at, so rows updated in several files are written once, and every file read is
+    recorded in file_tracking in the merge's transaction. Returns (rows applied, the files applied), or
+    (None, []) if a file is locked or already recorded by another run.
+    """
+    file_names = [os.path.basename(file_path) for file_path in file_paths]
+    table_name = file_names[0].split('-')[1]
+    orm_class = ORM_CLASSES[table_name]
+
+    with ExitStack() as locks:
+        try:
+            for file_name in file_names:
+                locks.enter_context(FileLock(f'/tmp/{file_name}.lock').acquire(timeout=0))
+        except Timeout:
+            logging.info(f"Skipping run of {len(file_names)} {table_name} files, one of them is locked")
+            return None, []
+
+        conn = ENGINE.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                column_types = get_column_types(cursor, table_name)
+                primary_key = get_primary_key_columns(cursor, table_name)
+                unique_constraints = get_unique_constraints(cursor, table_name)
+
+            def prepare_partitions(pf):
+                with conn.cursor() as cursor:
+                    ensure_file_partitions(cursor, table_name, pf)
+                conn.commit()
+
+            compacted, files_read, rows_read = read_run(file_paths, orm_class, primary_key, on_open=prepare_partitions)
+            applied_names = file_names[:files_read]
+            logging.info(f"Compacted {len(applied_names)} files of {table_name} from {applied_names[0]}: "
+                         f"{rows_read} rows, {compacted.num_rows} after keeping the latest row per key")
+
+            columns = compacted.column_names
+            column_type_names = [column_types[name] for name in columns]
+            skipped_rows = 0
+
+            def load_chunk(cursor, chunk):
+                nonlocal skipped_rows
+                share_swap_lock(cursor)
+                stage_name = create_staging_table(cursor, table_name, sequenced=True)
+                staged_rows = copy_batches(cursor, stage_name, columns, column_type_names, chunk)
+                inserted, updated, skipped = merge_from_staging(cursor, table_name, stage_name, columns, primary_key,
+                                                                unique_constraints)
+                skipped_rows += skipped
+                metrics.inc('rows_skipped_total', skipped, table=table_name)
+                logging.info(f"Staged {staged_rows} rows for {len(applied_names)} {table_name} files: "
+                             f"{inserted} inserted, {updated} updated, {skipped} unchanged skipped")
+                return inserted + updated
+
+            def finish(cursor):
+                for file_name in applied_names:
+                    # A file left partly applied by an earlier run is complete now
+                    clear_checkpoint(cursor, file_name)
+                    if not record_file_as_processed(cursor, file_name):
+                        return False
+
+            batches = ((0, batch_index, transform_batch(batch, orm_class, column_types))
+                       for batch_index, batch in enumerate(compacted.to_batches(max_chunksize=READ_BATCH_ROWS)))
+            # One chunk, so the run commits together with all of its files
+            total_rows = load_in_chunks(conn, applied_names[-1], table_name, batches, load_chunk, finish,
+                                        checkpoint_rows=compacted.num_rows + 1)
+        finally:
+            conn.close()
+
+    if total_rows is None:
+        logging.info(f"Skipping run of {table_name} files from {applied_names[0]}, one of them is already processed")
+        return None, []
+    logging.info(f"{len(applied_names)} {table_name} files processed: {total_rows} rows inserted/updated, "
+                 f"{skipped_rows} unchanged rows skipped")
+    return total_rows, file_paths[:len(applied_names)]
 
 
 def main():
+    if PARTITIONED_SCHEMA:
+        run_sql_script('./sql/partitioned_setup.sql')
     run_sql_script('./sql/setup.sql')
 
-    full_path = './downloads/full'
-    incremental_path = './downloads/incremental'
+    if STREAM_FROM_S3:
+        # Imported here so the S3 client is only created when streaming
+        from download_or_update_files import get_stream_files
+        full_files, incremental_files = get_stream_files()
+    else:
+        full_files = list_local_files('./downloads/full')
+        incremental_files = list_local_files('./downloads/incremental')
+
+    rows_by_table = defaultdict(int)
 
     # Process full files first, sequentially, sorted by timestamp
-    full_files = sorted(os.listdir(full_path), key=lambda f: extract_timestamp(f))
-    for file in full_files:
-        file_path = os.path.join(full_path, file)
+    full_files = sorted(full_files, key=lambda f: extract_timestamp(os.path.basename(f)))
+    for file_path in full_files:
         try:
-            process_file(file_path, incremental=False)
+            rows_by_table[os.path.basename(file_path).split('-')[1]] += process_file(file_path, incremental=False) or 0
         except Exception as e:
             logging.error(e)
+    # Full files are loaded without counting or placing casts, before incremental merges build on top of them
+    if CAST_COUNTERS and any(rows_by_table.get(table_name) for table_name in COUNTED_TABLES):
+        rebuild_cast_counters(ENGINE)
+    if CAST_THREADS and rows_by_table.get('casts'):
+        rebuild_cast_threads(ENGINE)
 
-    # Categorize incremental files by type and sort them by timestamp within each category
-    categorized_files = defaultdict(list)
-    for file in os.listdir(incremental_path):
-        try:
-            category = file.split('-')[1]  # Assuming category is defined in the filename
-            categorized_files[category].append(file)
-        except IndexError:
-            logging.error(f"Filename format error: {file}")
-            continue
+    # Files the downloader queued already are left as they are; this picks up any it did not
+    work_queue.enqueue(incremental_files)
+    with ProcessPoolExecutor(max_workers=APPLY_WORKERS, initializer=init_worker) as executor:
+        for table_name, rows in apply_queued_files(executor).items():
+            rows_by_table[table_name] += rows
 
-    for category in categorized_files:
-        categorized_files[category] = sorted(categorized_files[category], key=lambda f: extract_timestamp(f))
+    return rows_by_table
 
-    threads = []
-    for category, files in categorized_files.items():
-        thread = threading.Thread(target=process_category_files, args=(files, incremental_path, True))
-        threads.append(thread)
-        thread.start()
 
-    for thread in threads:
-        thread.join()
+def log_summary(rows_by_table, wall_time):
+    for table_name, rows in sorted(rows_by_table.items()):
+        logging.info(f"{table_name}: {rows} rows inserted/updated")
+    total_rows = sum(rows_by_table.values())
+    logging.info(f"Applied {total_rows} rows across {len(rows_by_table)} tables in {wall_time:.2f} seconds "
+                 f"({total_rows / max(wall_time, 1e-6):.2f} rows/second)")
+    main_rss, worker_rss = peak_rss_bytes()
+    logging.info(f"Peak RSS: {main_rss / 1024 / 1024:.0f} MiB main process, {worker_rss / 1024 / 1024:.0f} MiB largest worker")
 
 
 if __name__ == "__main__":
-    main()
-    logging.info("Script finished")
+    metrics.start('insert_or_update_sql')
+    start_time = time.time()
+    rows_by_table = main()
+    log_summary(rows_by_table, time.time() - start_time)
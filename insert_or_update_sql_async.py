@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+import asyncpg
+
+import metrics
+import work_queue
+from cast_threads import thread_updates_sql
+from compaction import read_run
+from insert_or_update_sql import CONNECTION_STRING, ENGINE, ORM_CLASSES, PARTITIONED_SCHEMA, claim_runs, \
+    extract_timestamp, list_local_files, log_summary, run_sql_script, settle_run
+from partitions import ensure_file_partitions
+from parquet_source import STREAM_FROM_S3, open_parquet_file
+from pg_copy import PGCOPY_HEADER, PGCOPY_TRAILER, encode_batch, get_column_types
+from pipeline import READ_BATCH_ROWS, iter_pipeline
+from schema_swap import SHARE_SWAP_LOCK_SQL
+from staging import get_primary_key_columns, get_unique_constraints, merge_from_staging_sql, staging_table_name, \
+    staging_table_sql, unique_conflicts_sql
+from transforms import project_columns, transform_batch
+
+# Connections shared by every table the async loader writes to
+ASYNC_POOL_SIZE = int(os.getenv('ASYNC_POOL_SIZE', 4))
+
+# Claims every file of a run in file_tracking and clears their checkpoints in one round trip
+TRACK_FILES_SQL = (
+    "WITH claimed AS (INSERT INTO file_tracking (file_name, table_name, file_timestamp) "
+    "SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::bigint[]) ON CONFLICT DO NOTHING RETURNING 1), "
+    "cleared AS (DELETE FROM file_checkpoints WHERE file_name = ANY($1::varchar[])) "
+    "SELECT count(*) FROM claimed"
+)
+
+
+class AlreadyProcessed(Exception):
+    """Raised inside a run's transaction to roll it back when another run recorded one of its files first."""
+
+
+_table_metadata = {}
+
+
+def load_table_metadata(table_name):
+    """(column types, primary key columns, other unique constraints) of table_name, read once per table."""
+    if table_name not in _table_metadata:
+        conn = ENGINE.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                _table_metadata[table_name] = (get_column_types(cursor, table_name),
+                                               get_primary_key_columns(cursor, table_name),
+                                               get_unique_constraints(cursor, table_name))
+        finally:
+            conn.close()
+    return _table_metadata[table_name]
+
+
+def prepare_partitions(table_name, pf):
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            ensure_file_partitions(cursor, table_name, pf)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def open_run(stack, run, table_name):
+    """Open a run for reading and return (files read, columns, iterator of transformed batches).
+
+    A single file is streamed through the reader and transform threads; a longer run is compacted first.
+    Whatever has to be closed afterwards is registered on stack.
+    """
+    orm_class = ORM_CLASSES[table_name]
+    column_types, primary_key, _ = load_table_metadata(table_name)
+
+    def transform(batch):
+        return transform_batch(batch, orm_class, column_types)
+
+    if len(run) == 1:
+        pf = stack.enter_context(open_parquet_file(run[0]))
+        prepare_partitions(table_name, pf)
+        columns = project_columns(pf.schema_arrow.names, orm_class)
+        positioned_batches = iter_pipeline(pf, columns=columns, transform=transform)
+        stack.callback(positioned_batches.close)
+        return 1, columns, (batch for _, _, batch in positioned_batches)
+    compacted, files_read, rows_read = read_run(run, orm_class, primary_key,
+                                                on_open=lambda pf: prepare_partitions(table_name, pf))
+    logging.info(f"Compacted {files_read} files of {table_name} from {os.path.basename(run[0])}: "
+                 f"{rows_read} rows, {compacted.num_rows} after keeping the latest row per key")
+    return files_read, compacted.column_names, map(transform, compacted.to_batches(max_chunksize=READ_BATCH_ROWS))
+
+
+def next_encoded(batches, column_type_names, stats):
+    batch = next(batches, None)
+    if batch is None:
+        return None
+    stats['rows'] += batch.num_rows
+    return encode_batch(batch, column_type_names)
+
+
+async def copy_source(batches, column_type_names, stats):
+    """Binary COPY data for batches, decoding and encoding the next batch in a thread while this one is sent."""
+    yield PGCOPY_HEADER
+    while True:
+        data = await asyncio.to_thread(next_encoded, batches, column_type_names, stats)
+        if data is None:
+            break
+        yield data
+    yield PGCOPY_TRAILER
+
+
+async def apply_run(pool, run, table_name):
+    """Apply a run of one table's incremental files in one transaction on a pooled connection.
+
+    Returns (rows, the files applied), or (None, []) if another run recorded one of the files first.
+    """
+    start_time = time.time()
+    column_types, primary_key, unique_constraints = await asyncio.to_thread(load_table_metadata, table_name)
+    with ExitStack() as stack:
+        files_read, columns, batches = await asyncio.to_thread(open_run, stack, run, table_name)
+        file_names = [os.path.basename(file_path) for file_path in run[:files_read]]
+        column_type_names = [column_types[name] for name in columns]
+        stage_name = staging_table_name(table_name)
+        stats = {'rows': 0}
+        try:
+            async with pool.acquire() as conn:
+                load_start = time.time()
+                async with conn.transaction():
+                    # Sent as one message, so holding off a snapshot swap and creating the staging table
+                    # cost a single round trip
+                    await conn.execute('; '.join([SHARE_SWAP_LOCK_SQL, *staging_table_sql(table_name, sequenced=True)]))
+                    await conn.copy_to_table(stage_name, source=copy_source(batches, column_type_names, stats),
+                                             columns=columns, format='binary')
+                    dropped = 0
+                    for statement, kind in unique_conflicts_sql(table_name, stage_name, columns, primary_key,
+                                                                unique_constraints):
+                        status = await conn.execute(statement)
+                        if kind == 'dropped':
+                            dropped += int(status.split()[-1])
+                    merged, inserted, updated = await conn.fetchrow(
+                        merge_from_staging_sql(table_name, stage_name, columns, primary_key))
+                    for statement in thread_updates_sql(table_name, stage_name):
+                        await conn.execute(statement)
+                    claimed = await conn.fetchval(TRACK_FILES_SQL, file_names, [table_name] * len(file_names),
+                                                  [extract_timestamp(file_name) for file_name in file_names])
+                    if claimed != len(file_names):
+                        raise AlreadyProcessed()
+        except AlreadyProcessed:
+            logging.info(f"Skipping {table_name} files from {file_names[0]}, one of them is already processed")
+            return None, []
+
+    rows = inserted + updated
+    skipped = merged - rows + dropped
+    metrics.inc('rows_applied_total', rows, table=table_name)
+    metrics.inc('rows_skipped_total', skipped, table=table_name)
+    metrics.observe('batch_duration_seconds', time.time() - load_start, table=table_name)
+    metrics.set_gauge('rows_per_second', rows / max(time.time() - start_time, 1e-6), table=table_name)
+    logging.info(f"{len(file_names)} {table_name} files from {file_names[0]} processed: staged {stats['rows']} rows, "
+                 f"{inserted} inserted, {updated} updated, {skipped} unchanged skipped")
+    return rows, run[:files_read]
+
+
+async def apply_queued_files_async():
+    """Apply the files in work_queue over a pool of ASYNC_POOL_SIZE connections and return rows per table.
+
+    Like apply_queued_files, each table has at most one run in flight and is applied oldest file first, while
+    runs of different tables share the pool. Returns once nothing is left to claim.
+    """
+    rows_by_table = defaultdict(int)
+    in_flight = {}
+    async with asyncpg.create_pool(CONNECTION_STRING, min_size=ASYNC_POOL_SIZE, max_size=ASYNC_POOL_SIZE) as pool:
+        while True:
+            runs = await asyncio.to_thread(claim_runs, {table for _, table in in_flight.values()})
+            for run, table_name in runs:
+                in_flight[asyncio.create_task(apply_run(pool, run, table_name))] = (run, table_name)
+            if not in_flight:
+                break
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                run, table_name = in_flight.pop(task)
+                try:
+                    rows, applied = task.result()
+                except Exception as e:
+                    await asyncio.to_thread(settle_run, run, table_name, error=e)
+                    continue
+                rows_by_table[table_name] += await asyncio.to_thread(settle_run, run, table_name, rows, applied)
+    return rows_by_table
+
+
+def main():
+    if PARTITIONED_SCHEMA:
+        run_sql_script('./sql/partitioned_setup.sql')
+    run_sql_script('./sql/setup.sql')
+
+    if STREAM_FROM_S3:
+        # Imported here so the S3 client is only created when streaming
+        from download_or_update_files import get_stream_files
+        _, incremental_files = get_stream_files()
+    else:
+        incremental_files = list_local_files('./downloads/incremental')
+
+    # Full files are loaded by insert_or_update_sql.py or the seed
+    work_queue.enqueue(incremental_files)
+    return asyncio.run(apply_queued_files_async())
+
+
+if __name__ == "__main__":
+    metrics.start('insert_or_update_sql_async')
+    start_time = time.time()
+    rows_by_table = main()
+    log_summary(rows_by_table, time.time() - start_time)
@@ -1,12 +1,12 @@
 import logging
 import os
 import sys
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import time
 import gc
 import psutil
 
-import pyarrow.parquet as pq
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
 from sqlalchemy.dialects.postgresql import insert
@@ -15,6 +15,18 @@ from sqlalchemy.pool import QueuePool
 from sqlalchemy.exc import OperationalError, SQLAlchemyError
 
 from models import Fids, Storage, Links, Casts, UserData, Reactions, Fnames, Signers, Verifications, WarpcastPowerUsers, ProfileWithAddresses
+import metrics
+from cast_counters import CAST_COUNTERS, COUNTED_TABLES, rebuild_cast_counters
+from cast_threads import CAST_THREADS, rebuild_cast_threads
+from checkpoints import get_checkpoint, has_checkpoint, load_in_chunks, save_checkpoint, clear_checkpoint
+from index_builds import defer_indexes, rebuild_deferred_indexes, skip_deferred_indexes
+from partitions import PARTITIONED_SCHEMA, PARTITION_COLUMN, ensure_file_partitions, ensure_partitions, \
+    is_partitioned, load_partitions, partition_name
+from parquet_source import STREAM_FROM_S3, open_parquet_file
+from pipeline import LOAD_MEMORY_BUDGET, iter_pipeline, peak_rss_bytes
+from pg_copy import get_column_types, copy_batches
+from staging import create_staging_table, insert_from_staging_sql
+from transforms import project_columns, transform_batch
 
 # Load environment variables from .env file
 load_dotenv()
@@ -48,6 +60,28 @@ skip_tables = {}
 
 # Increased batch size to better utilize resources
 BATCH_SIZE = 200000  # Adjusted from 100k to 500k
+# Rows sent to the insert workers become Python dicts, roughly this many times their Arrow size
+PYTHON_ROW_EXPANSION = 8
+
+# 'insert' uses batched INSERT ... ON CONFLICT DO NOTHING, 'copy' streams each file through binary COPY
+SEED_LOAD_MODE = os.getenv('SEED_LOAD_MODE', 'insert')
+# Drop secondary indexes on empty tables before loading them and rebuild them once all files are in
+SEED_DEFER_INDEXES = os.getenv('SEED_DEFER_INDEXES', '1') == '1'
+
+def use_schema(schema):
+    """Seed schema instead of public from now on, e.g. the snapshot refresh_snapshot.py is building."""
+    global ENGINE, Session
+    ENGINE.dispose()
+    ENGINE = create_engine(
+        CONNECTION_STRING,
+        poolclass=QueuePool,
+        pool_size=400,
+        max_overflow=100,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        connect_args={'options': f'-csearch_path={schema}'}
+    )
+    Session = sessionmaker(bind=ENGINE)
 
 def run_sql_script(filename):
     with open(filename, 'r') as file:
@@ -56,7 +90,7 @@ def run_sql_script(filename):
     conn = ENGINE.raw_connection()
     cursor = conn.cursor()
     try:
-        for statement in statements:
+        for statement in skip_deferred_indexes(cursor, statements):
             if statement:
                 cursor.execute(statement)
         conn.commit()
@@ -74,6 +108,28 @@ def table_is_empty(table_name):
         result = conn.execute(query)
         return not result.scalar()
 
+def table_is_partitioned(table_name):
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            return is_partitioned(cursor, table_name)
+    finally:
+        conn.close()
+
+def prepare_partitions(table_name, pf):
+    """Create the partitions a file needs before loading it; returns its months, or None if table_name is not partitioned."""
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            months = ensure_file_partitions(cursor, table_name, pf)
+        conn.commit()
+        return months
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
 def process_batch(orm_class, batch_data, retries=3):
     start_time = time.time()
     attempt = 0
@@ -90,12 +146,13 @@ def process_batch(orm_class, batch_data, retries=3):
         except (OperationalError, SQLAlchemyError) as e:
             attempt += 1
             logger.warning(f"Error on attempt {attempt}/{retries}: {e}")
-            if attempt < retries:
-                time.sleep(2 ** attempt)  # Exponential backoff
+            if attempt >= retries:
+                logger.error(f"Failed to process batch of {len(batch_data)} rows after {retries} attempts")
+                # The chunk must fail, or its row group would be checkpointed as loaded
+                raise
+            time.sleep(2 ** attempt)  # Exponential backoff
         finally:
             session.close()
-    logger.error(f"Failed to process batch of {len(batch_data)} rows after {retries} attempts")
-    return 0, 0
 
 def process_chunk(orm_class, chunk, batch_size):
     total_rows = 0
@@ -119,9 +176,136 @@ def process_chunk(orm_class, chunk, batch_size):
 
     return total_rows, total_time
 
+def copy_file(orm_class, file_path):
+    """Stream a full parquet file into a staging table with binary COPY, then move it into the real table.
+
+    Every CHECKPOINT_ROWS rows are committed with a checkpoint, and a rerun resumes after the last one.
+    """
+    table_name = orm_class.__tablename__
+    file_name = os.path.basename(file_path)
+    start_time = time.time()
+    stats = {'copied': 0}
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            column_types = get_column_types(cursor, table_name)
+            checkpoint = get_checkpoint(cursor, file_name)
+        if checkpoint:
+            logger.info(f"Resuming {file_name} at row group {checkpoint[0]}, batch {checkpoint[1]}")
+        with open_parquet_file(file_path) as pf:
+            columns = project_columns(pf.schema_arrow.names, orm_class)
+
+            def load_chunk(cursor, chunk):
+                stage_name = create_staging_table(cursor, table_name)
+                copied_rows = copy_batches(cursor, stage_name, columns, [column_types[name] for name in columns], chunk)
+                cursor.execute(insert_from_staging_sql(table_name, stage_name, columns))
+                stats['copied'] += copied_rows
+                logger.info(f"Copied {stats['copied']} rows into {table_name} in {time.time() - start_time:.2f} seconds")
+                return cursor.rowcount
+
+            batches = iter_pipeline(pf, columns=columns, start=checkpoint,
+                                    transform=lambda batch: transform_batch(batch, orm_class, column_types))
+            inserted_rows = load_in_chunks(conn, file_name, table_name, batches, load_chunk)
+    finally:
+        conn.close()
+
+    copied_rows = stats['copied']
+    total_time = time.time() - start_time
+    logger.info(f"Table {table_name}: {inserted_rows} rows inserted ({copied_rows - inserted_rows} duplicates dropped) "
+                f"in {total_time:.2f} seconds via COPY. Overall rate: {inserted_rows / total_time:.2f} rows/second")
+    return inserted_rows, total_time
+
+
+def drop_load_table(load_name):
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {load_name}")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def copy_partitioned_file(orm_class, file_path):
+    """Load a full parquet file into a partitioned table, several partitions at a time.
+
+    Each chunk is copied into an unlogged load table partitioned like the target, so Postgres routes every
+    row to its month, and each month is then moved into its partition on its own connection. Those moves
+    commit separately from the checkpoint, so a crash can repeat one chunk; ON CONFLICT DO NOTHING makes
+    the repeat harmless.
+    """
+    table_name = orm_class.__tablename__
+    file_name = os.path.basename(file_path)
+    load_name = f"load_{table_name}"
+    start_time = time.time()
+    stats = {'copied': 0}
+    try:
+        with open_parquet_file(file_path) as pf:
+            months = prepare_partitions(table_name, pf)
+            conn = ENGINE.raw_connection()
+            try:
+                with conn.cursor() as cursor:
+                    column_types = get_column_types(cursor, table_name)
+                    checkpoint = get_checkpoint(cursor, file_name)
+                    cursor.execute(f"DROP TABLE IF EXISTS {load_name}")
+                    cursor.execute(f"CREATE TABLE {load_name} (LIKE {table_name} INCLUDING DEFAULTS) "
+                                   f"PARTITION BY RANGE ({PARTITION_COLUMN})")
+                    ensure_partitions(cursor, load_name, months, unlogged=True)
+                conn.commit()
+                if checkpoint:
+                    logger.info(f"Resuming {file_name} at row group {checkpoint[0]}, batch {checkpoint[1]}")
+                columns = project_columns(pf.schema_arrow.names, orm_class)
+
+                def load_chunk(cursor, chunk):
+                    stats['copied'] += copy_batches(cursor, load_name, columns,
+                                                    [column_types[name] for name in columns], chunk)
+                    conn.commit()
+                    inserted_rows = load_partitions(ENGINE, {
+                        month: insert_from_staging_sql(partition_name(table_name, month),
+                                                       partition_name(load_name, month), columns)
+                        for month in months
+                    })
+                    cursor.execute(f"TRUNCATE {load_name}")
+                    logger.info(f"Copied {stats['copied']} rows into {table_name} ({len(months)} partitions) "
+                                f"in {time.time() - start_time:.2f} seconds")
+                    return inserted_rows
+
+                batches = iter_pipeline(pf, columns=columns, start=checkpoint,
+                                        transform=lambda batch: transform_batch(batch, orm_class, column_types))
+                inserted_rows = load_in_chunks(conn, file_name, table_name, batches, load_chunk)
+            finally:
+                conn.close()
+    finally:
+        drop_load_table(load_name)
+
+    copied_rows = stats['copied']
+    total_time = time.time() - start_time
+    logger.info(f"Table {table_name}: {inserted_rows} rows inserted ({copied_rows - inserted_rows} duplicates dropped) "
+                f"in {total_time:.2f} seconds via partitioned COPY. Overall rate: {inserted_rows / total_time:.2f} rows/second")
+    return inserted_rows, total_time
+
+
+def write_checkpoint(file_name, table_name, position):
+    """Save position as file_name's checkpoint in its own transaction, or clear it when position is None."""
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            if position is None:
+                clear_checkpoint(cursor, file_name)
+            else:
+                save_checkpoint(cursor, file_name, table_name, position)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def file_table_name(file_path):
+    return os.path.basename(file_path).split('-')[1].split('.')[0]
+
+
 def process_file(file_path):
     file_name = os.path.basename(file_path)
-    table_name = file_name.split('-')[1].split('.')[0]
+    table_name = file_table_name(file_path)
 
     orm_class_dict = {
         'fids': Fids,
@@ -142,55 +326,124 @@ def process_file(file_path):
         return
 
     orm_class = orm_class_dict.get(table_name)
-    if not orm_class or not table_is_empty(table_name):
+    # A partially seeded file resumes from its checkpoint even though the table is no longer empty
+    if not orm_class or (not table_is_empty(table_name) and not has_checkpoint(ENGINE, file_name)):
         logger.info(f"No action taken for table '{table_name}' from file '{file_name}'")
         return
 
     logger.info(f"Starting to process file {file_name} for table {table_name}")
 
+    if SEED_LOAD_MODE == 'copy':
+        if table_is_partitioned(table_name):
+            inserted_rows, total_time = copy_partitioned_file(orm_class, file_path)
+        else:
+            inserted_rows, total_time = copy_file(orm_class, file_path)
+        metrics.set_gauge('rows_per_second', inserted_rows / max(total_time, 1e-6), table=table_name)
+        return
+
     total_rows = 0
     total_time = 0
     start_time = time.time()
 
-    # Determine the number of CPU cores and available memory
     num_cores = psutil.cpu_count(logical=False)
-    available_memory = psutil.virtual_memory().available
-
-    # Calculate chunk size based on available memory (aim for ~10% of available memory per chunk)
-    chunk_size = max(10000, int(available_memory * 0.1 / (num_cores * 8)))  # Assuming 8 bytes per value on average
 
-    with pq.ParquetFile(file_path) as pf:
-        num_row_groups = pf.num_row_groups
-        with ProcessPoolExecutor(max_workers=num_cores) as executor:
-            futures = []
-            for row_group in range(num_row_groups):
-                table = pf.read_row_group(row_group)
-                for chunk_start in range(0, len(table), chunk_size):
-                    chunk = table.slice(chunk_start, chunk_size)
-                    futures.append(executor.submit(process_chunk, orm_class, chunk, BATCH_SIZE))
-
-            for future in as_completed(futures):
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            checkpoint = get_checkpoint(cursor, file_name)
+    finally:
+        conn.close()
+    # Chunks finish out of order, so only whole row groups are checkpointed; a partly inserted row group
+    # is inserted again on resume and its duplicates dropped by ON CONFLICT DO NOTHING
+    first_row_group = checkpoint[0] if checkpoint else 0
+    if checkpoint:
+        logger.info(f"Resuming {file_name} at row group {first_row_group}")
+
+    # Half of the budget feeds the reader, the other half bounds the chunks handed to worker processes
+    in_flight_budget = LOAD_MEMORY_BUDGET // 2
+    in_flight = {}
+    in_flight_bytes = 0
+    pending_chunks = defaultdict(int)
+    submitted_row_groups = set()
+    failed_row_groups = set()
+    next_row_group = first_row_group
+
+    def collect(done):
+        nonlocal total_rows, total_time, in_flight_bytes, next_row_group
+        for future in done:
+            row_group, nbytes = in_flight.pop(future)
+            in_flight_bytes -= nbytes
+            pending_chunks[row_group] -= 1
+            try:
                 rows, chunk_time = future.result()
-                total_rows += rows
-                total_time += chunk_time
-                logger.info(f"Processed {total_rows} rows in {total_time:.2f} seconds. "
-                            f"Average rate: {total_rows / total_time:.2f} rows/second")
+            except Exception as e:
+                logger.error(f"Failed to load a chunk of row group {row_group} of {file_name}: {e}")
+                failed_row_groups.add(row_group)
+                continue
+            total_rows += rows
+            total_time += chunk_time
+            metrics.inc('rows_applied_total', rows, table=table_name)
+            metrics.observe('batch_duration_seconds', chunk_time, table=table_name)
+            logger.info(f"Processed {total_rows} rows in {total_time:.2f} seconds. "
+                        f"Average rate: {total_rows / max(total_time, 1e-6):.2f} rows/second")
+        checkpointed_row_group = next_row_group
+        # The checkpoint never moves past a row group with a failed chunk, so a rerun loads it again
+        while (next_row_group in submitted_row_groups and pending_chunks[next_row_group] == 0
+               and next_row_group not in failed_row_groups):
+            next_row_group += 1
+        if next_row_group != checkpointed_row_group:
+            write_checkpoint(file_name, table_name, (next_row_group, 0))
+
+    with open_parquet_file(file_path) as pf:
+        prepare_partitions(table_name, pf)
+        with ProcessPoolExecutor(max_workers=num_cores) as executor:
+            batches = iter_pipeline(pf, start=(first_row_group, 0), memory_budget=LOAD_MEMORY_BUDGET - in_flight_budget)
+            for row_group, _, batch in batches:
+                submitted_row_groups.update(range(first_row_group, row_group))
+                nbytes = batch.nbytes * PYTHON_ROW_EXPANSION
+                in_flight[executor.submit(process_chunk, orm_class, batch, BATCH_SIZE)] = (row_group, nbytes)
+                in_flight_bytes += nbytes
+                pending_chunks[row_group] += 1
+                # Backpressure: stop reading until workers have finished enough chunks
+                while in_flight_bytes > in_flight_budget:
+                    collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                if failed_row_groups:
+                    break
+            else:
+                submitted_row_groups.update(range(first_row_group, pf.num_row_groups))
+            collect(wait(in_flight).done)
+
+    if failed_row_groups:
+        raise RuntimeError(f"{file_name} stopped at row group {min(failed_row_groups)} after a chunk failed; "
+                           "a rerun resumes from there")
+    write_checkpoint(file_name, table_name, None)
 
     end_time = time.time()
     total_file_time = end_time - start_time
     logger.info(f"File {file_name} processed: {total_rows} rows in {total_file_time:.2f} seconds. "
                 f"Overall rate: {total_rows / total_file_time:.2f} rows/second")
+    metrics.set_gauge('rows_per_second', total_rows / max(total_file_time, 1e-6), table=table_name)
 
 def main():
+    if PARTITIONED_SCHEMA:
+        run_sql_script('./sql/partitioned_setup.sql')
     run_sql_script('./sql/setup.sql')
 
-    full_path = './downloads/full'
+    if STREAM_FROM_S3:
+        # Imported here so the S3 client is only created when streaming
+        from download_or_update_files import get_stream_files
+        full_files, _ = get_stream_files()
+    else:
+        full_path = './downloads/full'
+        full_files = [os.path.join(full_path, f) for f in os.listdir(full_path) if f.endswith('.parquet')]
 
-    full_files = [f for f in os.listdir(full_path) if f.endswith('.parquet')]
+    if SEED_DEFER_INDEXES:
+        seed_tables = {file_table_name(file_path) for file_path in full_files} - set(skip_tables)
+        defer_indexes(ENGINE, sorted(table for table in seed_tables if table_is_empty(table)))
 
     total_files = len(full_files)
-    for i, file in enumerate(full_files, 1):
-        file_path = os.path.join(full_path, file)
+    for i, file_path in enumerate(full_files, 1):
+        file = os.path.basename(file_path)
         logger.info(f"Processing file {i} of {total_files}: {file}")
         start_time = time.time()
         try:
@@ -201,8 +454,19 @@ def main():
         logger.info(f"Total processing time for {file}: {end_time - start_time:.2f} seconds")
         logger.info(f"Completed {i}/{total_files} files")
 
+    # Also picks up indexes left deferred by an earlier run that crashed mid-load
+    rebuild_deferred_indexes(ENGINE)
+    # The seed loads casts and reactions without counting them or placing casts in their threads
+    if CAST_COUNTERS and any(file_table_name(file_path) in COUNTED_TABLES for file_path in full_files):
+        rebuild_cast_counters(ENGINE)
+    if CAST_THREADS and any(file_table_name(file_path) == 'casts' for file_path in full_files):
+        rebuild_cast_threads(ENGINE)
+
 if __name__ == "__main__":
+    metrics.start('insert_or_update_sql_seed')
     main_start_time = time.time()
     main()
     main_end_time = time.time()
     logger.info(f"Script finished. Total execution time: {main_end_time - main_start_time:.2f} seconds")
+    main_rss, worker_rss = peak_rss_bytes()
+    logger.info(f"Peak RSS: {main_rss / 1024 / 1024:.0f} MiB main process, {worker_rss / 1024 / 1024:.0f} MiB largest worker")
@@ -0,0 +1,182 @@
+import atexit
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Directory for node_exporter's textfile collector; each script writes <script>.prom there
+METRICS_DIR = os.getenv('METRICS_DIR')
+# Serve /metrics over HTTP on this port while a script runs (0 disables it)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+# Seconds between rewrites of the metrics file
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', 15))
+
+PREFIX = 'neynar_indexer_'
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+DEFINITIONS = {
+    'rows_applied_total': ('counter', 'Rows inserted or updated'),
+    'rows_skipped_total': ('counter', 'Incremental rows not written because the stored row was as new and unchanged'),
+    'rows_per_second': ('gauge', 'Rows applied per second by the last file or table run'),
+    'batch_duration_seconds': ('histogram', 'Time to load and commit one chunk of rows'),
+    'drift_rows': ('gauge', 'Rows found missing, stale or only in the database by the last reconciliation'),
+    'files_pending': ('gauge', 'Incremental files in the work queue, waiting or being applied'),
+    'newest_downloaded_timestamp_seconds': ('gauge', 'Timestamp of the newest downloaded file'),
+    'newest_applied_timestamp_seconds': ('gauge', 'Timestamp of the newest file recorded in file_tracking'),
+    'freshness_lag_seconds': ('gauge', 'Newest downloaded file timestamp minus newest applied file timestamp'),
+    's3_list_requests_total': ('counter', 'ListObjectsV2 pages requested'),
+    's3_listed_objects_total': ('counter', 'Objects returned by S3 listings'),
+    's3_download_bytes_total': ('counter', 'Bytes downloaded from S3'),
+    'last_run_timestamp_seconds': ('gauge', 'Unix time at which the script last published its metrics'),
+}
+
+_lock = threading.Lock()
+# (name, sorted label items) -> value, or [bucket counts, sum, count] for histograms
+_samples = {}
+_script = None
+_owner_pid = None
+
+
+def _key(name, labels):
+    if name not in DEFINITIONS:
+        raise KeyError(f"Unknown metric {name}")
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _samples[key] = _samples.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _samples[key] = value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _samples.setdefault(key, [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0])
+        histogram[0][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def reset():
+    """Forget every sample, e.g. in a worker process that inherited its parent's."""
+    with _lock:
+        _samples.clear()
+
+
+def drain():
+    """Return the samples recorded so far and forget them, for a worker to hand back to its parent."""
+    with _lock:
+        samples = dict(_samples)
+        _samples.clear()
+    return samples
+
+
+def merge(samples):
+    """Add samples drained in a worker process: counters and histograms add up, gauges are replaced."""
+    with _lock:
+        for key, value in samples.items():
+            kind = DEFINITIONS[key[0]][0]
+            if kind == 'gauge' or key not in _samples:
+                _samples[key] = value
+            elif kind == 'counter':
+                _samples[key] += value
+            else:
+                counts, total, count = _samples[key]
+                _samples[key] = [[a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2]]
+
+
+def run_in_worker(function, *args):
+    """Call function in a pool worker and return (its result, the samples it recorded) for merge()."""
+    result = function(*args)
+    return result, drain()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}'
+
+
+def render():
+    """All samples in the Prometheus text exposition format."""
+    with _lock:
+        samples = sorted(_samples.items())
+    script_label = (('script', _script),) if _script else ()
+    lines = []
+    for name, (kind, description) in DEFINITIONS.items():
+        metric_samples = [(labels, value) for (sample_name, labels), value in samples if sample_name == name]
+        if not metric_samples:
+            continue
+        metric_name = PREFIX + name
+        lines.append(f"# HELP {metric_name} {description}")
+        lines.append(f"# TYPE {metric_name} {kind}")
+        for labels, value in metric_samples:
+            labels = script_label + labels
+            if kind != 'histogram':
+                lines.append(f"{metric_name}{_format_labels(labels)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{metric_name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{metric_name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{metric_name}_count{_format_labels(labels)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics_file():
+    """Atomically rewrite METRICS_DIR/<script>.prom, so the collector never reads a partial file."""
+    if not METRICS_DIR or os.getpid() != _owner_pid:
+        return
+    set_gauge('last_run_timestamp_seconds', int(time.time()))
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{_script}.prom")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        file.write(render())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _write_periodically(stop):
+    while not stop.wait(METRICS_INTERVAL):
+        write_metrics_file()
+
+
+def start(script):
+    """Publish this process's metrics under script: to METRICS_DIR periodically and at exit, and on METRICS_PORT."""
+    global _script, _owner_pid
+    _script = script
+    _owner_pid = os.getpid()
+    if METRICS_DIR:
+        stop = threading.Event()
+        threading.Thread(target=_write_periodically, args=(stop,), daemon=True).start()
+        atexit.register(write_metrics_file)
+        atexit.register(stop.set)
+    if METRICS_PORT:
+        server = ThreadingHTTPServer(('', METRICS_PORT), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
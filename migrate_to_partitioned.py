@@ -0,0 +1,126 @@
+import logging
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+
+from index_builds import rebuild_deferred_indexes
+from partitions import PARTITION_COLUMN, PARTITIONED_TABLES, ensure_partitions, is_partitioned, load_partitions, \
+    month_range, next_month, partition_name
+from pg_copy import get_column_types
+
+# Converts casts and reactions in an existing database to the monthly partitioned layout of
+# sql/partitioned_setup.sql. Stop the loaders first: each table is locked against writes while it is copied.
+# The old table is kept as <table>_unpartitioned and can be dropped once the new one has been checked.
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+DB_NAME = os.getenv('DB_NAME')
+DB_USER = os.getenv('DB_USER')
+DB_PASS = os.getenv('DB_PASS')
+DB_HOST = os.getenv('DB_HOST')
+DB_PORT = os.getenv('DB_PORT')
+CONNECTION_STRING = f'postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+ENGINE = create_engine(CONNECTION_STRING)
+
+
+def create_partitioned_copy(table_name, new_name):
+    """Create new_name partitioned like sql/partitioned_setup.sql with a partition per month present in table_name."""
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT min({PARTITION_COLUMN}), max({PARTITION_COLUMN}) FROM {table_name}")
+            first, last = cursor.fetchone()
+            months = month_range(first, last) if first is not None else []
+            cursor.execute(f"DROP TABLE IF EXISTS {new_name}")
+            cursor.execute(
+                f"CREATE TABLE {new_name} (LIKE {table_name} INCLUDING DEFAULTS, "
+                f"CONSTRAINT {table_name}_id_timestamp_pkey PRIMARY KEY (id, {PARTITION_COLUMN}), "
+                f"CONSTRAINT {table_name}_hash_timestamp_unique UNIQUE (hash, {PARTITION_COLUMN})) "
+                f"PARTITION BY RANGE ({PARTITION_COLUMN})"
+            )
+            ensure_partitions(cursor, new_name, months, table_name=table_name)
+        conn.commit()
+        return months
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def swap_tables(cursor, table_name, new_name):
+    """Put new_name in place of table_name and queue the old secondary indexes for a rebuild on the new table."""
+    old_name = f"{table_name}_unpartitioned"
+    cursor.execute(
+        "SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE i.indrelid = %s::regclass "
+        "AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.indexrelid)",
+        (table_name,)
+    )
+    for index_name, index_definition in cursor.fetchall():
+        # The definition names the table as table_name, which is the partitioned table once the swap commits
+        cursor.execute(
+            "INSERT INTO deferred_indexes (index_name, table_name, index_definition) "
+            "VALUES (%s, %s, %s) ON CONFLICT (index_name) DO NOTHING",
+            (index_name, table_name, index_definition)
+        )
+        cursor.execute(f'ALTER INDEX "{index_name}" RENAME TO "{index_name}_unpartitioned"')
+    cursor.execute(f"ALTER TABLE {table_name} RENAME TO {old_name}")
+    cursor.execute(f"ALTER TABLE {new_name} RENAME TO {table_name}")
+    return old_name
+
+
+def migrate_table(table_name):
+    new_name = f"{table_name}_partitioned"
+    start_time = time.time()
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            if is_partitioned(cursor, table_name):
+                logging.info(f"Table {table_name} is already partitioned")
+                return
+            # Held until the swap commits, so nothing is written to the old table after it has been copied
+            cursor.execute(f"LOCK TABLE {table_name} IN SHARE MODE")
+            column_list = ', '.join(f'"{column}"' for column in get_column_types(cursor, table_name))
+
+            months = create_partitioned_copy(table_name, new_name)
+            logging.info(f"Copying {table_name} into {len(months)} monthly partitions")
+            copied_rows = load_partitions(ENGINE, {
+                month: (f"INSERT INTO {partition_name(table_name, month)} ({column_list}) "
+                        f"SELECT {column_list} FROM {table_name} "
+                        f"WHERE {PARTITION_COLUMN} >= '{month}' AND {PARTITION_COLUMN} < '{next_month(month)}'")
+                for month in months
+            })
+
+            cursor.execute(f"SELECT count(*) FROM {table_name}")
+            source_rows = cursor.fetchone()[0]
+            if copied_rows != source_rows:
+                raise RuntimeError(f"Copied {copied_rows} of {source_rows} rows from {table_name}; not swapping")
+
+            old_name = swap_tables(cursor, table_name, new_name)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    logging.info(f"Migrated {table_name}: {copied_rows} rows in {time.time() - start_time:.2f} seconds. "
+                 f"The previous table is kept as {old_name}")
+
+
+def main():
+    tables = sys.argv[1:] or PARTITIONED_TABLES
+    for table_name in tables:
+        migrate_table(table_name)
+    rebuild_deferred_indexes(ENGINE)
+
+
+if __name__ == "__main__":
+    main()
@@ -138,6 +138,8 @@ class FileTracking(Base):
     __tablename__ = 'file_tracking'
     file_name = Column(VARCHAR, primary_key=True)
     processed_at = Column(TIMESTAMP, default=text('CURRENT_TIMESTAMP'))
+    table_name = Column(VARCHAR)
+    file_timestamp = Column(BigInteger)
 
 class Channel(Base):
     __tablename__ = 'channels'
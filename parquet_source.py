@@ -0,0 +1,41 @@
+import os
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+# Load parquet files straight from S3 with ranged GETs instead of from ./downloads
+STREAM_FROM_S3 = os.getenv('STREAM_FROM_S3', '0') == '1'
+
+_s3_filesystem = None
+
+
+def get_s3_filesystem():
+    """pyarrow S3 filesystem using the default AWS credential chain (AWS_PROFILE, env vars) and S3_ENDPOINT_URL."""
+    global _s3_filesystem
+    if _s3_filesystem is None:
+        kwargs = {'region': os.getenv('AWS_DEFAULT_REGION', 'us-east-1')}
+        endpoint_url = os.getenv('S3_ENDPOINT_URL')
+        if endpoint_url:
+            endpoint = urlparse(endpoint_url)
+            kwargs['endpoint_override'] = endpoint.netloc
+            kwargs['scheme'] = endpoint.scheme
+        _s3_filesystem = fs.S3FileSystem(**kwargs)
+    return _s3_filesystem
+
+
+@contextmanager
+def open_parquet_file(path):
+    """Open a local path or an s3://bucket/key URI as a ParquetFile, closing it and its source on exit.
+
+    S3 files are read with ranged GETs for the footer and each requested row group; nothing lands on disk.
+    """
+    if path.startswith('s3://'):
+        # ParquetFile only closes sources it opened itself, so the S3 stream is closed here
+        with get_s3_filesystem().open_input_file(path[len('s3://'):]) as source:
+            with pq.ParquetFile(source, pre_buffer=True) as pf:
+                yield pf
+    else:
+        with pq.ParquetFile(path) as pf:
+            yield pf
@@ -0,0 +1,120 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+
+# Create casts and reactions as monthly range partitions on timestamp (see sql/partitioned_setup.sql)
+PARTITIONED_SCHEMA = os.getenv('PARTITIONED_SCHEMA', '0') == '1'
+# Partitions loaded at once by the seed and by migrate_to_partitioned.py
+PARTITION_LOAD_WORKERS = int(os.getenv('PARTITION_LOAD_WORKERS', 4))
+PARTITION_COLUMN = 'timestamp'
+PARTITIONED_TABLES = ('casts', 'reactions')
+
+logger = logging.getLogger(__name__)
+
+
+def is_partitioned(cursor, table_name):
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass", (table_name,))
+    return cursor.fetchone()[0]
+
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def month_range(first, last):
+    """First day of every month from first's month through last's month."""
+    if isinstance(last, datetime):
+        last = last.date()
+    month = date(first.year, first.month, 1)
+    months = []
+    while month <= last:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+def file_months(pf, column=PARTITION_COLUMN):
+    """Months covered by column in a ParquetFile, taken from row group statistics when every row group has them."""
+    names = pf.schema_arrow.names
+    if column not in names or pf.metadata.num_rows == 0:
+        return []
+    column_index = names.index(column)
+    minimums, maximums = [], []
+    for row_group in range(pf.num_row_groups):
+        statistics = pf.metadata.row_group(row_group).column(column_index).statistics
+        if statistics is None or not statistics.has_min_max:
+            values = pf.read(columns=[column]).column(column).drop_null().to_pylist()
+            if not values:
+                return []
+            return month_range(min(values), max(values))
+        minimums.append(statistics.min)
+        maximums.append(statistics.max)
+    return month_range(min(minimums), max(maximums))
+
+
+def partition_name(table_name, month):
+    return f"{table_name}_p{month:%Y%m}"
+
+
+def ensure_partitions(cursor, parent_name, months, unlogged=False, table_name=None):
+    """Create the monthly partitions of parent_name that do not exist yet.
+
+    Partitions are named after table_name (default parent_name), so a table built under a temporary
+    name can already carry its final partition names.
+    """
+    persistence = 'UNLOGGED ' if unlogged else ''
+    for month in months:
+        name = partition_name(table_name or parent_name, month)
+        cursor.execute("SELECT to_regclass(%s)", (name,))
+        if cursor.fetchone()[0] is None:
+            cursor.execute(f"CREATE {persistence}TABLE {name} PARTITION OF {parent_name} "
+                           f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')")
+
+
+def ensure_file_partitions(cursor, table_name, pf):
+    """Create the partitions a parquet file needs if table_name is partitioned. Returns the file's months, or None."""
+    if not is_partitioned(cursor, table_name):
+        return None
+    months = file_months(pf)
+    ensure_partitions(cursor, table_name, months)
+    return months
+
+
+def _load_partition(engine, month, statement):
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(statement)
+            rows = cursor.rowcount
+        conn.commit()
+        return rows
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def load_partitions(engine, statements):
+    """Run {month: statement} on PARTITION_LOAD_WORKERS connections, one transaction per month.
+
+    Returns the total rowcount. Every month is attempted; the first failure is raised once all are done.
+    """
+    total_rows = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=PARTITION_LOAD_WORKERS) as executor:
+        futures = {executor.submit(_load_partition, engine, month, statement): month
+                   for month, statement in statements.items()}
+        for future in as_completed(futures):
+            month = futures[future]
+            try:
+                rows = future.result()
+                total_rows += rows
+                logger.info(f"Loaded {rows} rows for {month:%Y-%m}")
+            except Exception as e:
+                logger.error(f"Failed to load partition for {month:%Y-%m}: {e}")
+                errors.append(e)
+    if errors:
+        raise errors[0]
+    return total_rows
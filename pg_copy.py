@@ -0,0 +1,291 @@
+import io
+import json
+import struct
+from datetime import datetime, timezone
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+POSTGRES_EPOCH = datetime(2000, 1, 1)
+POSTGRES_EPOCH_UTC = datetime(2000, 1, 1, tzinfo=timezone.utc)
+NULL_FIELD = struct.pack('!i', -1)
+
+# Element OIDs for the array types used in sql/setup.sql
+ARRAY_ELEMENT_OIDS = {'_int8': 20, '_int2': 21, '_int4': 23}
+ARRAY_ELEMENT_FORMATS = {'_int8': '!iq', '_int2': '!ih', '_int4': '!ii'}
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+LARGE_BINARY = pa.large_binary()
+EMPTY_FIELD = pa.scalar(b'', LARGE_BINARY)
+NULL_FIELD_SCALAR = pa.scalar(NULL_FIELD, LARGE_BINARY)
+JSONB_VERSION = pa.scalar(b'\x01', LARGE_BINARY)
+# Microseconds between the Unix and Postgres epochs
+POSTGRES_EPOCH_MICROS = 946684800 * 1000000
+
+# Big-endian payload dtype and Arrow type of the fixed-width Postgres types
+FIXED_WIDTH_TYPES = {
+    'int8': ('>i8', pa.int64()),
+    'int4': ('>i4', pa.int32()),
+    'int2': ('>i2', pa.int16()),
+    'float8': ('>f8', pa.float64()),
+    'bool': ('?', pa.bool_()),
+}
+ARRAY_ELEMENT_TYPES = {'_int8': ('>i8', pa.int64()), '_int4': ('>i4', pa.int32()), '_int2': ('>i2', pa.int16())}
+
+
+def get_column_types(cursor, table_name):
+    """Return {column_name: pg type name} for a table, resolved through the search_path."""
+    cursor.execute(
+        "SELECT a.attname, t.typname FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid "
+        "WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped ORDER BY a.attnum",
+        (table_name,)
+    )
+    return dict(cursor.fetchall())
+
+
+def parse_int_list(value):
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode('utf-8')
+    if isinstance(value, str):
+        try:
+            return [int(x) for x in value.strip('[]{} ').split(',') if x.strip()]
+        except ValueError:
+            return []
+    return [int(x) for x in value]
+
+
+def _encode_timestamp(value):
+    if value.tzinfo is not None:
+        delta = value - POSTGRES_EPOCH_UTC
+    else:
+        delta = value - POSTGRES_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return struct.pack('!iq', 8, micros)
+
+
+def _encode_bytes(payload):
+    return struct.pack('!i', len(payload)) + payload
+
+
+def _encode_text(value):
+    if isinstance(value, (bytes, bytearray)):
+        return _encode_bytes(bytes(value))
+    return _encode_bytes(str(value).encode('utf-8'))
+
+
+def _json_text(value):
+    # JSON text has already been validated by transforms.transform_batch
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return json.dumps(value).encode('utf-8')
+
+
+def _encode_json(value):
+    return _encode_bytes(_json_text(value))
+
+
+def _encode_jsonb(value):
+    return _encode_bytes(b'\x01' + _json_text(value))
+
+
+def _array_encoder(type_name):
+    element_oid = ARRAY_ELEMENT_OIDS[type_name]
+    element_format = struct.Struct(ARRAY_ELEMENT_FORMATS[type_name])
+    element_size = element_format.size - 4
+
+    def encode(value):
+        items = parse_int_list(value)
+        if not items:
+            return _encode_bytes(struct.pack('!iii', 0, 0, element_oid))
+        payload = struct.pack('!iiiii', 1, 0, element_oid, len(items), 1)
+        payload += b''.join(element_format.pack(element_size, item) for item in items)
+        return _encode_bytes(payload)
+
+    return encode
+
+
+FIELD_ENCODERS = {
+    'int8': lambda value: struct.pack('!iq', 8, value),
+    'int4': lambda value: struct.pack('!ii', 4, value),
+    'int2': lambda value: struct.pack('!ih', 2, value),
+    'bool': lambda value: struct.pack('!i?', 1, value),
+    'float8': lambda value: struct.pack('!id', 8, value),
+    'timestamp': _encode_timestamp,
+    'timestamptz': _encode_timestamp,
+    'bytea': _encode_bytes,
+    'text': _encode_text,
+    'varchar': _encode_text,
+    'json': _encode_json,
+    'jsonb': _encode_jsonb,
+    '_int8': _array_encoder('_int8'),
+    '_int4': _array_encoder('_int4'),
+    '_int2': _array_encoder('_int2'),
+}
+
+
+def _binary_array(data, offsets):
+    """LargeBinary array over a contiguous byte buffer, without copying either."""
+    return pa.LargeBinaryArray.from_buffers(LARGE_BINARY, len(offsets) - 1,
+                                            [None, pa.py_buffer(offsets), pa.py_buffer(data)])
+
+
+def _fixed_width_fields(values, payload_dtype):
+    """Length-prefixed fields for a numpy array of fixed-width values."""
+    fields = np.empty(len(values), dtype=[('length', '>i4'), ('value', payload_dtype)])
+    fields['length'] = fields.dtype['value'].itemsize
+    fields['value'] = values
+    offsets = np.arange(len(values) + 1, dtype=np.int64) * fields.dtype.itemsize
+    return _binary_array(fields, offsets)
+
+
+def _prefixed_fields(values, extra=None):
+    """Length-prefixed fields for a binary array, with `extra` bytes between each prefix and its value."""
+    lengths = pc.binary_length(values).fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+    if extra is None:
+        return pc.binary_join_element_wise(_length_prefix_array(lengths), values, EMPTY_FIELD)
+    return pc.binary_join_element_wise(_length_prefix_array(lengths + len(extra.as_py())), extra, values, EMPTY_FIELD)
+
+
+def _length_prefix_array(lengths):
+    prefixes = lengths.astype('>i4')
+    offsets = np.arange(len(lengths) + 1, dtype=np.int64) * 4
+    return _binary_array(prefixes, offsets)
+
+
+def _timestamp_micros(column):
+    micros = pc.cast(column, pa.timestamp('us', tz=column.type.tz)).cast(pa.int64()).fill_null(0)
+    return micros.to_numpy(zero_copy_only=False) - POSTGRES_EPOCH_MICROS
+
+
+def _array_fields(column, type_name):
+    """Binary array fields for a list<int> column: one-dimensional arrays, or empty arrays for empty lists."""
+    element_dtype, element_type = ARRAY_ELEMENT_TYPES[type_name]
+    element_size = np.dtype(element_dtype).itemsize
+    counts = pc.list_value_length(column).fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+    elements = pc.cast(column.flatten(), element_type).to_numpy(zero_copy_only=False)
+
+    element_fields = np.empty(len(elements), dtype=[('length', '>i4'), ('value', element_dtype)])
+    element_fields['length'] = element_size
+    element_fields['value'] = elements
+    element_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts * element_fields.dtype.itemsize, out=element_offsets[1:])
+
+    # Field length, ndim, flags, element oid, then dimension and lower bound for non-empty arrays only
+    headers = np.zeros(len(counts), dtype=[('length', '>i4'), ('ndim', '>i4'), ('flags', '>i4'), ('oid', '>i4'),
+                                           ('dim', '>i4'), ('lbound', '>i4')])
+    non_empty = counts > 0
+    headers['length'] = np.where(non_empty, 20 + counts * element_fields.dtype.itemsize, 12)
+    headers['ndim'] = non_empty
+    headers['oid'] = ARRAY_ELEMENT_OIDS[type_name]
+    headers['dim'] = counts
+    headers['lbound'] = 1
+    header_lengths = np.where(non_empty, 24, 16)
+    keep = np.arange(24) < header_lengths[:, None]
+    header_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(header_lengths, out=header_offsets[1:])
+    header_bytes = headers.view(np.uint8).reshape(len(counts), 24)[keep]
+    return pc.binary_join_element_wise(_binary_array(header_bytes, header_offsets),
+                                       _binary_array(element_fields, element_offsets), EMPTY_FIELD)
+
+
+def _python_fields(column, type_name):
+    """Per-value fallback for Arrow types the vectorized encoders do not handle."""
+    encode = FIELD_ENCODERS[type_name]
+    return pa.array([NULL_FIELD if value is None else encode(value) for value in column.to_pylist()], LARGE_BINARY)
+
+
+def encode_column(column, type_name):
+    """Binary COPY fields (length prefix and payload, or NULL) for an Arrow array, as a LargeBinary array."""
+    arrow_type = column.type
+    if pa.types.is_null(arrow_type):
+        return pa.array([NULL_FIELD] * len(column), LARGE_BINARY)
+    if type_name in FIXED_WIDTH_TYPES and (pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type)
+                                           or pa.types.is_boolean(arrow_type)):
+        payload_dtype, target_type = FIXED_WIDTH_TYPES[type_name]
+        values = pc.cast(column, target_type).fill_null(False if type_name == 'bool' else 0)
+        fields = _fixed_width_fields(values.to_numpy(zero_copy_only=False), payload_dtype)
+    elif type_name in ('timestamp', 'timestamptz') and pa.types.is_timestamp(arrow_type):
+        fields = _fixed_width_fields(_timestamp_micros(column), '>i8')
+    elif type_name in ('bytea', 'text', 'varchar', 'json', 'jsonb') and (
+            pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type)
+            or pa.types.is_binary(arrow_type) or pa.types.is_large_binary(arrow_type)
+            or pa.types.is_fixed_size_binary(arrow_type)):
+        values = column.cast(LARGE_BINARY)
+        fields = _prefixed_fields(values, JSONB_VERSION if type_name == 'jsonb' else None)
+    elif type_name in ARRAY_ELEMENT_TYPES and (pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type)) \
+            and column.flatten().null_count == 0:
+        fields = _array_fields(column, type_name)
+    else:
+        return _python_fields(column, type_name)
+    if column.null_count:
+        fields = pc.if_else(column.is_null(), NULL_FIELD_SCALAR, fields)
+    return fields
+
+
+def encode_batch(batch, column_types):
+    """Encode an Arrow record batch into binary COPY tuples for the given column types.
+
+    Every column is encoded as a whole into length-prefixed fields, and the fields are joined row by row,
+    so no Python object is created per value.
+    """
+    if batch.num_rows == 0:
+        return b''
+    fields = [encode_column(column, type_name) for column, type_name in zip(batch.columns, column_types)]
+    tuple_header = pa.scalar(struct.pack('!h', len(fields)), LARGE_BINARY)
+    rows = pc.binary_join_element_wise(tuple_header, *fields, EMPTY_FIELD)
+    offsets = np.frombuffer(rows.buffers()[1], dtype=np.int64)[rows.offset:rows.offset + len(rows) + 1]
+    return memoryview(rows.buffers()[2])[int(offsets[0]):int(offsets[-1])]
+
+
+class CopyStream(io.RawIOBase):
+    """File-like object over an iterator of byte chunks, as consumed by cursor.copy_expert."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = b''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                self._chunk = next(self._chunks, None)
+                self._offset = 0
+                if self._chunk is None:
+                    self._chunk = b''
+                    break
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size)
+            parts.append(self._chunk[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return b''.join(parts)
+
+
+def copy_batches(cursor, table_name, columns, column_types, batches):
+    """Stream Arrow record batches into table_name with a single COPY ... FROM STDIN (FORMAT binary).
+
+    Returns the number of rows sent.
+    """
+    stats = {'rows': 0}
+
+    def chunks():
+        yield PGCOPY_HEADER
+        for batch in batches:
+            stats['rows'] += batch.num_rows
+            data = encode_batch(batch, column_types)
+            for start in range(0, len(data), COPY_CHUNK_SIZE):
+                yield data[start:start + COPY_CHUNK_SIZE]
+        yield PGCOPY_TRAILER
+
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    cursor.copy_expert(f"COPY {table_name} ({column_list}) FROM STDIN (FORMAT binary)", CopyStream(chunks()),
+                       size=COPY_CHUNK_SIZE)
+    return stats['rows']
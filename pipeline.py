@@ -0,0 +1,120 @@
+import os
+import queue
+import resource
+import threading
+
+# Bytes of Arrow data a load may hold at once: half for decoded batches waiting to be transformed, half
+# for transformed batches waiting to be written
+LOAD_MEMORY_BUDGET = int(os.getenv('LOAD_MEMORY_BUDGET', 512 * 1024 * 1024))
+# Rows per decoded batch. Fixed rather than derived from the budget, because checkpoints count batches
+READ_BATCH_ROWS = 65536
+
+
+class MemoryBudget:
+    """Byte-counting semaphore between two pipeline stages.
+
+    A single item larger than the whole budget is still let through once nothing else is held, so an
+    oversized batch slows the pipeline down instead of deadlocking it.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes, stop=None):
+        with self._condition:
+            while self.used and self.used + nbytes > self.limit:
+                if stop is not None and stop.is_set():
+                    return False
+                self._condition.wait(timeout=0.5)
+            self.used += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self._condition:
+            self.used -= nbytes
+            self._condition.notify_all()
+
+
+class _Done:
+    pass
+
+
+def _stage(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def iter_pipeline(pf, columns=None, start=None, transform=None, memory_budget=None):
+    """Yield (row_group, batch_index, batch) from a ParquetFile through reader and transform threads.
+
+    Decoding, transform(batch) and the caller's writes overlap, while the batches held between the stages
+    stay within memory_budget bytes (LOAD_MEMORY_BUDGET by default). A batch counts against the budget
+    until the caller asks for the next one. start is a (row_group, batch_index) position to resume from.
+    """
+    memory_budget = memory_budget or LOAD_MEMORY_BUDGET
+    decoded_budget = MemoryBudget(memory_budget // 2)
+    transformed_budget = MemoryBudget(memory_budget - memory_budget // 2)
+    decoded = queue.Queue()
+    transformed = queue.Queue()
+    stop = threading.Event()
+    start_row_group, start_batch = start or (0, 0)
+
+    def reader():
+        try:
+            for row_group in range(start_row_group, pf.num_row_groups):
+                batches = pf.iter_batches(batch_size=READ_BATCH_ROWS, row_groups=[row_group], columns=columns)
+                for batch_index, batch in enumerate(batches):
+                    if row_group == start_row_group and batch_index < start_batch:
+                        continue
+                    if not decoded_budget.acquire(batch.nbytes, stop):
+                        return
+                    decoded.put((row_group, batch_index, batch))
+            decoded.put(_Done)
+        except Exception as e:
+            decoded.put(e)
+
+    def transformer():
+        while True:
+            item = decoded.get()
+            if item is _Done or isinstance(item, Exception):
+                transformed.put(item)
+                return
+            row_group, batch_index, batch = item
+            try:
+                result = transform(batch) if transform else batch
+            except Exception as e:
+                transformed.put(e)
+                return
+            if not transformed_budget.acquire(result.nbytes, stop):
+                return
+            decoded_budget.release(batch.nbytes)
+            transformed.put((row_group, batch_index, result))
+
+    threads = [_stage(reader), _stage(transformer)]
+    try:
+        while True:
+            item = transformed.get()
+            if item is _Done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            try:
+                yield item
+            finally:
+                transformed_budget.release(item[2].nbytes)
+    finally:
+        stop.set()
+        # Unblock a transformer waiting for input so both stages can exit
+        decoded.put(_Done)
+        for thread in threads:
+            thread.join()
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process and of its largest finished child process, in bytes."""
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
@@ -0,0 +1,492 @@
+"""Check the tables against the latest full files and merge back the rows that drifted.
+
+    python reconcile.py [table ...]
+
+A row's fingerprint covers its key, updated_at and deleted_at only, not its other columns: a row whose content
+differs from the snapshot while its updated_at matches is not detected. Content changes are expected to move
+updated_at, as every upstream write does.
+"""
+import bisect
+import logging
+import math
+import os
+import sys
+import time
+
+import numpy as np
+import pyarrow as pa
+
+import metrics
+from insert_or_update_sql import ENGINE, ORM_CLASSES, extract_timestamp, list_local_files
+from parquet_source import STREAM_FROM_S3, open_parquet_file
+from partitions import ensure_file_partitions
+from pg_copy import copy_batches, get_column_types
+from pipeline import READ_BATCH_ROWS
+from schema_swap import share_swap_lock
+from staging import create_staging_table, get_primary_key_columns, get_unique_constraints, merge_from_staging
+from transforms import project_columns, transform_batch
+
+# Key ranges a mismatching range is split into for the next pass
+RECONCILE_FANOUT = int(os.getenv('RECONCILE_FANOUT', 64))
+# Mismatching ranges of at most this many rows are compared row by row instead of being split further
+RECONCILE_LEAF_ROWS = int(os.getenv('RECONCILE_LEAF_ROWS', 20000))
+# Set to 0 to report drift without applying the snapshot's rows
+RECONCILE_APPLY = os.getenv('RECONCILE_APPLY', '1') == '1'
+
+# Keys sampled for each range of the next split, to place its boundaries
+SAMPLES_PER_RANGE = 16
+# (left, right) shifts that mix each fingerprinted column before they are XORed together
+KEY_SHIFTS = ((13, 7), (17, 11), (23, 5))
+UPDATED_SHIFTS = (29, 19)
+DELETED_SHIFTS = (31, 3)
+# MD5's initial state, per-step constants and per-round rotations, for hashing text keys like md5() in SQL
+MD5_INITIAL_STATE = (0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476)
+MD5_CONSTANTS = [np.uint32(int(abs(math.sin(i + 1)) * (1 << 32))) for i in range(64)]
+MD5_SHIFTS = ((7, 12, 17, 22), (5, 9, 14, 20), (4, 11, 16, 23), (6, 10, 15, 21))
+# Multipliers of splitmix64's finalizer, which spreads key hashes evenly over 64 bits to decide the sample
+SAMPLE_MULTIPLIERS = (0xbf58476d1ce4e5b9, 0x94d049bb133111eb)
+TIMESTAMP_TYPES = {'timestamp', 'timestamptz'}
+TEXT_TYPES = {'text', 'varchar', 'bpchar'}
+UINT64_RANGE = 1 << 64
+
+
+def _mix(values, shifts):
+    left, right = shifts
+    return values ^ (values << left) ^ (values >> right)
+
+
+def _mix_sql(value, shifts):
+    left, right = shifts
+    return f"({value} # ({value} << {left}) # ({value} >> {right}))"
+
+
+def sample_hash(key_hash):
+    """splitmix64's finalizer over key hashes, read as unsigned. Unlike the key hash, which barely mixes small
+    integer keys, every bit of it depends on every bit of the key, so the hashes below a threshold are a fair
+    sample of the keys."""
+    first, second = (np.uint64(multiplier) for multiplier in SAMPLE_MULTIPLIERS)
+    values = key_hash.view(np.uint64)
+    values = (values ^ (values >> np.uint64(30))) * first
+    values = (values ^ (values >> np.uint64(27))) * second
+    return values ^ (values >> np.uint64(31))
+
+
+def _md5_rounds(words):
+    """MD5 state words (a, b, c, d) after compressing the 64-byte blocks in words, shaped (rows, blocks, 16)."""
+    state = [np.full(len(words), value, dtype=np.uint32) for value in MD5_INITIAL_STATE]
+    f, scratch = np.empty(len(words), dtype=np.uint32), np.empty(len(words), dtype=np.uint32)
+    for block in range(words.shape[1]):
+        block_words = np.ascontiguousarray(words[:, block, :].T)
+        a, b, c, d = (value.copy() for value in state)
+        # In place, since every step is a few passes over whole columns: a's array takes the new b
+        for i in range(64):
+            if i < 16:
+                np.bitwise_and(b, c, out=f)
+                np.invert(b, out=scratch)
+                scratch &= d
+                f |= scratch
+                g = i
+            elif i < 32:
+                np.bitwise_and(d, b, out=f)
+                np.invert(d, out=scratch)
+                scratch &= c
+                f |= scratch
+                g = (5 * i + 1) % 16
+            elif i < 48:
+                np.bitwise_xor(b, c, out=f)
+                f ^= d
+                g = (3 * i + 5) % 16
+            else:
+                np.invert(d, out=f)
+                f |= b
+                f ^= c
+                g = (7 * i) % 16
+            f += a
+            f += MD5_CONSTANTS[i]
+            f += block_words[g]
+            shift = MD5_SHIFTS[i // 16][i % 4]
+            np.left_shift(f, np.uint32(shift), out=scratch)
+            f >>= np.uint32(32 - shift)
+            scratch |= f
+            np.add(b, scratch, out=a)
+            a, d, c, b = d, c, b, a
+        for total, value in zip(state, (a, b, c, d)):
+            total += value
+    return state
+
+
+def md5_prefixes(column):
+    """The first 8 bytes of the md5 of each string of column, as signed big-endian int64 like
+    ('x' || left(md5(value), 16))::bit(64)::bigint, computed for all rows at once; nulls are 0."""
+    column = column.cast(pa.large_string())
+    valid = column.is_valid().to_numpy(zero_copy_only=False)
+    column = column.fill_null('')
+    offsets = np.frombuffer(column.buffers()[1], dtype=np.int64)[column.offset:column.offset + len(column) + 1]
+    data = np.frombuffer(column.buffers()[2], dtype=np.uint8) if column.buffers()[2] else np.zeros(0, np.uint8)
+    lengths = np.diff(offsets)
+    # Padding takes at least 9 bytes: 0x80 and the message length in bits
+    blocks = (lengths + 8) // 64 + 1
+    prefixes = np.zeros(len(column), dtype=np.int64)
+    for block_count in np.unique(blocks).tolist():
+        rows = np.flatnonzero(blocks == block_count)
+        row_lengths = lengths[rows]
+        width = block_count * 64
+        message = np.zeros((len(rows), width), dtype=np.uint8)
+        # Byte j of row i goes to position i * width + j, from position offset + j of the string data
+        shift = np.repeat(np.arange(len(rows)) * width - (np.cumsum(row_lengths) - row_lengths), row_lengths)
+        source_shift = np.repeat(offsets[rows] - (np.cumsum(row_lengths) - row_lengths), row_lengths)
+        packed = np.arange(row_lengths.sum())
+        message.ravel()[packed + shift] = data[packed + source_shift]
+        message[np.arange(len(rows)), row_lengths] = 0x80
+        message[:, -8:] = (row_lengths * 8).astype('<u8').view(np.uint8).reshape(-1, 8)
+        a, b, _, _ = _md5_rounds(message.view('<u4').reshape(len(rows), block_count, 16))
+        digest = np.stack([a, b], axis=1).astype('<u4').view(np.uint8).reshape(-1, 8)
+        prefixes[rows] = digest.copy().view('>i8').ravel()
+    return np.where(valid, prefixes, 0)
+
+
+def column_values(column):
+    """A column as fingerprinted, matching column_value_sql: int64, timestamps in microseconds, text as the
+    first 8 bytes of its md5 and nulls as 0."""
+    if pa.types.is_null(column.type):
+        return np.zeros(len(column), dtype=np.int64)
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        return md5_prefixes(column)
+    if pa.types.is_timestamp(column.type):
+        column = column.cast(pa.timestamp('us', tz=column.type.tz), safe=False).cast(pa.int64())
+    return column.fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+
+
+def column_value_sql(column, type_name):
+    column = f't."{column}"'
+    if type_name in TIMESTAMP_TYPES:
+        value = f"(extract(epoch FROM {column}) * 1000000)::bigint"
+    elif type_name in TEXT_TYPES:
+        value = f"('x' || left(md5({column}), 16))::bit(64)::bigint"
+    else:
+        value = f"{column}::bigint"
+    return f"coalesce({value}, 0)"
+
+
+def fingerprint_batch(batch, key_columns):
+    """(key hashes, fingerprints, updated_at in microseconds) of a batch's rows, as fingerprint_sql computes them.
+
+    A row's fingerprint covers its key, updated_at and deleted_at. Ranges are compared by row count and the
+    sum of their fingerprints modulo 2^64, which does not depend on row order.
+    """
+    key_hash = np.zeros(batch.num_rows, dtype=np.int64)
+    for column, shifts in zip(key_columns, KEY_SHIFTS):
+        key_hash ^= _mix(column_values(batch.column(column)), shifts)
+    updated = column_values(batch.column('updated_at'))
+    fingerprint = key_hash ^ _mix(updated, UPDATED_SHIFTS)
+    if 'deleted_at' in batch.schema.names:
+        fingerprint ^= _mix(column_values(batch.column('deleted_at')), DELETED_SHIFTS)
+    return key_hash, fingerprint, updated
+
+
+def fingerprint_sql(key_columns, column_types):
+    """SQL expressions of the key hash, fingerprint and updated_at of fingerprint_batch, over alias t."""
+    key_hash = ' # '.join(_mix_sql(column_value_sql(column, column_types[column]), shifts)
+                          for column, shifts in zip(key_columns, KEY_SHIFTS))
+    updated = column_value_sql('updated_at', column_types['updated_at'])
+    fingerprint = f"{key_hash} # {_mix_sql(updated, UPDATED_SHIFTS)}"
+    if 'deleted_at' in column_types:
+        fingerprint += f" # {_mix_sql(column_value_sql('deleted_at', column_types['deleted_at']), DELETED_SHIFTS)}"
+    return f"({key_hash})", f"({fingerprint})", updated
+
+
+def leading_values(batch, column):
+    values = batch.column(column)
+    if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+        return np.array(values.to_pylist(), dtype=object)
+    return values.to_numpy(zero_copy_only=False)
+
+
+def above(value):
+    """An upper bound just above value, so the last range includes it."""
+    return value + '\U0010ffff' if isinstance(value, str) else value + 1
+
+
+class KeyRange:
+    """Rows whose leading key column is in [low, high), and what one scan of the snapshot found there.
+
+    The first range of a table is unbounded (low and high None). A leaf range keeps the key hash,
+    fingerprint and updated_at of every snapshot row instead of their sum.
+    """
+
+    def __init__(self, low, high, estimated_rows, leaf=False):
+        self.low = low
+        self.high = high
+        self.estimated_rows = estimated_rows
+        self.leaf = leaf
+        self.rows = 0
+        self.fingerprint = 0
+        self.samples = []
+        self.snapshot_rows = {}
+
+    def sample_threshold(self):
+        """Keys whose sample_hash is below this are sampled, enough of them to split the range."""
+        rate = min(1.0, RECONCILE_FANOUT * SAMPLES_PER_RANGE / max(self.estimated_rows, 1))
+        return min(int(rate * UINT64_RANGE), UINT64_RANGE - 1)
+
+    def split(self):
+        """Ranges this one is split into at quantiles of its sampled keys, or a single leaf if it cannot be."""
+        samples = sorted(self.samples)
+        step = len(samples) / RECONCILE_FANOUT
+        cuts = sorted({samples[int(i * step)] for i in range(1, RECONCILE_FANOUT)} - {self.low}) if samples else []
+        if not cuts:
+            return [KeyRange(self.low, self.high, self.rows, leaf=True)]
+        rate = self.sample_threshold() / UINT64_RANGE
+        bounds = [self.low, *cuts, self.high]
+        return [KeyRange(low, high, (bisect.bisect_left(samples, high) - bisect.bisect_left(samples, low)) / rate)
+                for low, high in zip(bounds, bounds[1:])]
+
+
+def scan_snapshot(file_path, key_columns, ranges, cutoff):
+    """Read the snapshot's keys and timestamps once and fill in every range; returns the smallest and largest
+    leading key seen.
+
+    Rows updated after cutoff are left out, as they are on the database side.
+    """
+    unbounded = ranges[0].low is None
+    if not unbounded:
+        # Text keys stay Python strings, compared like the database compares them with COLLATE "C"
+        key_dtype = object if isinstance(ranges[0].low, str) else None
+        lows = np.array([key_range.low for key_range in ranges], dtype=key_dtype)
+        highs = np.array([key_range.high for key_range in ranges], dtype=key_dtype)
+    thresholds = np.array([key_range.sample_threshold() for key_range in ranges], dtype=np.uint64)
+    leaves = np.array([key_range.leaf for key_range in ranges])
+    counts = np.zeros(len(ranges), dtype=np.int64)
+    sums = np.zeros(len(ranges), dtype=np.uint64)
+    sampled_positions, sampled_keys = [], []
+    smallest = largest = None
+
+    with open_parquet_file(file_path) as pf:
+        columns = [column for column in (*key_columns, 'updated_at', 'deleted_at') if column in pf.schema_arrow.names]
+        for batch in pf.iter_batches(batch_size=READ_BATCH_ROWS, columns=columns):
+            key_hash, fingerprint, updated = fingerprint_batch(batch, key_columns)
+            leading = leading_values(batch, key_columns[0])
+            if unbounded:
+                index = np.zeros(batch.num_rows, dtype=np.intp)
+                inside = updated <= cutoff
+                if batch.num_rows:
+                    low, high = leading.min(), leading.max()
+                    if isinstance(low, np.generic):
+                        low, high = low.item(), high.item()
+                    smallest = low if smallest is None else min(smallest, low)
+                    largest = high if largest is None else max(largest, high)
+            else:
+                index = np.searchsorted(lows, leading, side='right') - 1
+                inside = (index >= 0) & (updated <= cutoff)
+                index = np.maximum(index, 0)
+                inside &= (leading < highs[index]).astype(bool)
+            index, key_hash, fingerprint, updated, leading = (
+                values[inside] for values in (index, key_hash, fingerprint, updated, leading))
+
+            np.add.at(counts, index, 1)
+            np.add.at(sums, index, fingerprint.view(np.uint64))
+            sampled = sample_hash(key_hash) < thresholds[index]
+            sampled_positions.append(index[sampled])
+            sampled_keys.append(leading[sampled])
+            in_leaf = leaves[index]
+            for position, row_hash, row_fingerprint, row_updated in zip(
+                    index[in_leaf].tolist(), key_hash[in_leaf].tolist(), fingerprint[in_leaf].tolist(),
+                    updated[in_leaf].tolist()):
+                ranges[position].snapshot_rows[row_hash] = (row_fingerprint, row_updated)
+
+    for key_range, count, total in zip(ranges, counts.tolist(), sums.tolist()):
+        key_range.rows, key_range.fingerprint = count, total
+    if sampled_positions:
+        positions = np.concatenate(sampled_positions)
+        order = np.argsort(positions, kind='stable')
+        keys = np.concatenate(sampled_keys)[order]
+        starts = np.searchsorted(positions[order], np.arange(len(ranges) + 1))
+        for key_range, start, end in zip(ranges, starts.tolist(), starts[1:].tolist()):
+            key_range.samples = keys[start:end].tolist()
+    return smallest, largest
+
+
+class TableFingerprints:
+    """The database side of a table's reconciliation."""
+
+    def __init__(self, cursor, table_name, key_columns, column_types):
+        self.cursor = cursor
+        self.table_name = table_name
+        self.key_hash, self.fingerprint, self.updated = fingerprint_sql(key_columns, column_types)
+        self.key_type = column_types[key_columns[0]]
+        self.text_key = self.key_type in TEXT_TYPES
+        # Text keys are compared bytewise, as Python compares them
+        self.key = f't."{key_columns[0]}"' + (' COLLATE "C"' if self.text_key else '')
+
+    def key_bounds(self):
+        self.cursor.execute(f"SELECT min({self.key}), max({self.key}) FROM {self.table_name} t")
+        return self.cursor.fetchone()
+
+    def ranges_sql(self, ranges):
+        """FROM clause selecting the rows of ranges as t, with r.position numbering the ranges from 1, and its
+        parameters."""
+        lows = [key_range.low for key_range in ranges]
+        if self.text_key:
+            # The primary key index does not serve bytewise order, so one scan buckets rows by the ranges' bounds
+            bounds = sorted({*lows, *(key_range.high for key_range in ranges)})
+            buckets = [bounds.index(low) + 1 for low in lows]
+            return (f"(SELECT t.*, width_bucket({self.key}, %s::{self.key_type}[]) AS bucket "
+                    f"FROM {self.table_name} t) t "
+                    f"JOIN unnest(%s::int[]) WITH ORDINALITY AS r(bucket, position) USING (bucket)"), [bounds, buckets]
+        # One primary key index range scan per range; OFFSET 0 keeps the planner from joining every row to
+        # every range instead
+        return (f"unnest(%s::{self.key_type}[], %s::{self.key_type}[]) WITH ORDINALITY AS r(low, high, position) "
+                f"CROSS JOIN LATERAL (SELECT * FROM {self.table_name} t "
+                f"WHERE {self.key} >= r.low AND {self.key} < r.high OFFSET 0) t"),\
+            [lows, [key_range.high for key_range in ranges]]
+
+    def sums(self, ranges, cutoff):
+        """{range position: (rows, fingerprint sum)} of rows updated up to cutoff, positions counted from 1."""
+        if ranges[0].low is None:
+            self.cursor.execute(f"SELECT 1, count(*), coalesce(sum({self.fingerprint}), 0) FROM {self.table_name} t "
+                                f"WHERE {self.updated} <= %s", (cutoff,))
+        else:
+            from_sql, parameters = self.ranges_sql(ranges)
+            self.cursor.execute(f"SELECT r.position, count(*), coalesce(sum({self.fingerprint}), 0) FROM {from_sql} "
+                                f"WHERE {self.updated} <= %s GROUP BY r.position", (*parameters, cutoff))
+        return {position: (rows, int(total) % UINT64_RANGE) for position, rows, total in self.cursor.fetchall()}
+
+    def rows(self, ranges):
+        """{range position: {key hash: (fingerprint, updated_at)}} of every row in ranges."""
+        from_sql, parameters = self.ranges_sql(ranges)
+        self.cursor.execute(f"SELECT r.position, {self.key_hash}, {self.fingerprint}, {self.updated} FROM {from_sql}",
+                            parameters)
+        rows = {}
+        for position, key_hash, fingerprint, updated in self.cursor.fetchall():
+            rows.setdefault(position, {})[key_hash] = (fingerprint, updated)
+        return rows
+
+
+def compare_leaf(key_range, stored_rows, cutoff, drift):
+    """Sort a leaf's differing rows into missing, stale and extra; rows the database has newer are not drift."""
+    for key_hash, (fingerprint, updated) in key_range.snapshot_rows.items():
+        stored = stored_rows.pop(key_hash, None)
+        if stored is None:
+            drift['missing'].add(key_hash)
+        elif stored[0] != fingerprint and stored[1] <= updated:
+            drift['stale'].add(key_hash)
+    drift['extra'] += sum(1 for _, updated in stored_rows.values() if updated <= cutoff)
+
+
+def find_drift(file_path, table_fingerprints, key_columns, cutoff):
+    """Narrow the snapshot and the database down to their differing rows, pass by pass; returns the drift and
+    the number of passes."""
+    with open_parquet_file(file_path) as pf:
+        ranges = [KeyRange(None, None, pf.metadata.num_rows)]
+    drift = {'missing': set(), 'stale': set(), 'extra': 0}
+    passes = 0
+    while ranges:
+        passes += 1
+        bounds = scan_snapshot(file_path, key_columns, ranges, cutoff)
+        summed = [key_range for key_range in ranges if not key_range.leaf]
+        sums = table_fingerprints.sums(summed, cutoff) if summed else {}
+        leaves = [key_range for key_range in ranges if key_range.leaf]
+        stored_rows = table_fingerprints.rows(leaves) if leaves else {}
+        for position, key_range in enumerate(leaves, 1):
+            compare_leaf(key_range, stored_rows.get(position, {}), cutoff, drift)
+
+        next_ranges = []
+        for position, key_range in enumerate(summed, 1):
+            if sums.get(position, (0, 0)) == (key_range.rows, key_range.fingerprint):
+                continue
+            if key_range.low is None:
+                keys = [key for key in (*bounds, *table_fingerprints.key_bounds()) if key is not None]
+                key_range.low, key_range.high = min(keys), above(max(keys))
+            if key_range.rows <= RECONCILE_LEAF_ROWS:
+                next_ranges.append(KeyRange(key_range.low, key_range.high, key_range.rows, leaf=True))
+            else:
+                next_ranges.extend(key_range.split())
+        ranges = next_ranges
+    return drift, passes
+
+
+def apply_rows(conn, file_path, table_name, key_columns, key_hashes, column_types, unique_constraints):
+    """Merge the snapshot rows with the given key hashes into the table; returns (inserted, updated, skipped)."""
+    orm_class = ORM_CLASSES[table_name]
+    wanted = np.array(sorted(key_hashes), dtype=np.int64)
+    batches = []
+    with open_parquet_file(file_path) as pf:
+        columns = project_columns(pf.schema_arrow.names, orm_class)
+        for batch in pf.iter_batches(batch_size=READ_BATCH_ROWS, columns=columns):
+            key_hash, _, _ = fingerprint_batch(batch, key_columns)
+            selected = np.isin(key_hash, wanted)
+            if selected.any():
+                batches.append(transform_batch(batch.filter(pa.array(selected)), orm_class, column_types))
+        with conn.cursor() as cursor:
+            ensure_file_partitions(cursor, table_name, pf)
+        conn.commit()
+
+    with conn.cursor() as cursor:
+        share_swap_lock(cursor)
+        stage_name = create_staging_table(cursor, table_name, sequenced=True)
+        copy_batches(cursor, stage_name, columns, [column_types[name] for name in columns], batches)
+        counts = merge_from_staging(cursor, table_name, stage_name, columns, key_columns, unique_constraints)
+    conn.commit()
+    return counts
+
+
+def reconcile_table(file_path):
+    """Find and apply the rows a table misses or holds stale compared with its full snapshot file."""
+    file_name = os.path.basename(file_path)
+    table_name = file_name.split('-')[1]
+    # The snapshot holds every change up to its timestamp; later ones are left to the incremental files
+    cutoff = extract_timestamp(file_name) * 1000000
+    start_time = time.time()
+    conn = ENGINE.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            column_types = get_column_types(cursor, table_name)
+            key_columns = get_primary_key_columns(cursor, table_name)
+            unique_constraints = get_unique_constraints(cursor, table_name)
+            table_fingerprints = TableFingerprints(cursor, table_name, key_columns, column_types)
+            drift, passes = find_drift(file_path, table_fingerprints, key_columns, cutoff)
+        conn.commit()
+
+        missing, stale = len(drift['missing']), len(drift['stale'])
+        for kind, rows in (('missing', missing), ('stale', stale), ('extra', drift['extra'])):
+            metrics.set_gauge('drift_rows', rows, table=table_name, kind=kind)
+        logging.info(f"{table_name}: {missing} rows missing, {stale} stale and {drift['extra']} only in the database "
+                     f"compared with {file_name}, found in {passes} passes and {time.time() - start_time:.2f} seconds")
+        if not RECONCILE_APPLY or not missing + stale:
+            return 0
+        inserted, updated, skipped = apply_rows(conn, file_path, table_name, key_columns,
+                                                drift['missing'] | drift['stale'], column_types, unique_constraints)
+    finally:
+        conn.close()
+    metrics.inc('rows_applied_total', inserted + updated, table=table_name)
+    logging.info(f"{table_name}: {inserted} rows inserted, {updated} updated, {skipped} skipped as no newer")
+    return inserted + updated
+
+
+def main(tables=()):
+    if STREAM_FROM_S3:
+        # Imported here so the S3 client is only created when streaming
+        from download_or_update_files import get_stream_files
+        full_files, _ = get_stream_files()
+    else:
+        full_files = list_local_files('./downloads/full')
+
+    failed = []
+    for file_path in sorted(full_files):
+        table_name = os.path.basename(file_path).split('-')[1]
+        if table_name not in ORM_CLASSES or (tables and table_name not in tables):
+            continue
+        try:
+            reconcile_table(file_path)
+        except Exception as e:
+            logging.error(f"Reconciling {table_name} failed: {e}")
+            failed.append(table_name)
+    return failed
+
+
+if __name__ == "__main__":
+    metrics.start('reconcile')
+    start_time = time.time()
+    failed = main(sys.argv[1:])
+    logging.info(f"Reconciliation finished in {time.time() - start_time:.2f} seconds")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+
+from psycopg2 import errors
+from sqlalchemy import create_engine
+
+import insert_or_update_sql as loader
+import insert_or_update_sql_seed as seed
+import metrics
+from cast_counters import CAST_COUNTERS, COUNTED_TABLES, recount_sql
+from cast_threads import CAST_THREADS
+from compaction import COMPACT_MAX_FILES
+from parquet_source import STREAM_FROM_S3
+from schema_swap import REFRESH_SCHEMA, drop_retired, swap_tables
+
+# Replays and swaps tried before giving up, when loaders keep applying files or readers keep the tables busy
+SWAP_ATTEMPTS = 5
+
+# Connections of this script itself stay on public
+ENGINE = create_engine(loader.CONNECTION_STRING)
+
+
+def list_snapshot_files():
+    """(full files, incremental files) the refresh is built from, like the seed and the loaders list them."""
+    if STREAM_FROM_S3:
+        # Imported here so the S3 client is only created when streaming
+        from download_or_update_files import get_stream_files
+        return get_stream_files()
+    return loader.list_local_files('./downloads/full'), loader.list_local_files('./downloads/incremental')
+
+
+def prepare_schema(conn, snapshot_timestamps):
+    """Create the refresh schema, or keep it to resume a build of the same snapshot that was interrupted."""
+    snapshot = json.dumps(snapshot_timestamps, sort_keys=True)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT obj_description(oid, 'pg_namespace') FROM pg_namespace WHERE nspname = %s",
+                       (REFRESH_SCHEMA,))
+        row = cursor.fetchone()
+        if row and row[0] == snapshot:
+            logging.info(f"Resuming the snapshot being built in {REFRESH_SCHEMA}")
+        else:
+            if row:
+                logging.info(f"Dropping {REFRESH_SCHEMA}, it holds an older snapshot")
+            cursor.execute(f"DROP SCHEMA IF EXISTS {REFRESH_SCHEMA} CASCADE")
+            cursor.execute(f"CREATE SCHEMA {REFRESH_SCHEMA}")
+            cursor.execute(f"COMMENT ON SCHEMA {REFRESH_SCHEMA} IS %s", (snapshot,))
+    conn.commit()
+
+
+def check_snapshot(conn, full_files, snapshot_timestamps):
+    """Raise if the seed left a snapshot table unloaded, partly loaded or without its indexes."""
+    file_names = [os.path.basename(file_path) for file_path in full_files]
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT file_name FROM {REFRESH_SCHEMA}.file_checkpoints WHERE file_name = ANY(%s)",
+                       (file_names,))
+        incomplete = [row[0] for row in cursor.fetchall()]
+        incomplete += [table for table in snapshot_timestamps if seed.table_is_empty(table)]
+        cursor.execute(f"SELECT index_name FROM {REFRESH_SCHEMA}.deferred_indexes")
+        incomplete += [row[0] for row in cursor.fetchall()]
+        if incomplete:
+            raise RuntimeError(f"Snapshot in {REFRESH_SCHEMA} is incomplete ({', '.join(incomplete)}), "
+                               f"rerun to resume it")
+        for table in sorted(snapshot_timestamps):
+            # Planner statistics are in place before the first query reaches the new tables
+            cursor.execute(f"ANALYZE {REFRESH_SCHEMA}.{table}")
+    conn.commit()
+
+
+def replay_incremental_files(incremental_files, snapshot_timestamps):
+    """Apply every incremental file newer than its table's snapshot to the refresh schema, oldest first.
+
+    Files already replayed are skipped, and a file a loader is applying to public is waited for.
+    """
+    files_by_table = defaultdict(list)
+    for file_path in incremental_files:
+        file_name = os.path.basename(file_path)
+        table_name = file_name.split('-')[1]
+        if table_name in snapshot_timestamps and loader.extract_timestamp(file_name) > snapshot_timestamps[table_name]:
+            files_by_table[table_name].append(file_path)
+
+    for table_name, file_paths in sorted(files_by_table.items()):
+        file_paths.sort(key=lambda file_path: loader.extract_timestamp(os.path.basename(file_path)))
+        processed = loader.load_processed_files(table_name, [os.path.basename(file_path) for file_path in file_paths])
+        pending = [file_path for file_path in file_paths if os.path.basename(file_path) not in processed]
+        if pending:
+            logging.info(f"Replaying {len(pending)} {table_name} files into {REFRESH_SCHEMA}")
+        while pending:
+            rows, applied = loader.apply_files(pending[:COMPACT_MAX_FILES])
+            if rows is None:
+                time.sleep(loader.QUEUE_POLL_INTERVAL)
+                continue
+            pending = pending[len(applied):]
+
+
+def main():
+    full_files, incremental_files = list_snapshot_files()
+    snapshot_timestamps = {}
+    for file_path in full_files:
+        table_name = seed.file_table_name(file_path)
+        if table_name in loader.ORM_CLASSES:
+            snapshot_timestamps[table_name] = loader.extract_timestamp(os.path.basename(file_path))
+    if not snapshot_timestamps:
+        logging.info("No full files to refresh from")
+        return
+
+    # file_tracking and file_checkpoints of public are compared with the refresh schema's before the swap
+    loader.run_sql_script('./sql/setup.sql')
+    conn = ENGINE.raw_connection()
+    try:
+        prepare_schema(conn, snapshot_timestamps)
+
+        # The seed creates the schema's tables and loads the full files with COPY, whatever mode it is set to
+        seed.use_schema(REFRESH_SCHEMA)
+        seed.SEED_LOAD_MODE = 'copy'
+        seed.main()
+        check_snapshot(conn, full_files, snapshot_timestamps)
+
+        # The seed counted the new tables into the refresh schema's cast_counters and the replay keeps them
+        # counted, which is only right if every counted table is new. Otherwise they are recounted in the swap's
+        # transaction, from the new tables and public's others while the loaders are held off
+        derived_tables, derived_sql = [], []
+        if CAST_COUNTERS and set(COUNTED_TABLES) & set(snapshot_timestamps):
+            derived_tables.append('cast_counters')
+            if not set(COUNTED_TABLES) <= set(snapshot_timestamps):
+                sources = {table: f"{REFRESH_SCHEMA if table in snapshot_timestamps else 'public'}.{table}"
+                           for table in COUNTED_TABLES}
+                derived_sql = [f"TRUNCATE {REFRESH_SCHEMA}.cast_counters",
+                               recount_sql(f"{REFRESH_SCHEMA}.cast_counters", sources)]
+        # cast_threads only depends on casts
+        if CAST_THREADS and 'casts' in snapshot_timestamps:
+            derived_tables.append('cast_threads')
+
+        loader.use_schema(REFRESH_SCHEMA)
+        for attempt in range(1, SWAP_ATTEMPTS + 1):
+            if attempt > 1:
+                _, incremental_files = list_snapshot_files()
+            replay_incremental_files(incremental_files, snapshot_timestamps)
+            try:
+                missing = swap_tables(conn, REFRESH_SCHEMA, snapshot_timestamps, derived_tables, derived_sql)
+            except errors.LockNotAvailable:
+                conn.rollback()
+                logging.info(f"Tables still in use after the lock timeout, retrying the swap "
+                             f"({attempt}/{SWAP_ATTEMPTS})")
+                continue
+            if not missing:
+                break
+            logging.info(f"{len(missing)} files were applied to public during the replay, replaying them "
+                         f"({attempt}/{SWAP_ATTEMPTS})")
+        else:
+            raise RuntimeError(f"Could not swap in the snapshot after {SWAP_ATTEMPTS} attempts")
+
+        drop_retired(conn, REFRESH_SCHEMA)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    metrics.start('refresh_snapshot')
+    start_time = time.time()
+    main()
+    logging.info(f"Snapshot refreshed in {time.time() - start_time:.2f} seconds")
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Files downloaded in parallel, ranged GETs in flight per file, and the size of each range
+DOWNLOAD_WORKERS = int(os.getenv('S3_DOWNLOAD_WORKERS', 8))
+MULTIPART_CONCURRENCY = int(os.getenv('S3_MULTIPART_CONCURRENCY', 8))
+MULTIPART_CHUNK_SIZE = int(os.getenv('S3_MULTIPART_CHUNK_SIZE', 64 * 1024 * 1024))
+READ_SIZE = 1024 * 1024
+
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.part.json'
+
+
+class DownloadVerificationError(Exception):
+    pass
+
+
+def _load_state(state_path, etag, size):
+    """Chunks already written for this exact object version, or an empty set to start over."""
+    if not os.path.exists(state_path):
+        return set()
+    with open(state_path, 'r') as file:
+        state = json.load(file)
+    if state.get('etag') != etag or state.get('size') != size or state.get('chunk_size') != MULTIPART_CHUNK_SIZE:
+        return set()
+    return set(state['done'])
+
+
+def _save_state(state_path, etag, size, done):
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump({'etag': etag, 'size': size, 'chunk_size': MULTIPART_CHUNK_SIZE, 'done': sorted(done)}, file)
+    os.replace(tmp_path, state_path)
+
+
+def _download_range(s3, bucket_name, key, etag, fd, start, end):
+    response = s3.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag)
+    body = response['Body']
+    offset = start
+    while True:
+        data = body.read(READ_SIZE)
+        if not data:
+            break
+        os.pwrite(fd, data, offset)
+        offset += len(data)
+    if offset != end + 1:
+        raise DownloadVerificationError(f"Short read for {key} range {start}-{end}: got {offset - start} bytes")
+
+
+def _verify(part_path, key, size, etag):
+    actual_size = os.path.getsize(part_path)
+    if actual_size != size:
+        raise DownloadVerificationError(f"Size mismatch for {key}: expected {size}, got {actual_size}")
+    # Multipart ETags ("<md5>-<parts>") depend on the uploader's part size, so only plain ETags are checked
+    if '-' not in etag:
+        md5 = hashlib.md5()
+        with open(part_path, 'rb') as file:
+            for data in iter(lambda: file.read(READ_SIZE), b''):
+                md5.update(data)
+        if md5.hexdigest() != etag:
+            raise DownloadVerificationError(f"ETag mismatch for {key}: expected {etag}, got {md5.hexdigest()}")
+
+
+def download_object(s3, bucket_name, key, local_path, size=None, etag=None):
+    """Download one object with concurrent ranged GETs into local_path + '.part' and publish it atomically.
+
+    Completed ranges are recorded next to the part file, so an interrupted download resumes where it
+    stopped as long as the object has not changed. Returns the number of bytes downloaded.
+    """
+    if os.path.exists(local_path):
+        return 0
+    if size is None or etag is None:
+        head = s3.head_object(Bucket=bucket_name, Key=key)
+        size, etag = head['ContentLength'], head['ETag']
+    etag = etag.strip('"')
+
+    part_path = local_path + PART_SUFFIX
+    state_path = local_path + STATE_SUFFIX
+    chunks = [(index, start, min(start + MULTIPART_CHUNK_SIZE, size) - 1)
+              for index, start in enumerate(range(0, size, MULTIPART_CHUNK_SIZE))]
+    done = _load_state(state_path, etag, size) if os.path.exists(part_path) else set()
+    pending = [chunk for chunk in chunks if chunk[0] not in done]
+    if done:
+        logging.info(f"Resuming {key}: {len(done)}/{len(chunks)} chunks already downloaded")
+
+    start_time = time.time()
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT)
+    try:
+        os.ftruncate(fd, size)
+        if len(pending) <= 1:
+            for index, start, end in pending:
+                _download_range(s3, bucket_name, key, etag, fd, start, end)
+        else:
+            state_lock = threading.Lock()
+            with ThreadPoolExecutor(max_workers=MULTIPART_CONCURRENCY) as executor:
+                futures = {executor.submit(_download_range, s3, bucket_name, key, etag, fd, start, end): index
+                           for index, start, end in pending}
+                for future in as_completed(futures):
+                    future.result()
+                    with state_lock:
+                        done.add(futures[future])
+                        _save_state(state_path, etag, size, done)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    try:
+        _verify(part_path, key, size, etag)
+    except DownloadVerificationError:
+        # Every chunk is marked done, so a resume would only publish the same bytes: start over next time
+        for path in (part_path, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    os.replace(part_path, local_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    elapsed = time.time() - start_time
+    downloaded = sum(end - start + 1 for _, start, end in pending)
+    logging.info(f"Downloaded {key}: {downloaded} bytes in {elapsed:.2f} seconds "
+                 f"({downloaded / max(elapsed, 1e-6) / 1024 / 1024:.2f} MiB/s)")
+    return downloaded
+
+
+def download_objects(s3, bucket_name, jobs, on_downloaded=None):
+    """Download [(key, local_path, size, etag)] with a bounded pool of DOWNLOAD_WORKERS files at a time.
+
+    on_downloaded(local_path) is called as each file is published, while the others are still downloading.
+    Failed files are logged and left as resumable part files, except those that failed verification, which
+    start over. Returns the total bytes downloaded.
+    """
+    if not jobs:
+        return 0
+    start_time = time.time()
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = {executor.submit(download_object, s3, bucket_name, key, local_path, size, etag): (key, local_path)
+                   for key, local_path, size, etag in jobs}
+        for future in as_completed(futures):
+            key, local_path = futures[future]
+            try:
+                total_bytes += future.result()
+            except Exception as e:
+                logging.error(f"Failed to download {key}: {e}")
+                continue
+            if on_downloaded is not None:
+                on_downloaded(local_path)
+    elapsed = time.time() - start_time
+    logging.info(f"Downloaded {len(jobs)} files, {total_bytes} bytes in {elapsed:.2f} seconds "
+                 f"({total_bytes / max(elapsed, 1e-6) / 1024 / 1024:.2f} MiB/s)")
+    return total_bytes
@@ -0,0 +1,143 @@
+import logging
+import os
+
+from psycopg2 import errors
+
+# Schema refresh_snapshot.py builds a new snapshot in before it replaces the tables of public
+REFRESH_SCHEMA = os.getenv('REFRESH_SCHEMA', 'refresh')
+# Longest the swap waits for queries on the tables it replaces before giving up and retrying
+SWAP_LOCK_TIMEOUT = os.getenv('SWAP_LOCK_TIMEOUT', '30s')
+
+# Advisory lock loaders share while they write to public and the swap takes exclusively
+SWAP_LOCK_KEY = 7302015
+SHARE_SWAP_LOCK_SQL = f"SELECT pg_advisory_xact_lock_shared({SWAP_LOCK_KEY})"
+
+
+def share_swap_lock(cursor):
+    """Hold off a swap until the caller's transaction ends, so its writes land wholly in the old or new tables."""
+    cursor.execute(SHARE_SWAP_LOCK_SQL)
+
+
+def retired_schema(schema):
+    return f"{schema}_retired"
+
+
+def snapshot_relations(cursor, schema, tables):
+    """The tables of schema named in tables, followed by their partitions."""
+    cursor.execute(
+        "SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "LEFT JOIN pg_inherits i ON i.inhrelid = c.oid LEFT JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE n.nspname = %s AND c.relkind IN ('r', 'p') AND (c.relname = ANY(%s) OR p.relname = ANY(%s)) "
+        "ORDER BY c.relispartition, c.relname",
+        (schema, list(tables), list(tables))
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def unreplayed_files(cursor, schema, snapshot_timestamps):
+    """Incremental files newer than the snapshot that public has applied, or started to, but schema has not."""
+    tables = list(snapshot_timestamps)
+    cursor.execute(
+        "WITH snapshot (table_name, file_timestamp) AS (SELECT * FROM unnest(%s::varchar[], %s::bigint[])), "
+        "applied AS ("
+        "SELECT file_name, table_name, file_timestamp FROM public.file_tracking "
+        "UNION ALL "
+        "SELECT file_name, table_name, substring(file_name FROM '-([0-9]+)\\.parquet$')::BIGINT "
+        "FROM public.file_checkpoints) "
+        "SELECT a.file_name FROM applied a "
+        "JOIN snapshot s ON s.table_name = a.table_name AND a.file_timestamp > s.file_timestamp "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {schema}.file_tracking t WHERE t.file_name = a.file_name) "
+        "ORDER BY a.file_timestamp, a.file_name",
+        (tables, [snapshot_timestamps[table] for table in tables])
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def copy_grants(cursor, table, schema):
+    """Grant on schema.table what other roles have been granted on public.table."""
+    cursor.execute(
+        "SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END, "
+        "a.privilege_type FROM pg_class c, aclexplode(c.relacl) a "
+        "WHERE c.oid = to_regclass(%s) AND a.grantee <> c.relowner",
+        (f"public.{table}",)
+    )
+    for grantee, privilege in cursor.fetchall():
+        cursor.execute(f"GRANT {privilege} ON {schema}.{table} TO {grantee}")
+
+
+def swap_tables(conn, schema, snapshot_timestamps, derived_tables=(), derived_sql=()):
+    """Replace the snapshot tables of public by their rebuilt copies in schema, in one transaction.
+
+    snapshot_timestamps maps each rebuilt table to the timestamp of its full file, and derived_tables are
+    computed from those tables in schema and swapped along with them. derived_sql is run first in the swap's
+    transaction, for derived tables that also read tables of public the loaders write to. The swap waits for the
+    loaders' transactions on public to end and blocks new ones until it commits. If public has applied
+    incremental files that schema has not, nothing is swapped and those files are returned for replay.
+    Otherwise the old tables are moved to the retired schema and file_tracking learns the files replayed
+    into schema. Readers see the old tables until the commit and the new ones after it.
+    """
+    retired = retired_schema(schema)
+    tables = sorted(snapshot_timestamps)
+    with conn.cursor() as cursor:
+        cursor.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'")
+        cursor.execute(f"SELECT pg_advisory_xact_lock({SWAP_LOCK_KEY})")
+        missing = unreplayed_files(cursor, schema, snapshot_timestamps)
+        if missing:
+            conn.rollback()
+            return missing
+
+        cursor.execute(
+            "INSERT INTO public.file_tracking (file_name, processed_at, table_name, file_timestamp) "
+            f"SELECT file_name, processed_at, table_name, file_timestamp FROM {schema}.file_tracking "
+            "ON CONFLICT DO NOTHING"
+        )
+        # Whatever is left is older than the snapshot and belonged to the old tables
+        cursor.execute("DELETE FROM public.file_checkpoints WHERE table_name = ANY(%s)", (tables,))
+
+        for statement in derived_sql:
+            cursor.execute(statement)
+
+        tables += sorted(derived_tables)
+        for table in tables:
+            copy_grants(cursor, table, schema)
+        cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {retired}")
+        kept = snapshot_relations(cursor, retired, tables)
+        if kept:
+            raise RuntimeError(f"Tables retired by an earlier swap are still in {retired}: {', '.join(kept)}")
+        for relation in snapshot_relations(cursor, 'public', tables):
+            cursor.execute(f"ALTER TABLE public.{relation} SET SCHEMA {retired}")
+        for relation in snapshot_relations(cursor, schema, tables):
+            cursor.execute(f"ALTER TABLE {schema}.{relation} SET SCHEMA public")
+    conn.commit()
+    logging.info(f"Swapped in the new snapshot of {', '.join(tables)}")
+    return []
+
+
+def drop_retired(conn, schema):
+    """Drop the tables the swap retired and what is left of schema.
+
+    A retired table that a view or foreign key still depends on is kept and logged, for its dependents to be
+    recreated on the new table first.
+    """
+    retired = retired_schema(schema)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = %s AND c.relkind IN ('r', 'p') AND NOT c.relispartition",
+            (retired,)
+        )
+        for (table,) in cursor.fetchall():
+            try:
+                cursor.execute(f"DROP TABLE {retired}.{table}")
+                conn.commit()
+            except errors.DependentObjectsStillExist:
+                conn.rollback()
+                logging.warning(f"Kept {retired}.{table}, other objects still depend on it")
+        # Only the bookkeeping tables and unused copies of tables outside the snapshot remain in schema
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.commit()
+        try:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {retired}")
+            conn.commit()
+        except errors.DependentObjectsStillExist:
+            conn.rollback()
@@ -0,0 +1,49 @@
+-- noinspection SqlDialectInspectionForFile
+-- noinspection SqlNoDataSourceInspectionForFile
+
+-- Optional monthly range partitioning of casts and reactions on timestamp (PARTITIONED_SCHEMA=1).
+-- Runs before setup.sql, whose CREATE TABLE IF NOT EXISTS then leaves these definitions alone and whose
+-- CREATE INDEX statements become partitioned indexes. Monthly partitions are created by the loaders.
+--
+-- Postgres requires unique constraints on a partitioned table to include the partition key, so id and
+-- hash are unique together with timestamp, and only within a partition: two rows may share an id or a hash
+-- under different timestamps. Merges settle conflicts on id and on hash alone before writing (see
+-- get_unique_constraints in staging.py), so the loaders still keep one row per id and per hash.
+-- migrate_to_partitioned.py converts an existing unpartitioned database.
+
+CREATE TABLE IF NOT EXISTS casts (
+    id BIGINT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    deleted_at TIMESTAMP,
+    timestamp TIMESTAMP NOT NULL,
+    fid BIGINT NOT NULL,
+    hash BYTEA NOT NULL,
+    parent_hash BYTEA,
+    parent_fid BIGINT,
+    parent_url TEXT,
+    text TEXT NOT NULL,
+    embeds JSONB NOT NULL DEFAULT '{}'::jsonb,
+    mentions BIGINT[] NOT NULL DEFAULT '{}'::bigint[],
+    mentions_positions SMALLINT[] NOT NULL DEFAULT '{}'::smallint[],
+    root_parent_hash BYTEA,
+    root_parent_url TEXT,
+    CONSTRAINT casts_id_timestamp_pkey PRIMARY KEY (id, timestamp),
+    CONSTRAINT casts_hash_timestamp_unique UNIQUE (hash, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS reactions (
+    id BIGINT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    deleted_at TIMESTAMP,
+    timestamp TIMESTAMP NOT NULL,
+    reaction_type SMALLINT NOT NULL,
+    fid BIGINT NOT NULL,
+    hash BYTEA NOT NULL,
+    target_hash BYTEA,
+    target_fid BIGINT,
+    target_url TEXT,
+    CONSTRAINT reactions_id_timestamp_pkey PRIMARY KEY (id, timestamp),
+    CONSTRAINT reactions_hash_timestamp_unique UNIQUE (hash, timestamp)
+) PARTITION BY RANGE (timestamp);
@@ -139,7 +139,60 @@ CREATE TABLE IF NOT EXISTS profile_with_addresses (
 
 CREATE TABLE IF NOT EXISTS file_tracking (
     file_name VARCHAR PRIMARY KEY,
-    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    table_name VARCHAR,
+    file_timestamp BIGINT
+);
+
+-- Lets the loader read only the tracking rows of one table from its oldest pending file onwards
+ALTER TABLE file_tracking ADD COLUMN IF NOT EXISTS table_name VARCHAR;
+ALTER TABLE file_tracking ADD COLUMN IF NOT EXISTS file_timestamp BIGINT;
+
+UPDATE file_tracking
+SET table_name = split_part(file_name, '-', 2),
+    file_timestamp = substring(file_name FROM '-([0-9]+)\.parquet$')::BIGINT
+WHERE table_name IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_file_tracking_table_timestamp
+ON file_tracking (table_name, file_timestamp);
+
+-- Last committed position in a partially loaded file, removed in the transaction that loads its last rows
+CREATE TABLE IF NOT EXISTS file_checkpoints (
+    file_name VARCHAR PRIMARY KEY,
+    table_name VARCHAR NOT NULL,
+    row_group INTEGER NOT NULL,
+    batch INTEGER NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS deferred_indexes (
+    index_name TEXT PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    index_definition TEXT NOT NULL,
+    deferred_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Live likes, recasts, replies and thread size per cast hash, maintained by the merges of casts and reactions
+-- when CAST_COUNTERS=1 and recomputed by cast_counters.py
+CREATE TABLE IF NOT EXISTS cast_counters (
+    hash BYTEA PRIMARY KEY,
+    likes BIGINT NOT NULL DEFAULT 0,
+    recasts BIGINT NOT NULL DEFAULT 0,
+    replies BIGINT NOT NULL DEFAULT 0,
+    thread_size BIGINT NOT NULL DEFAULT 0
+);
+
+-- Position of every cast in its conversation thread, maintained by the merges of casts when CAST_THREADS=1 and
+-- recomputed by cast_threads.py. path orders a thread depth first, and root_hash, depth and path stay NULL
+-- while the cast waits for its parent
+CREATE TABLE IF NOT EXISTS cast_threads (
+    hash BYTEA PRIMARY KEY,
+    parent_hash BYTEA,
+    timestamp TIMESTAMP NOT NULL,
+    deleted_at TIMESTAMP,
+    root_hash BYTEA,
+    depth INTEGER,
+    path BYTEA
 );
 
 CREATE TABLE IF NOT EXISTS channels (
@@ -152,32 +205,39 @@ CREATE TABLE IF NOT EXISTS channels (
 
 -- Reaction Query Indexes
 CREATE INDEX IF NOT EXISTS idx_casts_hash
-ON public.casts (hash);
+ON casts (hash);
 
 CREATE INDEX IF NOT EXISTS idx_casts_root_parent_deleted
-ON public.casts (root_parent_hash, deleted_at);
+ON casts (root_parent_hash, deleted_at);
 
 CREATE INDEX IF NOT EXISTS idx_reactions_target_type
-ON public.reactions (target_hash, reaction_type);
+ON reactions (target_hash, reaction_type);
 
 CREATE INDEX IF NOT EXISTS idx_warpcast_power_users_fid
-ON public.warpcast_power_users (fid);
+ON warpcast_power_users (fid);
+
+-- A whole thread in order is one range scan
+CREATE INDEX IF NOT EXISTS idx_cast_threads_root_path
+ON cast_threads (root_hash, path);
+
+CREATE INDEX IF NOT EXISTS idx_cast_threads_waiting_parent
+ON cast_threads (parent_hash) WHERE root_hash IS NULL;
 
 -- Full neynar results indexes
 CREATE INDEX IF NOT EXISTS idx_casts_root_parent_hash
-ON public.casts (root_parent_hash);
+ON casts (root_parent_hash);
 
 CREATE INDEX IF NOT EXISTS idx_reactions_target_fid_type
-ON public.reactions (target_hash, fid, reaction_type);
+ON reactions (target_hash, fid, reaction_type);
 
 CREATE INDEX IF NOT EXISTS idx_casts_hash_parent_hash
-ON public.casts (hash, parent_hash);
+ON casts (hash, parent_hash);
 
 CREATE INDEX IF NOT EXISTS idx_profile_with_addresses_fid
-ON public.profile_with_addresses (fid);
+ON profile_with_addresses (fid);
 
 CREATE INDEX IF NOT EXISTS idx_casts_parent_hash
-ON public.casts (parent_hash);
+ON casts (parent_hash);
 
 CREATE INDEX IF NOT EXISTS idx_casts_fid ON casts(fid);
 CREATE INDEX IF NOT EXISTS idx_reactions_target_hash ON reactions(target_hash);
@@ -0,0 +1,217 @@
+from cast_counters import counted_columns, counter_deltas_sql
+from cast_threads import thread_updates_sql
+
+STAGE_SEQUENCE_COLUMN = 'stage_seq'
+# Merges only overwrite a stored row with a staged one at least this recent
+UPDATED_AT_COLUMN = 'updated_at'
+
+
+def staging_table_name(table_name):
+    return f"stage_{table_name}"
+
+
+def replaced_table_name(table_name):
+    return f"replaced_{table_name}"
+
+
+def staging_table_sql(table_name, sequenced=False):
+    """Statements that create the staging table of create_staging_table, for drivers that send them at once."""
+    stage_name = staging_table_name(table_name)
+    statements = [f"DROP TABLE IF EXISTS {stage_name}",
+                  f"CREATE TEMP TABLE {stage_name} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP"]
+    if sequenced:
+        statements.append(f"ALTER TABLE {stage_name} ADD COLUMN {STAGE_SEQUENCE_COLUMN} BIGSERIAL")
+        counted = counted_columns(table_name)
+        if counted:
+            # Holds the counted columns of stored rows replaced on a secondary unique constraint until the merge
+            # takes them back from cast_counters
+            replaced_name = replaced_table_name(table_name)
+            statements += [f"DROP TABLE IF EXISTS {replaced_name}",
+                           f"CREATE TEMP TABLE {replaced_name} ON COMMIT DROP AS SELECT " +
+                           ', '.join(f'"{column}"' for column in counted) + f" FROM {table_name} WITH NO DATA"]
+    return statements
+
+
+def create_staging_table(cursor, table_name, sequenced=False):
+    """Create a transaction-scoped temp table shaped like table_name and return its name.
+
+    A sequenced staging table numbers rows in arrival order so later duplicates can win the merge.
+    """
+    for statement in staging_table_sql(table_name, sequenced):
+        cursor.execute(statement)
+    return staging_table_name(table_name)
+
+
+def get_primary_key_columns(cursor, table_name):
+    """Primary key columns of table_name in key order, as defined in the database rather than in models.py."""
+    cursor.execute(
+        "SELECT a.attname FROM pg_index i "
+        "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+        "WHERE i.indrelid = %s::regclass AND i.indisprimary "
+        "ORDER BY array_position(i.indkey::int2[], a.attnum)",
+        (table_name,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_unique_constraints(cursor, table_name):
+    """Column lists of table_name's unique constraints other than the primary key, from pg_constraint.
+
+    Postgres enforces the constraints of a partitioned table within each partition only, as they must include
+    the partition key. For such a table, the primary key and unique constraints are returned without the
+    partition key columns instead, which unique_conflicts_sql then enforces across partitions.
+    """
+    cursor.execute(
+        "SELECT coalesce(array_agg(a.attname::text), '{}') FROM pg_partitioned_table p "
+        "JOIN pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = ANY(p.partattrs::int2[]) "
+        "WHERE p.partrelid = %s::regclass",
+        (table_name,)
+    )
+    partition_columns = cursor.fetchone()[0]
+    cursor.execute(
+        "SELECT c.contype = 'p', array_agg(a.attname::text ORDER BY k.position) FROM pg_constraint c "
+        "CROSS JOIN LATERAL unnest(c.conkey) WITH ORDINALITY AS k(attnum, position) "
+        "JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum "
+        "WHERE c.conrelid = %s::regclass AND c.contype IN ('p', 'u') GROUP BY c.oid, c.conname, c.contype "
+        "ORDER BY c.conname",
+        (table_name,)
+    )
+    constraints = []
+    for primary, columns in cursor.fetchall():
+        if partition_columns:
+            constraints.append([column for column in columns if column not in partition_columns])
+        elif not primary:
+            constraints.append(columns)
+    return [columns for columns in constraints if columns]
+
+
+def _equal(left, right, columns):
+    return ' AND '.join(f'{left}."{column}" = {right}."{column}"' for column in columns)
+
+
+def _row(alias, columns):
+    return 'ROW(' + ', '.join(f'{alias}."{column}"' for column in columns) + ')'
+
+
+def unique_conflicts_sql(table_name, stage_name, columns, key_columns, unique_constraints):
+    """Statements that settle a sequenced staging table's conflicts on secondary unique constraints, in bulk.
+
+    A row that shares a unique constraint with a row under another key, e.g. a link followed again under a
+    new id, would make the merge fail. Of each such pair the newer row, by updated_at and then arrival,
+    is kept: older staged rows are deleted from the staging table, and stored rows are deleted from
+    table_name when a staged row replaces them. Returns (statement, kind) pairs, where kind is 'dropped' or
+    'replaced' for the rows each statement deletes, to be run in order before merge_from_staging_sql.
+    """
+    unique_constraints = [constraint for constraint in unique_constraints
+                          if all(column in columns for column in constraint)]
+    if not unique_constraints:
+        return []
+    has_updated_at = UPDATED_AT_COLUMN in columns and UPDATED_AT_COLUMN not in key_columns
+    ordering = [UPDATED_AT_COLUMN, STAGE_SEQUENCE_COLUMN] if has_updated_at else [STAGE_SEQUENCE_COLUMN]
+    other_key = f"{_row('s', key_columns)} IS DISTINCT FROM {_row('t', key_columns)}"
+    # Only the last staged row per key is merged, so older copies must not take part in the comparisons below
+    statements = [(f"DELETE FROM {stage_name} s USING {stage_name} t WHERE {_equal('s', 't', key_columns)} "
+                   f"AND t.{STAGE_SEQUENCE_COLUMN} > s.{STAGE_SEQUENCE_COLUMN}", None)]
+    for constraint in unique_constraints:
+        statements.append((f"DELETE FROM {stage_name} s USING {stage_name} t WHERE {_equal('s', 't', constraint)} "
+                           f"AND {other_key} AND {_row('t', ordering)} > {_row('s', ordering)}", 'dropped'))
+    newer = ''
+    if has_updated_at:
+        # The staged row must also win against the stored row of its own key, or it would not be written
+        newer = (f'AND s."{UPDATED_AT_COLUMN}" >= t."{UPDATED_AT_COLUMN}" AND NOT EXISTS (SELECT 1 FROM {table_name} o '
+                 f'WHERE {_equal("o", "s", key_columns)} AND o."{UPDATED_AT_COLUMN}" > s."{UPDATED_AT_COLUMN}")')
+    counted = counted_columns(table_name)
+    for constraint in unique_constraints:
+        replace = (f"DELETE FROM {table_name} t USING {stage_name} s WHERE {_equal('t', 's', constraint)} "
+                   f"AND {other_key} {newer}")
+        if counted:
+            replace = (f"WITH replaced AS ({replace} RETURNING " + ', '.join(f't."{column}"' for column in counted) +
+                       f") INSERT INTO {replaced_table_name(table_name)} SELECT * FROM replaced")
+        statements.append((replace, 'replaced'))
+    for constraint in unique_constraints:
+        statements.append((f"DELETE FROM {stage_name} s USING {table_name} t WHERE {_equal('s', 't', constraint)} "
+                           f"AND {other_key}", 'dropped'))
+    return statements
+
+
+def insert_from_staging_sql(table_name, stage_name, columns):
+    """INSERT ... SELECT that moves staged rows into table_name, dropping rows that hit any unique constraint."""
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    return (f"INSERT INTO {table_name} ({column_list}) "
+            f"SELECT {column_list} FROM {stage_name} "
+            f"ON CONFLICT DO NOTHING")
+
+
+def _changed_condition(columns):
+    """True where the incoming row differs from the stored one, comparing text forms so json columns work too."""
+    stored = ', '.join(f'target."{column}"' for column in columns)
+    incoming = ', '.join(f'EXCLUDED."{column}"' for column in columns)
+    return f"ROW({stored})::text IS DISTINCT FROM ROW({incoming})::text"
+
+
+def merge_from_staging_sql(table_name, stage_name, columns, key_columns):
+    """Upsert a sequenced staging table into table_name, writing only rows that are newer than the stored ones.
+
+    Only the last staged row per key is merged, matching the order in which the rows were copied. A stored row
+    is rewritten only if the staged one has a later updated_at, or the same updated_at but different content;
+    tables without updated_at compare content alone. Unchanged rows are skipped, so they cost no dead tuple,
+    WAL or index updates. The statement returns one row: (rows merged, rows inserted, rows updated).
+    Merges into a table counted by cast_counters also apply the changes of the rows written to it, and of the
+    rows unique_conflicts_sql replaced.
+    """
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    key_list = ', '.join(f'"{column}"' for column in key_columns)
+    update_columns = [column for column in columns if column not in key_columns]
+    sql = (f"WITH latest AS MATERIALIZED ("
+           f"SELECT DISTINCT ON ({key_list}) {column_list} FROM {stage_name} "
+           f"ORDER BY {key_list}, {STAGE_SEQUENCE_COLUMN} DESC), "
+           f"merged AS (INSERT INTO {table_name} AS target ({column_list}) SELECT {column_list} FROM latest "
+           f"ON CONFLICT ({key_list}) ")
+    if not update_columns:
+        sql += "DO NOTHING"
+    else:
+        changed = _changed_condition(update_columns)
+        if UPDATED_AT_COLUMN in update_columns:
+            changed = (f'EXCLUDED."{UPDATED_AT_COLUMN}" > target."{UPDATED_AT_COLUMN}" OR '
+                       f'(EXCLUDED."{UPDATED_AT_COLUMN}" = target."{UPDATED_AT_COLUMN}" AND {changed})')
+        sql += ("DO UPDATE SET " + ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in update_columns) +
+                f" WHERE {changed}")
+    # Every part of the statement sees the table as it was before the merge, so a merged key it cannot find
+    # was inserted. xmax would tell the same, but partitioned tables do not return system columns from
+    # ON CONFLICT. The stored row is also the version a merge overwrote, for the counters to take back.
+    counted = counted_columns(table_name)
+    returned = ', '.join(f'"{column}"' for column in key_columns + [c for c in counted if c not in key_columns])
+    key_match = ' AND '.join(f'stored."{column}" = merged."{column}"' for column in key_columns)
+    sql += (f" RETURNING {returned}), "
+            f"changes AS MATERIALIZED (SELECT merged.*, stored.\"{key_columns[0]}\" IS NOT NULL AS existed" +
+            ''.join(f', stored."{column}" AS "old_{column}"' for column in counted) +
+            f" FROM merged LEFT JOIN {table_name} stored ON {key_match})")
+    if counted:
+        written = ', '.join(f'"{column}"' for column in counted)
+        overwritten = ', '.join(f'"old_{column}"' for column in counted)
+        # Every change to the counters goes through this one upsert, which locks them in order. Taking back the
+        # replaced rows separately could deadlock with a merge of the other counted table
+        sql += (", counted AS (" + counter_deltas_sql(
+            table_name, f"SELECT 1 AS sign, {written} FROM changes UNION ALL "
+                        f"SELECT -1, {overwritten} FROM changes WHERE existed UNION ALL "
+                        f"SELECT -1, {written} FROM {replaced_table_name(table_name)}") + ")")
+    return sql + (" SELECT (SELECT count(*) FROM latest), count(*) FILTER (WHERE NOT existed), "
+                  "count(*) FILTER (WHERE existed) FROM changes")
+
+
+def merge_from_staging(cursor, table_name, stage_name, columns, key_columns, unique_constraints=()):
+    """Settle unique conflicts, run merge_from_staging_sql and return (rows inserted, rows updated, rows skipped).
+
+    Skipped rows are the staged rows that were unchanged, older than the stored ones, or lost a conflict on
+    one of unique_constraints. Merged casts are then placed in cast_threads by thread_updates_sql.
+    """
+    dropped = 0
+    for statement, kind in unique_conflicts_sql(table_name, stage_name, columns, key_columns, unique_constraints):
+        cursor.execute(statement)
+        if kind == 'dropped':
+            dropped += cursor.rowcount
+    cursor.execute(merge_from_staging_sql(table_name, stage_name, columns, key_columns))
+    merged, inserted, updated = cursor.fetchone()
+    for statement in thread_updates_sql(table_name, stage_name):
+        cursor.execute(statement)
+    return inserted, updated, merged - inserted - updated + dropped
@@ -0,0 +1,109 @@
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+import work_queue
+from download_or_update_files import local_incremental_path, sync_incremental_files
+from insert_or_update_sql import APPLY_WORKERS, PARTITIONED_SCHEMA, apply_queued_files, init_worker, list_local_files, \
+    run_sql_script
+
+# Seconds between S3 listings: the shortest while new files keep arriving, backing off to the longest when quiet
+SYNC_POLL_MIN_INTERVAL = float(os.getenv('SYNC_POLL_MIN_INTERVAL', 5))
+SYNC_POLL_MAX_INTERVAL = float(os.getenv('SYNC_POLL_MAX_INTERVAL', 30))
+# Seconds between listings of the download directory when inotify is not available
+WATCH_INTERVAL = 1
+
+
+class DirectoryWatcher:
+    """Wakes the applier when a parquet file is published in path.
+
+    Uses inotify when inotify_simple is installed and falls back to listing the directory otherwise.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._seen = set(list_local_files(path))
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            self._inotify = None
+            logging.info(f"inotify_simple is not installed, listing {path} every {WATCH_INTERVAL} seconds instead")
+        else:
+            self._inotify = INotify()
+            # Downloads are renamed into place once verified, so a published file arrives as a move
+            self._inotify.add_watch(path, flags.MOVED_TO | flags.CLOSE_WRITE)
+
+    def wait(self, timeout):
+        """Block for up to timeout seconds and return the parquet files published in the meantime."""
+        if self._inotify is not None:
+            return [os.path.join(self.path, event.name) for event in self._inotify.read(timeout=int(timeout * 1000))
+                    if event.name.endswith('.parquet')]
+        time.sleep(timeout)
+        files = set(list_local_files(self.path))
+        published = files - self._seen
+        self._seen = files
+        return sorted(published)
+
+
+def init_sync_worker():
+    """Applier processes finish their current file on shutdown; the daemon stops handing them new ones."""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker()
+
+
+def poll_s3(stop):
+    """Download new incremental files until stop is set, polling faster while files are being published."""
+    interval = SYNC_POLL_MIN_INTERVAL
+    while not stop.is_set():
+        try:
+            downloaded = sync_incremental_files(relist=True)
+        except Exception as e:
+            logging.error(f"Polling S3 failed: {e}")
+            downloaded = 0
+        interval = SYNC_POLL_MIN_INTERVAL if downloaded else min(interval * 2, SYNC_POLL_MAX_INTERVAL)
+        stop.wait(interval)
+
+
+def main():
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logging.info(f"Received signal {signum}, finishing the files being applied")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    # Once per daemon instead of once per run
+    if PARTITIONED_SCHEMA:
+        run_sql_script('./sql/partitioned_setup.sql')
+    run_sql_script('./sql/setup.sql')
+
+    os.makedirs(local_incremental_path, exist_ok=True)
+    watcher = DirectoryWatcher(local_incremental_path)
+    # Files downloaded while the daemon was down are applied straight away
+    work_queue.enqueue(list_local_files(local_incremental_path))
+    # Spawned rather than forked, since the poller thread may hold locks at the moment a worker starts
+    executor = ProcessPoolExecutor(max_workers=APPLY_WORKERS, initializer=init_sync_worker,
+                                   mp_context=multiprocessing.get_context('spawn'))
+    poller = threading.Thread(target=poll_s3, args=(stop,), name='s3-poller')
+    poller.start()
+    try:
+        # The poller queues each file once it is downloaded, but the watcher usually sees it land first
+        apply_queued_files(executor, stop=stop, wait_for_files=lambda timeout: work_queue.enqueue(watcher.wait(timeout)))
+    finally:
+        stop.set()
+        executor.shutdown()
+        poller.join()
+    logging.info("Sync daemon stopped")
+
+
+if __name__ == "__main__":
+    metrics.start('sync_daemon')
+    main()
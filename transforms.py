@@ -0,0 +1,146 @@
+import json
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pj
+
+LARGE_STRING = pa.large_string()
+EMPTY_JSON = '[]'
+
+# Arrow list types for the Postgres array columns in sql/setup.sql
+ARRAY_LIST_TYPES = {
+    '_int8': pa.list_(pa.int64()),
+    '_int4': pa.list_(pa.int32()),
+    '_int2': pa.list_(pa.int16()),
+}
+JSON_TYPES = {'json', 'jsonb'}
+# JSON values the Arrow reader accepts but Postgres may not: an escaped NUL, NaN or Infinity
+SUSPECT_JSON_PATTERN = r'\\u0000|NaN|Infinity'
+# What '[1,2]'-style values hold once trimmed: comma-separated integers, or nothing
+INT_LIST_PATTERN = r'^\s*(-?\d+(\s*,\s*-?\d+)*)?\s*$'
+
+
+def _to_ndjson(values, prefix, suffix):
+    """Wrap every value as prefix + value + suffix on its own line and return the joined buffer."""
+    lines = pc.binary_join_element_wise(pa.scalar(prefix, LARGE_STRING), values,
+                                        pa.scalar(suffix + '\n', LARGE_STRING), pa.scalar('', LARGE_STRING))
+    offsets = np.frombuffer(lines.buffers()[1], dtype=np.int64)[lines.offset:lines.offset + len(lines) + 1]
+    longest_line = int(np.diff(offsets).max(initial=0))
+    return lines.buffers()[2][int(offsets[0]):int(offsets[-1])], longest_line
+
+
+def _read_ndjson(values, prefix, suffix, schema):
+    buffer, longest_line = _to_ndjson(values, prefix, suffix)
+    read_options = pj.ReadOptions(block_size=max(1 << 20, longest_line + 1))
+    parse_options = pj.ParseOptions(explicit_schema=schema, unexpected_field_behavior='ignore')
+    return pj.read_json(pa.BufferReader(buffer), read_options=read_options, parse_options=parse_options)
+
+
+def _parse_or_bisect(values, prefix, suffix, schema, on_malformed):
+    """Parse values with the Arrow JSON reader, bisecting to isolate rows it rejects.
+
+    A value that closes its wrapper and opens another object reads back as several rows, so values that do
+    not read back as one row each are bisected too. Returns a list of tables in row order; malformed rows
+    are replaced by on_malformed(1).
+    """
+    try:
+        table = _read_ndjson(values, prefix, suffix, schema)
+    except pa.ArrowInvalid:
+        table = None
+    if table is not None and table.num_rows == len(values):
+        return [table]
+    if len(values) == 1:
+        return [on_malformed(1)]
+    middle = len(values) // 2
+    return (_parse_or_bisect(values.slice(0, middle), prefix, suffix, schema, on_malformed) +
+            _parse_or_bisect(values.slice(middle), prefix, suffix, schema, on_malformed))
+
+
+def _single_line(values):
+    # Raw newlines are only valid JSON as whitespace, and the reader is line-delimited
+    return pc.replace_substring_regex(values, pattern='[\r\n]', replacement=' ')
+
+
+def _malformed_mask(values, prefix, suffix):
+    tables = _parse_or_bisect(values, prefix, suffix, pa.schema([]),
+                              lambda n: pa.table({'malformed': pa.array([True] * n)}))
+    return np.concatenate([
+        np.ones(table.num_rows, dtype=bool) if 'malformed' in table.column_names
+        else np.zeros(table.num_rows, dtype=bool)
+        for table in tables
+    ])
+
+
+def _reject_constant(constant):
+    raise ValueError(f"{constant} is not JSON")
+
+
+def _postgres_rejects(value):
+    try:
+        json.loads(value, parse_constant=_reject_constant)
+    except ValueError:
+        return True
+    return False
+
+
+def validate_json_column(column):
+    """Return column with every value that is not valid JSON (or that Postgres rejects) replaced by '[]'."""
+    if len(column) == 0:
+        return column.cast(LARGE_STRING)
+    values = _single_line(column.cast(LARGE_STRING))
+    null_mask = values.is_null()
+    values = values.fill_null('null')
+    # Wrapped as an object's field, 1,"w":2 reads as an object with an extra field, and wrapped as an array's
+    # element, 1,2 reads as an array of two. Only a single JSON value reads back both ways
+    malformed = _malformed_mask(values, '{"v":', '}') | _malformed_mask(values, '{"v":[', ']}')
+    # jsonb cannot store the NUL character, and the reader accepts NaN and Infinity, which Postgres does not:
+    # the few values that mention them are checked one by one
+    suspect = np.flatnonzero(pc.match_substring_regex(values, SUSPECT_JSON_PATTERN).to_numpy(zero_copy_only=False))
+    for index, value in zip(suspect.tolist(), values.take(pa.array(suspect)).to_pylist()):
+        malformed[index] |= '\\u0000' in value or _postgres_rejects(value)
+    result = pc.if_else(pa.array(malformed), pa.scalar(EMPTY_JSON, LARGE_STRING), values)
+    return pc.if_else(null_mask, pa.scalar(None, LARGE_STRING), result)
+
+
+def parse_int_list_column(column, list_type):
+    """Turn '[1,2]'-style strings (or lists of any integer type) into list_type; malformed values become []."""
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        return pc.cast(column, list_type)
+    if len(column) == 0:
+        return pa.array([], type=list_type)
+    values = column.cast(LARGE_STRING)
+    null_mask = values.is_null()
+    values = _single_line(pc.utf8_trim(values.fill_null(''), '[]{} '))
+    # Anything else is malformed, and could close the wrapper early as 1],"w":[2 does, so it is parsed as []
+    values = pc.if_else(pc.match_substring_regex(values, INT_LIST_PATTERN), values, pa.scalar('', LARGE_STRING))
+    schema = pa.schema([('v', list_type)])
+    tables = _parse_or_bisect(values, '{"v":[', ']}', schema,
+                              lambda n: pa.table({'v': pa.array([[]] * n, type=list_type)}))
+    parsed = pa.concat_arrays([chunk for table in tables for chunk in table.column('v').chunks])
+    return pc.if_else(null_mask, pa.scalar(None, list_type), parsed)
+
+
+def project_columns(names, orm_class):
+    """Keep the parquet columns that exist on orm_class's table, in file order."""
+    table_columns = {column.name for column in orm_class.__table__.columns}
+    return [name for name in names if name in table_columns]
+
+
+def transform_batch(batch, orm_class, column_types):
+    """Column-level transform stage between parquet decode and COPY.
+
+    Projects the batch onto the ORM table's columns, parses array columns into Arrow lists and
+    validates JSON columns, all on whole Arrow arrays.
+    """
+    names = project_columns(batch.schema.names, orm_class)
+    arrays = []
+    for name in names:
+        column = batch.column(name)
+        type_name = column_types[name]
+        if type_name in ARRAY_LIST_TYPES and not pa.types.is_null(column.type):
+            column = parse_int_list_column(column, ARRAY_LIST_TYPES[type_name])
+        elif type_name in JSON_TYPES and (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+            column = validate_json_column(column)
+        arrays.append(column)
+    return pa.RecordBatch.from_arrays(arrays, names=names)
@@ -7,14 +7,18 @@ from download_or_update_files import (
     get_latest_full_timestamp,
     delete_outdated_incremental_files,
     download_incremental_files,
+    file_types,
+    load_refreshed_manifest,
+    save_manifest,
 )
 
-# Define constants for paths and file types
+# Define constants for paths, the file types are the ones download_or_update_files.py downloads
 s3_daily_path = 's3://tf-premium-parquet/public-postgres/farcaster/v2/full/'
 s3_incremental_path = 's3://tf-premium-parquet/public-postgres/farcaster/v2/incremental/'
 local_full_path = os.path.abspath('./downloads/full')
 local_incremental_path = os.path.abspath('./downloads/incremental')
-file_types = ['casts', 'fids', 'fnames', 'links', 'reactions', 'signers', 'storage', 'user_data', 'verifications']
+# Rebuild the tables from the new full files and swap them into public once downloaded (refresh_snapshot.py)
+REFRESH_AFTER_UPDATE = os.getenv('REFRESH_AFTER_UPDATE', '0') == '1'
 
 
 def delete_all_full_files(local_full_path, file_types):
@@ -26,6 +30,7 @@ def delete_all_full_files(local_full_path, file_types):
 
 
 def main():
+    manifest = load_refreshed_manifest([s3_incremental_path, s3_daily_path])
     # Download incremental files newer than current full files
     ensure_directory_exists(local_incremental_path)
     for file_type in file_types:
@@ -33,7 +38,7 @@ def main():
         if latest_timestamp:
             delete_outdated_incremental_files(local_incremental_path, file_type, latest_timestamp)
             download_incremental_files(s3_incremental_path.split('/')[2], local_incremental_path, file_type,
-                                       latest_timestamp)
+                                       latest_timestamp, manifest)
 
     # Delete full files
     delete_all_full_files(local_full_path, file_types)
@@ -41,7 +46,13 @@ def main():
     # Download new full files
     ensure_directory_exists(local_full_path)
     for file_type in file_types:
-        download_most_recent_file(s3_daily_path, local_full_path, file_type)
+        download_most_recent_file(s3_daily_path, local_full_path, file_type, manifest)
+    save_manifest(manifest)
+
+    if REFRESH_AFTER_UPDATE:
+        # Imported here so the database is only connected to for a refresh
+        import refresh_snapshot
+        refresh_snapshot.main()
 
 
 if __name__ == "__main__":
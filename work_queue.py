@@ -0,0 +1,196 @@
+import os
+import sqlite3
+import sys
+import time
+
+# Local SQLite queue of downloaded incremental files waiting to be applied, shared by the downloader and loaders
+WORK_QUEUE_PATH = os.getenv('WORK_QUEUE_PATH', './downloads/work_queue.sqlite')
+# Longest wait, in seconds, before a failed file is retried; earlier retries back off exponentially from 2 seconds
+RETRY_MAX_DELAY = 60
+
+PENDING = 'pending'
+APPLYING = 'applying'
+DONE = 'done'
+
+
+def _file_table_name(file_path):
+    return os.path.basename(file_path).split('-')[1]
+
+
+def _file_timestamp(file_path):
+    # The end of the file's window, as extract_timestamp in insert_or_update_sql
+    return int(os.path.basename(file_path).rsplit('.', 1)[0].rsplit('-', 1)[-1])
+
+
+def connect():
+    os.makedirs(os.path.dirname(os.path.abspath(WORK_QUEUE_PATH)), exist_ok=True)
+    conn = sqlite3.connect(WORK_QUEUE_PATH, timeout=30, isolation_level=None)
+    # WAL lets the downloader enqueue while a loader reads the queue
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS work_queue ("
+        "file_path TEXT PRIMARY KEY, table_name TEXT NOT NULL, file_timestamp INTEGER NOT NULL, "
+        "state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+        "not_before REAL NOT NULL DEFAULT 0, claimed_by INTEGER, enqueued_at REAL NOT NULL, finished_at REAL, "
+        "error TEXT)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS work_queue_table_state ON work_queue (table_name, state, file_timestamp)")
+    return conn
+
+
+def enqueue(file_paths):
+    """Queue files for applying; files already queued, in any state, are left alone. Returns how many were added."""
+    # Local files are keyed by absolute path, so the downloader and a loader started elsewhere agree
+    rows = [(file_path if file_path.startswith('s3://') else os.path.abspath(file_path),
+             _file_table_name(file_path), _file_timestamp(file_path), time.time())
+            for file_path in file_paths]
+    if not rows:
+        return 0
+    conn = connect()
+    try:
+        before = conn.total_changes
+        conn.executemany("INSERT OR IGNORE INTO work_queue (file_path, table_name, file_timestamp, enqueued_at) "
+                         "VALUES (?, ?, ?, ?)", rows)
+        return conn.total_changes - before
+    finally:
+        conn.close()
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def claim_next(exclude_tables=(), max_files=1):
+    """Claim the oldest unfinished files of every table that has no file being applied.
+
+    A table's later files wait while its oldest is being applied or is backing off after a failure, so each
+    table is applied strictly in timestamp order. Up to max_files consecutive files are claimed per table as
+    one run, except after a failure, when the failed file is retried on its own. Claims of processes that
+    died are released first. Returns the claimed runs, each a list of file paths oldest first.
+    """
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for file_path, pid in conn.execute("SELECT file_path, claimed_by FROM work_queue WHERE state = ?",
+                                           (APPLYING,)).fetchall():
+            if pid is None or not _process_alive(pid):
+                conn.execute("UPDATE work_queue SET state = ?, claimed_by = NULL WHERE file_path = ?",
+                             (PENDING, file_path))
+        heads = conn.execute(
+            "SELECT table_name, state, not_before, error FROM work_queue q WHERE state != ? AND file_timestamp = "
+            "(SELECT min(file_timestamp) FROM work_queue WHERE table_name = q.table_name AND state != ?) "
+            "ORDER BY file_timestamp",
+            (DONE, DONE)
+        ).fetchall()
+        now = time.time()
+        claimed = []
+        claimed_tables = set(exclude_tables)
+        for table_name, state, not_before, error in heads:
+            if state != PENDING or not_before > now or table_name in claimed_tables:
+                continue
+            run = [row[0] for row in conn.execute(
+                "SELECT file_path FROM work_queue WHERE table_name = ? AND state = ? ORDER BY file_timestamp LIMIT ?",
+                (table_name, PENDING, 1 if error is not None else max_files)
+            ).fetchall()]
+            conn.executemany("UPDATE work_queue SET state = ?, claimed_by = ?, attempts = attempts + 1 "
+                             "WHERE file_path = ?", [(APPLYING, os.getpid(), file_path) for file_path in run])
+            claimed.append(run)
+            claimed_tables.add(table_name)
+        conn.execute("COMMIT")
+        return claimed
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def complete(file_path):
+    conn = connect()
+    try:
+        conn.execute("UPDATE work_queue SET state = ?, claimed_by = NULL, finished_at = ?, error = NULL "
+                     "WHERE file_path = ?", (DONE, time.time(), file_path))
+    finally:
+        conn.close()
+
+
+def fail(file_path, error):
+    """Put a file back at the head of its table's queue, to be retried after a backoff."""
+    conn = connect()
+    try:
+        row = conn.execute("SELECT attempts FROM work_queue WHERE file_path = ?", (file_path,)).fetchone()
+        delay = min(2 ** (row[0] if row else 1), RETRY_MAX_DELAY)
+        conn.execute("UPDATE work_queue SET state = ?, claimed_by = NULL, error = ?, not_before = ? "
+                     "WHERE file_path = ?", (PENDING, str(error), time.time() + delay, file_path))
+    finally:
+        conn.close()
+
+
+def release(file_paths):
+    """Hand claimed files back untried, e.g. the end of a run that did not fit in one apply."""
+    conn = connect()
+    try:
+        conn.executemany("UPDATE work_queue SET state = ?, claimed_by = NULL, attempts = attempts - 1 "
+                         "WHERE file_path = ?", [(PENDING, file_path) for file_path in file_paths])
+    finally:
+        conn.close()
+
+
+def forget_before(table_name, timestamp):
+    """Drop a table's entries for files older than timestamp, e.g. once a newer full file supersedes them."""
+    conn = connect()
+    try:
+        conn.execute("DELETE FROM work_queue WHERE table_name = ? AND file_timestamp < ?", (table_name, timestamp))
+    finally:
+        conn.close()
+
+
+def depth():
+    """{table: files pending or being applied}."""
+    conn = connect()
+    try:
+        return dict(conn.execute("SELECT table_name, count(*) FROM work_queue WHERE state != ? GROUP BY table_name",
+                                 (DONE,)).fetchall())
+    finally:
+        conn.close()
+
+
+def newest_timestamps():
+    """{table: timestamp of the newest file ever queued}."""
+    conn = connect()
+    try:
+        return dict(conn.execute("SELECT table_name, max(file_timestamp) FROM work_queue GROUP BY table_name").fetchall())
+    finally:
+        conn.close()
+
+
+def main():
+    """Print the queue per table: files waiting, being applied and failing, and the oldest unfinished file."""
+    conn = connect()
+    try:
+        rows = conn.execute(
+            "SELECT table_name, sum(state = ?), sum(state = ?), sum(state = ? AND error IS NOT NULL), "
+            "min(CASE WHEN state != ? THEN file_timestamp END) FROM work_queue GROUP BY table_name ORDER BY table_name",
+            (PENDING, APPLYING, PENDING, DONE)
+        ).fetchall()
+        failing = conn.execute("SELECT file_path, attempts, error FROM work_queue WHERE state = ? AND error IS NOT NULL "
+                               "ORDER BY table_name, file_timestamp", (PENDING,)).fetchall()
+    finally:
+        conn.close()
+    print(f"{'table':<24}{'pending':>9}{'applying':>10}{'failing':>9}  oldest unfinished")
+    for table_name, pending, applying, failing_count, oldest in rows:
+        oldest = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(oldest)) if oldest else '-'
+        print(f"{table_name:<24}{pending:>9}{applying:>10}{failing_count:>9}  {oldest}")
+    for file_path, attempts, error in failing:
+        print(f"{os.path.basename(file_path)} failed {attempts} times: {error}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()